@@ -0,0 +1,114 @@
+import time
+import asyncio
+from typing import List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+
+from consts import backups
+from storage import FolderUpload, BackupRootFolder, load_tree
+from chunks import chunk_store, volumes_of
+from download_cache import file_paths
+
+# getFile calls in flight at once
+AUDIT_CONCURRENCY = 8
+
+def parts_of(backup: BackupRootFolder) -> List[Tuple[str, str, Optional[list]]]:
+    """
+    Every uploaded part of a backup as (label, file_id, [file_unique_id, file_size] or None).
+    Chunk volumes shared by several files of the backup are listed once.
+    """
+    children = backup.children if backup.is_loaded or not backup.tree_path else load_tree(backup.tree_path)
+    parts = []
+    seen = set()
+    stack = [(backup.name, children)]
+    while stack:
+        prefix, nodes = stack.pop()
+        for node in nodes:
+            path = f"{prefix}/{node.name}"
+            if isinstance(node, FolderUpload):
+                stack.append((path, node.children))
+                continue
+            if node.chunks is not None:
+                for volume in volumes_of(node.chunks):
+                    file_id = chunk_store.file_id(volume)
+                    if file_id not in seen:
+                        seen.add(file_id)
+                        parts.append((f"{path} [{volume}]", file_id, chunk_store.fingerprints.get(volume)))
+                continue
+            fingerprints = node.fingerprints if len(node.fingerprints) == len(node.upload_id) else []
+            for i, file_id in enumerate(node.upload_id):
+                parts.append((f"{path} [part {i + 1}]", file_id, fingerprints[i] if fingerprints else None))
+    return parts
+
+class RateLimiter:
+    """
+    Shared pause for all audit requests: once Telegram answers 429, nobody calls
+    until retry_after has passed, instead of every request running into it on its own.
+    """
+
+    def __init__(self):
+        self.resume_at = 0.0
+
+    async def wait(self) -> None:
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+async def check_part(bot: Bot, file_id: str, expected: Optional[list], limiter: RateLimiter) -> str:
+    """
+    Asks getFile about one part. Returns "ok", "missing", "mismatch", "unverified" (exists,
+    but nothing was recorded at upload to compare with) or "too_big" (exists, over the 20 MB getFile limit).
+    """
+    if not file_id:
+        return "missing"
+    while True:
+        await limiter.wait()
+        try:
+            file_info = await bot.get_file(file_id)
+            break
+        except TelegramRetryAfter as e:
+            limiter.pause(e.retry_after)
+        except TelegramBadRequest as e:
+            return "too_big" if "too big" in e.message else "missing"
+    if file_info.file_path:
+        # The path is valid for an hour, a restore started right after the audit can use it.
+        file_paths.paths[file_id] = (file_info.file_path, time.monotonic() + file_paths.ttl)
+    if not expected or expected[0] is None:
+        return "unverified"
+    unique_id, size = expected
+    if file_info.file_unique_id != unique_id or (size is not None and file_info.file_size != size):
+        return "mismatch"
+    return "ok"
+
+async def audit(bot: Bot, backup_token: str, concurrency: int = AUDIT_CONCURRENCY,
+                limiter: RateLimiter = None) -> dict:
+    """
+    Checks that every part of a backup is still stored by Telegram and is what was uploaded,
+    with getFile only: a few hundred bytes per part instead of downloading it.
+
+    Returns {"token", "name", "parts", "ok", "unverified", "too_big", "missing": [labels], "mismatch": [labels]}.
+    """
+    await asyncio.to_thread(backups.load)
+    backup = next((b for b in backups.backups if b.token == backup_token), None)
+    if backup is None:
+        raise ValueError(f"Backup {backup_token} not found")
+    parts = await asyncio.to_thread(parts_of, backup)
+    limiter = limiter or RateLimiter()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def check(label, file_id, expected):
+        async with semaphore:
+            return label, await check_part(bot, file_id, expected, limiter)
+
+    report = {"token": backup.token, "name": backup.name, "parts": len(parts),
+              "ok": 0, "unverified": 0, "too_big": 0, "missing": [], "mismatch": []}
+    for label, status in await asyncio.gather(*(check(*part) for part in parts)):
+        if isinstance(report[status], list):
+            report[status].append(label)
+        else:
+            report[status] += 1
+    return report
@@ -1,275 +1,799 @@
+import io
 import os
+import json
+import re
+import uuid
 import multiprocessing
 import subprocess
+import signal
+import threading
+import queue
 import time
 import shutil
+import contextlib
 import datetime
 import glob
 import asyncio
-from typing import Union
+from typing import Union, Optional, Callable, Any, List, Dict
 
 from pathlib import Path
 import requests
 from aiogram import Bot
 
-from consts import backups, THRESHOLD
-from storage import FileUpload, FolderUpload, BackupRootFolder
+# The backups store is imported where it is used: consts needs the bot token,
+# and agents (worker.py) stage with this module on hosts that have none.
+from config import THRESHOLD, TMP_ROOT, TMP_DIR, TMP_BUDGET, DELTA_MIN_SIZE, COMPRESSION_CORES, \
+    UPLOAD_BATCH, UPLOAD_BATCH_BYTES
+from storage import FileUpload, BackupRootFolder, BackupStorage, generate_token
+from staging import TmpBudget, hold_dir, claim_dir, DIR_LOCK
+from throttle import bandwidth
+from chunks import chunk_store, chunk_file, volumes_of, assemble
+from download_cache import download_cache, file_url, url_resolver
+from utils import build_tree, folder_size, iter_files, human_readable_size
+from filters import matcher_for, SkipStats
+from tuner import tuner, uplink_meter
 
-def send_backup_files(bot: Bot, chat_id: int, backup_token: str, thread_id: int = None):
+# 7z -mx5 uses a 16 MB dictionary and LZMA2 blocks of 4x that, each compressed by two threads
+LZMA2_BLOCK = 64 * 1024 * 1024
+
+# Seconds the uploader waits for more staged files to fill a media group
+BATCH_LINGER = 0.2
+
+# Matches the numeric suffix 7z appends to volumes: archive.7z.001, archive.7z.002, ...
+PART_SUFFIX = re.compile(r"\.\d{3,}$")
+
+# Largest block MultipartBody hands out per read, whatever the caller asks for
+READ_BLOCK = 256 * 1024
+
+# Rounds of re-sending the parts a mirror missed at the end of a backup, and the first pause
+# in seconds between them (doubled every round)
+MIRROR_RETRIES = 4
+MIRROR_BACKOFF = 2
+
+class MultipartBody:
     """
-    Sends all files associated with the backup identified by backup_token.
-    Recursively traverses the backup's structure stored in backups,
-    uploads each file (using its absolute_path), and updates its upload_id list.
-    For split files (is_split=True), all parts are uploaded and each part's file_id
-    is appended to the list.
-    After sending, files are deleted from disk.
-    
-    Parameters:
-      - bot: The Bot instance.
-      - chat_id: The target chat id.
-      - backup_token: The unique token identifying the backup (from a BackupRootFolder).
-      - thread_id: (Optional) Message thread id if needed.
+    multipart/form-data body whose files are read from disk while it is being sent.
+    requests streams file-like data of known length in small blocks instead of
+    building the whole body in memory, and every block goes through the bandwidth limiter.
+    No read returns more than READ_BLOCK bytes, so memory per upload stays the same
+    for any part size (bench_upload.py measures it).
     """
-    # Look up the backup with the matching token.
-    backups.load()
-    backup = next((b for b in backups.backups if b.token == backup_token), None)
-    if backup is None:
-        print(f"Backup with token {backup_token} not found.")
+
+    def __init__(self, fields: dict, files: dict):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = b""
+        for key, value in fields.items():
+            if value is None:
+                continue
+            head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n'
+                     f'{value}\r\n').encode()
+        self._parts = [io.BytesIO(head)]
+        self.len = len(head)
+        for file_field, path in files.items():
+            filename = os.path.basename(path).replace('"', "%22")
+            file_head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                         f'Content-Type: application/octet-stream\r\n\r\n').encode()
+            self._parts += [io.BytesIO(file_head), open(path, "rb"), io.BytesIO(b"\r\n")]
+            self.len += len(file_head) + os.path.getsize(path) + 2
+        tail = f"--{boundary}--\r\n".encode()
+        self._parts.append(io.BytesIO(tail))
+        self.len += len(tail)
+
+    def read(self, size: int = -1) -> bytes:
+        size = READ_BLOCK if size < 0 else min(size, READ_BLOCK)
+        chunks = []
+        left = size
+        while self._parts and left > 0:
+            chunk = self._parts[0].read(left)
+            if not chunk:
+                self._parts.pop(0).close()
+                continue
+            chunks.append(chunk)
+            left -= len(chunk)
+        data = b"".join(chunks)
+        bandwidth.consume(len(data))
+        return data
+
+    def close(self) -> None:
+        for part in self._parts:
+            part.close()
+        self._parts = []
+
+def post_multipart(token: str, method: str, fields: dict, files: dict) -> dict:
+    """
+    Calls a Bot API method with a streamed multipart body and returns the decoded response.
+    On 429 the call is repeated after the retry_after Telegram asks for.
+    """
+    while True:
+        body = MultipartBody(fields, files)
+        try:
+            response = requests.post(
+                f"https://api.telegram.org/bot{token}/{method}",
+                data=body,
+                headers={"Content-Type": body.content_type}
+            )
+        finally:
+            body.close()
+        resp_json = response.json()
+        retry_after = (resp_json.get("parameters") or {}).get("retry_after")
+        if resp_json.get("error_code") == 429 and retry_after:
+            print(f"Rate limited on {method}, retrying in {retry_after}s")
+            time.sleep(retry_after)
+            continue
+        return resp_json
+
+def upload_document(token: str, chat_id: int, path: str, thread_id: int = None) -> Optional[dict]:
+    """
+    Uploads a single file with sendDocument and returns the Document Telegram made of it
+    (file_id, file_unique_id, file_size, ...), or None if Telegram refused it.
+    """
+    start_time = time.time()
+    resp_json = post_multipart(token, "sendDocument",
+                               {"chat_id": chat_id, "message_thread_id": thread_id}, {"document": path})
+    elapsed_time = time.time() - start_time
+    size_mb = os.path.getsize(path) / (1024 * 1024)
+    speed = size_mb / elapsed_time if elapsed_time > 0 else 0
+    print(f"Sent {os.path.basename(path)} in {elapsed_time:.2f}s at {speed:.2f} MB/s")
+    if resp_json.get("ok"):
+        document = resp_json["result"]["document"]
+        print(f"File ID for {os.path.basename(path)}: {document['file_id']}")
+        return document
+    print(f"Error sending {os.path.basename(path)}: {resp_json}")
+    return None
+
+def upload_documents(token: str, chat_id: int, paths: List[str], thread_id: int = None) -> List[Optional[dict]]:
+    """
+    Uploads up to 10 files in one sendMediaGroup call (one message group in the chat)
+    and returns their Documents in the order of paths, None for the ones Telegram refused.
+    """
+    if len(paths) == 1:
+        return [upload_document(token, chat_id, paths[0], thread_id)]
+    start_time = time.time()
+    media = [{"type": "document", "media": f"attach://file{i}"} for i in range(len(paths))]
+    resp_json = post_multipart(token, "sendMediaGroup",
+                               {"chat_id": chat_id, "message_thread_id": thread_id, "media": json.dumps(media)},
+                               {f"file{i}": path for i, path in enumerate(paths)})
+    elapsed_time = time.time() - start_time
+    size_mb = sum(os.path.getsize(path) for path in paths) / (1024 * 1024)
+    speed = size_mb / elapsed_time if elapsed_time > 0 else 0
+    print(f"Sent {len(paths)} files as a group in {elapsed_time:.2f}s at {speed:.2f} MB/s")
+    if not resp_json.get("ok"):
+        print(f"Error sending group of {len(paths)} files: {resp_json}")
+        return [None] * len(paths)
+    # Messages of a media group come back in the order of the media array.
+    return [message.get("document") for message in resp_json["result"]]
+
+def forward_documents(token: str, chat_id: int, file_ids: List[str], thread_id: int = None) -> bool:
+    """
+    Posts already uploaded files to another chat by file_id, as one message or one media group.
+    Telegram reuses the stored file, so nothing is uploaded again. Returns True on success.
+    """
+    if len(file_ids) == 1:
+        resp_json = post_multipart(token, "sendDocument",
+                                   {"chat_id": chat_id, "message_thread_id": thread_id, "document": file_ids[0]}, {})
+    else:
+        media = [{"type": "document", "media": file_id} for file_id in file_ids]
+        resp_json = post_multipart(token, "sendMediaGroup",
+                                   {"chat_id": chat_id, "message_thread_id": thread_id, "media": json.dumps(media)}, {})
+    if not resp_json.get("ok"):
+        print(f"Error copying {len(file_ids)} files to {chat_id}: {resp_json}")
+        return False
+    print(f"Copied {len(file_ids)} files to {chat_id}")
+    return True
+
+def copy_to_mirror(token: str, chat_id: int, file_ids: List[str], thread_id: int = None) -> List[str]:
+    """
+    Posts file_ids to a mirror chat in media groups of up to 10 (see forward_documents).
+    Returns the file_ids that did not make it.
+    """
+    missed = []
+    for i in range(0, len(file_ids), 10):
+        group = file_ids[i:i + 10]
+        try:
+            copied = forward_documents(token, chat_id, group, thread_id)
+        except Exception as e:
+            print(f"Failed to copy to {chat_id}: {e}")
+            copied = False
+        if not copied:
+            missed.extend(group)
+    return missed
+
+def _suspend(process: subprocess.Popen) -> None:
+    # Windows has no SIGSTOP, there 7z keeps running and the budget is only enforced for copies.
+    if hasattr(signal, "SIGSTOP"):
+        process.send_signal(signal.SIGSTOP)
+
+def _resume(process: subprocess.Popen) -> None:
+    if hasattr(signal, "SIGCONT"):
+        process.send_signal(signal.SIGCONT)
+
+def run_7z(command: list, output_file: str, file_record: FileUpload,
+           budget: TmpBudget = None, staged: queue.Queue = None, cwd: str = None) -> None:
+    """
+    Runs a 7z command that writes a multi-volume archive to output_file.
+
+    Without a staged queue this simply waits for 7z. With one, every volume is handed
+    to the uploader as soon as 7z moves on to the next one, and 7z is paused while
+    staged-but-not-uploaded bytes would exceed the budget.
+    """
+    if staged is None:
+        subprocess.run(command, check=True, cwd=cwd)
         return
+    budget = budget or TmpBudget()
+    process = subprocess.Popen(command, cwd=cwd)
+    # Uploaded volumes get deleted, so track them by name rather than by position.
+    published = set()
+    paused = False
+    while True:
+        finished = process.poll() is not None
+        # By volume number: as strings ".1000" would sort before ".999".
+        parts = sorted((part for part in glob.glob(glob.escape(output_file) + ".*") if PART_SUFFIX.search(part)),
+                       key=lambda part: int(part.rsplit(".", 1)[1]))
+        # The highest-numbered volume is still being written until 7z exits.
+        ready = parts if finished else parts[:-1]
+        for part in ready:
+            if part in published:
+                continue
+            size = os.path.getsize(part)
+            budget.add(size)
+            staged.put((file_record, part, size))
+            published.add(part)
+        if finished:
+            break
+        full = budget.is_full(THRESHOLD)
+        if full and not paused:
+            _suspend(process)
+            paused = True
+            print(f"tmp budget reached, pausing 7z for {os.path.basename(output_file)}")
+        elif paused and not full:
+            _resume(process)
+            paused = False
+        time.sleep(0.5)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
 
-    token = bot.token  # Bot token for URL construction
+# Helper: if a file already exists (i.e. a split archive part exists), append (1), (2), etc.
+# Names handed out to archives that 7z has not started writing yet, for concurrent jobs.
+_reserved_archives = set()
+_reserved_lock = threading.Lock()
 
-    def send_file(file_record):
-        # Check if file_record.absolute_path exists.
-        if not file_record.absolute_path or (not os.path.exists(file_record.absolute_path) \
-            and not os.path.exists(file_record.absolute_path + ".001")):
-            print(f"File {file_record.name} not found at {file_record.absolute_path}.")
-            return
-        
-        # If the file is marked as split, we need to send all parts.
-        if file_record.is_split:
-            # Use a glob pattern to find all parts.
-            pattern = file_record.absolute_path + ".*"
-            parts = sorted(glob.glob(pattern))
-            if not parts:
-                print(f"No parts found for split archive {file_record.name}.")
-                return
-            
-            for part in parts:
-                try:
-                    start_time = time.time()
-                    with open(part, "rb") as f:
-                        response = requests.post(
-                            f"https://api.telegram.org/bot{token}/sendDocument",
-                            files={"document": f},
-                            data={"chat_id": chat_id, "message_thread_id": thread_id}
-                        )
-                    elapsed_time = time.time() - start_time
-                    part_size_mb = os.path.getsize(part) / (1024 * 1024)
-                    speed = part_size_mb / elapsed_time if elapsed_time > 0 else 0
-                    print(f"Sent part {os.path.basename(part)} in {elapsed_time:.2f}s at {speed:.2f} MB/s")
-                    resp_json = response.json()
-                    if resp_json.get("ok"):
-                        file_id = resp_json["result"]["document"]["file_id"]
-                        print(f"File ID for part {os.path.basename(part)}: {file_id}")
-                        file_record.upload_id.append(file_id)
-                    else:
-                        print(f"Error sending {os.path.basename(part)}: {resp_json}")
-                    os.remove(part)
-                    print(f"Deleted part {os.path.basename(part)} from disk.")
-                except Exception as e:
-                    print(f"Failed to send part {os.path.basename(part)}: {e}")
-        else:
-            # Normal (non-split) file processing.
+def get_unique_filename(filename: str) -> str:
+    unique_name = filename
+    counter = 1
+    with _reserved_lock:
+        while os.path.exists(unique_name + ".001") or unique_name in _reserved_archives:
+            base, ext = os.path.splitext(filename)
+            unique_name = f"{base} ({counter}){ext}"
+            counter += 1
+        _reserved_archives.add(unique_name)
+    return unique_name
+
+def release_filename(filename: str) -> None:
+    with _reserved_lock:
+        _reserved_archives.discard(filename)
+
+# Same for plain copies: files with one name from different folders may be staged at once.
+def get_unique_copy(filename: str) -> str:
+    unique_name = filename
+    counter = 1
+    while os.path.exists(unique_name):
+        base, ext = os.path.splitext(filename)
+        unique_name = f"{base} ({counter}){ext}"
+        counter += 1
+    return unique_name
+
+def copy_file(src: str, name: str, size: int,
+              budget: TmpBudget = None, staged: queue.Queue = None) -> FileUpload:
+    """
+    Copies a small file into tmp/ as is and returns its record.
+    """
+    budget = budget or TmpBudget()
+    budget.reserve(size)
+    hold_dir(TMP_DIR)
+    dest_file = get_unique_copy(os.path.join(TMP_DIR, name))
+    shutil.copy2(src, dest_file)
+    print(f"Copied {name} to {TMP_DIR}")
+    file_record = FileUpload(
+        name=name,
+        upload_id=[],
+        absolute_path=os.path.abspath(dest_file),
+        is_split=False
+    )
+    if staged is not None:
+        staged.put((file_record, file_record.absolute_path, size))
+    else:
+        budget.release(size)
+    return file_record
+
+def new_archive(name: str) -> tuple:
+    """
+    Picks the tmp/ path of the multi-volume archive for a file and creates its record.
+    """
+    hold_dir(TMP_DIR)
+    current_date = datetime.datetime.now().strftime("%Y-%m-%d")
+    output_file = get_unique_filename(os.path.join(TMP_DIR, f"{current_date}_{name}.7z"))
+    file_record = FileUpload(
+        name=os.path.basename(output_file),
+        upload_id=[],
+        absolute_path=os.path.abspath(output_file),
+        is_split=True
+    )
+    return output_file, file_record
+
+def compress_to(src: str, output_file: str, file_record: FileUpload, num_threads: int,
+                budget: TmpBudget = None, staged: queue.Queue = None, level: int = 5) -> None:
+    command = [
+        "7z", "a", output_file,
+        src,
+        "-m0=LZMA2",
+        f"-mx{level}",
+        f"-v{int(THRESHOLD / 1024 / 1024)}m",
+        f"-mmt{num_threads}"
+    ]
+    try:
+        run_7z(command, output_file, file_record, budget, staged)
+    finally:
+        release_filename(output_file)
+    print(f"Compressed {os.path.basename(src)} into multi-volume archive {output_file}")
+
+def compress_file(src: str, name: str,
+                  budget: TmpBudget = None, staged: queue.Queue = None) -> FileUpload:
+    """
+    Packs a large file into a multi-volume 7z archive in tmp/ and returns its record.
+    """
+    level, num_threads = tuner.settings(src, max(1, int(multiprocessing.cpu_count() * 0.7)))
+    output_file, file_record = new_archive(name)
+    compress_to(src, output_file, file_record, num_threads, budget, staged, level)
+    return file_record
+
+class CompressionScheduler:
+    """
+    Runs several 7z jobs at once for individual mode.
+
+    LZMA2 compresses a file in blocks of LZMA2_BLOCK bytes with two threads per block,
+    so a medium-sized file can't keep many threads busy. Every job gets the threads
+    its size can use, and jobs are started while their threads fit into the core budget.
+    submit() returns the record right away, its parts reach the uploader as they are written.
+    The core budget is shared by all schedulers, so backups running side by side share the CPU too.
+    """
+    cores = COMPRESSION_CORES or multiprocessing.cpu_count()
+    used = 0
+    _cond = threading.Condition()
+
+    def __init__(self, budget: TmpBudget = None, staged: queue.Queue = None):
+        self.budget = budget
+        self.staged = staged
+        self.jobs = []
+        self.errors = []
+
+    def threads_for(self, size: int) -> int:
+        blocks = -(-size // LZMA2_BLOCK)
+        return max(1, min(self.cores, blocks * 2))
+
+    def submit(self, src: str, name: str, size: int) -> FileUpload:
+        """
+        Waits until the job fits into the core budget and starts it. A job that needs
+        more than the whole budget still runs, but only once nothing else does.
+        """
+        level, num_threads = tuner.settings(src, self.threads_for(size))
+        pool = CompressionScheduler
+        with pool._cond:
+            while pool.used and pool.used + num_threads > pool.cores:
+                pool._cond.wait()
+            pool.used += num_threads
+        output_file, file_record = new_archive(name)
+
+        def job():
             try:
-                start_time = time.time()
-                with open(file_record.absolute_path, "rb") as f:
-                    response = requests.post(
-                        f"https://api.telegram.org/bot{token}/sendDocument",
-                        files={"document": f},
-                        data={"chat_id": chat_id, "message_thread_id": thread_id}
-                    )
-                elapsed_time = time.time() - start_time
-                file_size_mb = os.path.getsize(file_record.absolute_path) / (1024 * 1024)
-                speed = file_size_mb / elapsed_time if elapsed_time > 0 else 0
-                print(f"Sent {file_record.name} in {elapsed_time:.2f}s at {speed:.2f} MB/s")
-                resp_json = response.json()
-                if resp_json.get("ok"):
-                    file_id = resp_json["result"]["document"]["file_id"]
-                    print(f"File ID for {file_record.name}: {file_id}")
-                    file_record.upload_id.append(file_id)
-                else:
-                    print(f"Error sending {file_record.name}: {resp_json}")
-                os.remove(file_record.absolute_path)
-                print(f"Deleted {file_record.name} from disk.")
+                compress_to(src, output_file, file_record, num_threads, self.budget, self.staged, level)
             except Exception as e:
-                print(f"Failed to send {file_record.name}: {e}")
+                print(f"Failed to compress {name}: {e}")
+                self.errors.append(e)
+            finally:
+                with pool._cond:
+                    pool.used -= num_threads
+                    pool._cond.notify_all()
 
-    def process_item(item: Union["FolderUpload", "FileUpload"]):
-        # If it's a FileUpload, send it.
-        if hasattr(item, "absolute_path"):
-            send_file(item)
-        # If it's a FolderUpload, recursively process its children.
-        if hasattr(item, "children") and item.children:
-            for child in item.children:
-                process_item(child)
+        thread = threading.Thread(target=job, daemon=True)
+        thread.start()
+        self.jobs.append(thread)
+        return file_record
 
-    # Process each child of the backup root folder.
-    for child in backup.children:
-        process_item(child)
-    
-    time.sleep(3)
-    backup.uploaded = True
-    backups.save()
-    print("Finished sending backup files.")
+    def join(self) -> None:
+        """
+        Waits for all submitted jobs and re-raises the first failure.
+        """
+        for thread in self.jobs:
+            thread.join()
+        self.jobs = []
+        if self.errors:
+            raise self.errors[0]
 
-def create_backup(path: str, mode: str):
-    backups.load()
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    tmp_dir = os.path.join(script_dir, "tmp")
-    os.makedirs(tmp_dir, exist_ok=True)
+def stage_file(src: str, name: str, size: int, budget: TmpBudget = None,
+               staged: queue.Queue = None, compressor: CompressionScheduler = None) -> FileUpload:
+    """
+    Stages one file for individual mode: small files are copied, large ones compressed,
+    and very large ones split into chunks so that only changed chunks get uploaded.
+    With a compressor, large files are compressed in the background by it.
+    """
+    if size < THRESHOLD:
+        file_record = copy_file(src, name, size, budget, staged)
+    elif DELTA_MIN_SIZE and size >= DELTA_MIN_SIZE:
+        hold_dir(TMP_DIR)
+        current_date = datetime.datetime.now().strftime("%Y-%m-%d")
+        # Volume names are keys of the chunk index, so they must never repeat.
+        output_file = os.path.join(TMP_DIR, f"{current_date}_{name}.{uuid.uuid4().hex[:8]}.chunks")
+        file_record = chunk_file(src, name, output_file, budget, staged)
+    elif compressor is not None:
+        file_record = compressor.submit(src, name, size)
+    else:
+        file_record = compress_file(src, name, budget, staged)
+    file_record.size = size
+    return file_record
+
+def create_backup(path: str, mode: str, token: str = None,
+                  budget: TmpBudget = None, staged: queue.Queue = None, skipped: SkipStats = None,
+                  storage: BackupStorage = None):
+    """
+    Stages the files under path in tmp/ and records the backup structure in backups.
+
+    Parameters:
+      - path: File or folder to back up.
+      - mode: "archive" to pack everything in one multi-volume 7z, anything else for individual mode.
+      - token: (Optional) Token for the new BackupRootFolder, generated if omitted.
+      - budget: (Optional) TmpBudget that limits how many bytes can sit in tmp/ at once.
+      - staged: (Optional) Queue that receives (file_record, part_path, size) for every staged
+        file or volume as soon as it is ready. Only pass it together with a consumer that uploads
+        and releases the parts (see run_backup), otherwise the budget never frees up.
+      - skipped: (Optional) SkipStats that counts what the exclusion rules (see filters.py) left out.
+      - storage: (Optional) BackupStorage that records the backup, backups by default.
+    """
+    if storage is None:
+        from consts import backups as storage
+    storage.load()
+    tmp_dir = hold_dir(TMP_DIR)
+    budget = budget or TmpBudget()
+    root_kwargs = {"token": token} if token else {}
     
     current_date = datetime.datetime.now().strftime("%Y-%m-%d")
     base_name = os.path.basename(os.path.abspath(path))
     output_pattern = os.path.join(tmp_dir, f"{current_date}_{base_name}.7z")
     num_threads = max(1, int(multiprocessing.cpu_count() * 0.7))
-    
-    # Helper: if a file already exists (i.e. a split archive part exists), append (1), (2), etc.
-    def get_unique_filename(filename: str) -> str:
-        unique_name = filename
-        counter = 1
-        while os.path.exists(unique_name + ".001"):
-            base, ext = os.path.splitext(filename)
-            unique_name = f"{base} ({counter}){ext}"
-            counter += 1
-        return unique_name
+    matcher = matcher_for(path) if os.path.isdir(path) else None
+    skipped = skipped if skipped is not None else SkipStats()
 
     if mode == "archive":
         # Always create a BackupRootFolder so that it gets its own unique token.
         output_pattern = get_unique_filename(output_pattern)
+        # One 7z process packs everything, so the level is tuned once at the start.
+        level, num_threads = tuner.settings(path, num_threads)
         command = [
             "7z", "a", output_pattern,
             path, 
             "-m0=LZMA2",  # Use LZMA2 compression
-            "-mx5",        # Medium compression level
+            f"-mx{level}",  # Level picked by the tuner, -mx5 unless set or measured otherwise
             f"-v{int(THRESHOLD / 1024 / 1024)}m",       # Split into 48MB parts
             f"-mmt{num_threads}"  # Use 70% of available CPU cores
         ]
-        
-        subprocess.run(command, check=True)
-        print(f"Created multi-volume archive: {output_pattern}*")
+        cwd = None
+        list_file = None
+        source_size = None
+        if matcher:
+            # 7z can't read gitignore rules, it gets the list of files that pass them instead.
+            # Run from the parent folder so the paths in the archive start with base_name as usual.
+            cwd = os.path.dirname(os.path.abspath(path))
+            # Not output_pattern + ".list", run_7z would take that for a volume.
+            list_file = os.path.splitext(output_pattern)[0] + ".list"
+            source_size = 0
+            with open(list_file, "w", encoding="utf-8") as f:
+                for file_path, _, size in iter_files(path, matcher, skipped):
+                    f.write(os.path.relpath(file_path, cwd) + "\n")
+                    source_size += size
+            command[3] = f"@{list_file}"
+            command.append("-scsUTF-8")
         
         # Instead of collecting all parts (which have appended suffixes), we store the base archive path.
-        backup_folder = BackupRootFolder(name=base_name, children=[])
+        backup_folder = BackupRootFolder(name=base_name, children=[], **root_kwargs)
         file_upload = FileUpload(
             name=os.path.basename(output_pattern),
             upload_id=[],
             absolute_path=os.path.abspath(output_pattern),
-            is_split=True
+            is_split=True,
+            size=source_size if source_size is not None else
+                 folder_size(path) if os.path.isdir(path) else os.path.getsize(path)
         )
+        try:
+            run_7z(command, output_pattern, file_upload, budget, staged, cwd)
+        finally:
+            release_filename(output_pattern)
+            if list_file:
+                os.remove(list_file)
+        print(f"Created multi-volume archive: {output_pattern}*")
         backup_folder.children.append(file_upload)
-        backups.add_backup(backup_folder)
-        backups.save()
+        storage.add_backup(backup_folder)
+        storage.save()
         print(f"Updated backups storage with archive backup '{base_name}' (token: {backup_folder.token}).")
         
     else:
         # Non-archive mode: build the full directory structure.
         if os.path.isdir(path):
-            folder_dict = {}
-            abs_path = os.path.abspath(path)
-            # Create top-level folder record as a BackupRootFolder (to have a unique token).
-            folder_dict[abs_path] = BackupRootFolder(name=base_name, children=[])
-            
-            for root, dirs, files in os.walk(path):
-                root_abs = os.path.abspath(root)
-                if root_abs not in folder_dict:
-                    folder_dict[root_abs] = FolderUpload(name=os.path.basename(root_abs), upload_id="", children=[])
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    file_size = os.path.getsize(file_path)
-                    if file_size < THRESHOLD:
-                        dest_file = os.path.join(tmp_dir, file)
-                        shutil.copy2(file_path, dest_file)
-                        print(f"Copied {file} to {tmp_dir}")
-                        file_record = FileUpload(
-                            name=file,
-                            upload_id=[],
-                            absolute_path=os.path.abspath(dest_file),
-                            is_split=False
-                        )
-                    else:
-                        output_file = os.path.join(tmp_dir, f"{current_date}_{file}.7z")
-                        output_file = get_unique_filename(output_file)
-                        command = [
-                            "7z", "a", output_file,
-                            file_path,
-                            "-m0=LZMA2",
-                            "-mx5",
-                            f"-v{int(THRESHOLD / 1024 / 1024)}m",
-                            f"-mmt{num_threads}"
-                        ]
-                        subprocess.run(command, check=True)
-                        print(f"Compressed {file} into multi-volume archive {output_file}")
-                        file_record = FileUpload(
-                            name=os.path.basename(output_file),
-                            upload_id=[],
-                            absolute_path=os.path.abspath(output_file),
-                            is_split=True
-                        )
-                    folder_dict[root_abs].children.append(file_record)
-                
-                for d in dirs:
-                    subdir_abs = os.path.abspath(os.path.join(root, d))
-                    if subdir_abs not in folder_dict:
-                        folder_dict[subdir_abs] = FolderUpload(name=d, upload_id="", children=[])
-                    parent_dir = os.path.abspath(root)
-                    if not any(isinstance(child, FolderUpload) and child.name == d for child in folder_dict[parent_dir].children):
-                        folder_dict[parent_dir].children.append(folder_dict[subdir_abs])
-            
-            backup_folder = folder_dict[abs_path]
-            backups.add_backup(backup_folder)
-            backups.save()
+            # The tree is built while walking, the root is a BackupRootFolder (to have a unique token).
+            # Large files are compressed concurrently while the walk goes on.
+            compressor = CompressionScheduler(budget, staged)
+            backup_folder = build_tree(
+                path, BackupRootFolder(name=base_name, children=[], **root_kwargs),
+                lambda file_path, name, file_size: stage_file(file_path, name, file_size,
+                                                              budget, staged, compressor),
+                matcher, skipped
+            )
+            compressor.join()
+            storage.add_backup(backup_folder)
+            storage.save()
             print(f"Updated backups storage with folder structure backup '{base_name}' (token: {backup_folder.token}).")
         elif os.path.isfile(path):
-            file_size = os.path.getsize(path)
-            if file_size < THRESHOLD:
-                dest_file = os.path.join(tmp_dir, base_name)
-                shutil.copy2(path, dest_file)
-                print(f"Copied file {base_name} to {tmp_dir}")
-                file_record = FileUpload(
-                    name=base_name,
-                    upload_id=[],
-                    absolute_path=os.path.abspath(dest_file),
-                    is_split=False
-                )
-            else:
-                output_file = os.path.join(tmp_dir, f"{current_date}_{base_name}.7z")
-                output_file = get_unique_filename(output_file)
-                command = [
-                    "7z", "a", output_file,
-                    path,
-                    "-m0=LZMA2",
-                    "-mx5",
-                    f"-v{int(THRESHOLD / 1024 / 1024)}m",
-                    f"-mmt{num_threads}"
-                ]
-                subprocess.run(command, check=True)
-                print(f"Compressed file {base_name} into multi-volume archive {output_file}")
-                file_record = FileUpload(
-                    name=os.path.basename(output_file),
-                    upload_id=[],
-                    absolute_path=os.path.abspath(output_file),
-                    is_split=True
-                )
-            backup_folder = BackupRootFolder(name=base_name, children=[file_record])
-            backups.add_backup(backup_folder)
-            backups.save()
+            file_record = stage_file(path, base_name, os.path.getsize(path), budget, staged)
+            backup_folder = BackupRootFolder(name=base_name, children=[file_record], **root_kwargs)
+            storage.add_backup(backup_folder)
+            storage.save()
             print(f"Updated backups storage with backup for file '{base_name}' (token: {backup_folder.token}).")
+
+    if skipped.files or skipped.dirs:
+        print(f"Exclusion rules skipped {skipped.files} files ({human_readable_size(skipped.bytes)}) "
+              f"and {skipped.dirs} folders of {base_name}")
     
     # Return the token of the backup root folder.
     return backup_folder.token
 
-async def download(backup_token: str, bot: Bot):
+def run_pipeline(bot: Bot, chat_id: int, produce: Callable[[TmpBudget, queue.Queue], Any],
+                 thread_id: int = None, stats: dict = None,
+                 mirrors: Union[List[int], Dict[int, Optional[int]]] = None, failed: list = None) -> Any:
+    """
+    Runs produce(budget, staged) in a worker thread and uploads everything it stages.
+
+    The producer puts (file_record, part_path, size) on the queue for every staged file or volume,
+    this thread uploads them in order, deletes them and frees the tmp budget, which lets a paused 7z
+    or a blocked copy continue. Returns whatever produce returned and re-raises what it raised.
+    If a stats dict is passed, it receives the number of parts and bytes sent, failed parts and seconds.
+
+    Every uploaded batch is also posted to the mirrors chats by file_id (see forward_documents),
+    mirrors is a list of chat ids or a dict of chat id -> message thread id. Parts a mirror misses
+    are sent again at the end, MIRROR_RETRIES times with backoff, stats["mirrors"] tells for each
+    mirror whether it got every part in the end.
+    If a failed list is passed, it receives every file record that lost a part.
+    """
+    from consts import backups
+    budget = TmpBudget(TMP_BUDGET)
+    staged = queue.Queue()
+    result = {}
+    stats = stats if stats is not None else {}
+    stats.update(parts=0, bytes=0, failed=0)
+    mirror_threads = {mirror: (mirrors.get(mirror) if isinstance(mirrors, dict) else None)
+                      for mirror in mirrors or [] if mirror != chat_id}
+    stats["mirrors"] = {mirror: True for mirror in mirror_threads}
+    missed = {mirror: [] for mirror in mirror_threads}
+    failed = failed if failed is not None else []
+    start_time = time.time()
+    handled = []
+
+    def worker():
+        try:
+            result["value"] = produce(budget, staged)
+        except Exception as e:
+            result["error"] = e
+        finally:
+            staged.put(None)
+
+    def batches():
+        # Groups what is already staged (or arrives within BATCH_LINGER) into batches
+        # of up to UPLOAD_BATCH files and UPLOAD_BATCH_BYTES, keeping the queue order.
+        carry = []
+        while True:
+            item = carry.pop() if carry else staged.get()
+            if item is None:
+                return
+            batch, batch_size = [item], item[2]
+            while len(batch) < UPLOAD_BATCH:
+                try:
+                    item = staged.get(timeout=BATCH_LINGER)
+                except queue.Empty:
+                    break
+                if item is None or batch_size + item[2] > UPLOAD_BATCH_BYTES:
+                    carry.append(item)
+                    break
+                batch.append(item)
+                batch_size += item[2]
+            yield batch
+
+    producer = threading.Thread(target=worker, daemon=True)
+    producer.start()
+    for batch in batches():
+        try:
+            handled.extend(file_record for file_record, _, _ in batch)
+            upload_start = time.monotonic()
+            documents = upload_documents(bot.token, chat_id, [part for _, part, _ in batch], thread_id)
+            uplink_meter.record(sum(size for (_, _, size), document in zip(batch, documents) if document),
+                                time.monotonic() - upload_start)
+            for (file_record, part, size), document in zip(batch, documents):
+                if document:
+                    file_record.add_part(document)
+                    stats["parts"] += 1
+                    stats["bytes"] += size
+                else:
+                    stats["failed"] += 1
+                    failed.append(file_record)
+                os.remove(part)
+                print(f"Deleted {os.path.basename(part)} from disk.")
+            # Journaled per batch, so the parts of a backup cut short stay on record.
+            backups.add_parts([(file_record, document)
+                               for (file_record, _, _), document in zip(batch, documents) if document])
+            uploaded = [document["file_id"] for document in documents if document]
+            for mirror, mirror_thread in mirror_threads.items():
+                missed[mirror].extend(copy_to_mirror(bot.token, mirror, uploaded, mirror_thread))
+        except Exception as e:
+            stats["failed"] += len(batch)
+            failed.extend(file_record for file_record, _, _ in batch)
+            print(f"Failed to send {', '.join(os.path.basename(part) for _, part, _ in batch)}: {e}")
+        finally:
+            budget.release(sum(size for _, _, size in batch))
+    producer.join()
+    delay = MIRROR_BACKOFF
+    for _ in range(MIRROR_RETRIES):
+        if not any(missed.values()):
+            break
+        print(f"Copying {sum(map(len, missed.values()))} missed parts to mirrors again in {delay}s")
+        time.sleep(delay)
+        delay *= 2
+        for mirror, mirror_thread in mirror_threads.items():
+            if missed[mirror]:
+                missed[mirror] = copy_to_mirror(bot.token, mirror, missed[mirror], mirror_thread)
+    for mirror in mirror_threads:
+        stats["mirrors"][mirror] = not missed[mirror]
+    stats["seconds"] = time.time() - start_time
+    # Chunks count as uploaded only once their volume made it.
+    # Files with chunks in a volume that did not make it are failed too, so are files with
+    # chunks in a volume a failed chunk_file never finished (commit() takes the abandoned ones).
+    failed.extend(chunk_store.commit([r.name for r in handled if r.name in chunk_store.pending_volumes]))
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+def run_backup(bot: Bot, path: str, mode: str, chat_id: int, token: str = None, thread_id: int = None,
+               stats: dict = None, mirrors: Union[List[int], Dict[int, Optional[int]]] = None) -> str:
+    """
+    Creates a backup and uploads it while it is being created (see run_pipeline).
+    Blocking, call it with asyncio.to_thread from handlers.
+    Parts are uploaded to chat_id once and copied to the mirrors chats by file_id.
+
+    Returns the token of the new backup.
+    """
+    from consts import backups
+    stats = stats if stats is not None else {}
+    skipped = SkipStats()
+    # Pinned until the end, a load() in another job must not swap the tree being filled in.
+    backup_token = token or generate_token()
+    with backups.pinned(backup_token):
+        run_pipeline(
+            bot, chat_id,
+            lambda budget, staged: create_backup(path, mode, token=backup_token, budget=budget, staged=staged,
+                                                 skipped=skipped),
+            thread_id, stats, mirrors
+        )
+        stats.update(skipped.to_dict())
+
+        backup = next((b for b in backups.backups if b.token == backup_token), None)
+        backup.destinations = [chat_id] + [mirror for mirror, complete in stats["mirrors"].items() if complete]
+        for mirror, complete in stats["mirrors"].items():
+            if not complete:
+                print(f"Backup {backup_token} is incomplete in {mirror}")
+        backup.uploaded = True
+        backups.save()
+    print("Finished sending backup files.")
+    return backup_token
+
+def collect_tmp_garbage() -> int:
+    """
+    Deletes files in tmp/ that no pending (not uploaded) backup refers to,
+    e.g. parts left over after a crash. Returns the number of bytes reclaimed.
+
+    Every process stages into a dir of its own under tmp/ (TMP_DIR). The dirs of processes
+    that still run, the CLI, an agent connection or the watcher of another bot, are left alone.
+    """
+    from consts import backups
+    if not os.path.isdir(TMP_ROOT):
+        return 0
+    backups.load()
+    referenced = set()
+
+    def collect(item):
+        if getattr(item, "absolute_path", None):
+            referenced.add(os.path.normcase(os.path.abspath(item.absolute_path)))
+        for child in getattr(item, "children", None) or []:
+            collect(child)
+
+    for backup in backups.backups:
+        if not backup.uploaded:
+            collect(backup)
+
+    def remove_orphans(dir_path: str) -> int:
+        reclaimed = 0
+        for entry in os.scandir(dir_path):
+            if not entry.is_file() or entry.name == DIR_LOCK:
+                continue
+            # A plain copy may end in ".NNN" itself (report.2024, data.001), so the name
+            # is checked as it is too, not only with the volume suffix stripped.
+            full = os.path.normcase(os.path.abspath(entry.path))
+            base = os.path.normcase(os.path.abspath(PART_SUFFIX.sub("", entry.path)))
+            if full in referenced or base in referenced:
+                continue
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+                reclaimed += size
+                print(f"Removed orphaned {entry.name} from tmp.")
+            except OSError as e:
+                print(f"Failed to remove {entry.name}: {e}")
+        return reclaimed
+
+    # Files right in tmp/ are from before staging went per process.
+    reclaimed = remove_orphans(TMP_ROOT)
+    for entry in os.scandir(TMP_ROOT):
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        with claim_dir(entry.path) as claimed:
+            if not claimed:
+                continue
+            reclaimed += remove_orphans(entry.path)
+            if os.listdir(entry.path) == [DIR_LOCK]:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(entry.path, DIR_LOCK))
+                    os.rmdir(entry.path)
+    return reclaimed
+
+def fetch_file(url: str, destination: Path) -> None:
+    """
+    Streams a file from url to destination in chunks, through the bandwidth limiter.
+    """
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(destination, "wb") as f:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                bandwidth.consume(len(chunk))
+                f.write(chunk)
+
+def fetch_cached(file_id: str, url: Optional[str], destination: Path, link: bool = False,
+                 resolve: Callable[[], str] = None) -> None:
+    """
+    Puts the file with file_id at destination, from the download cache when it is there,
+    otherwise downloads it from url and keeps a copy in the cache.
+    link: destination is a temporary part deleted after use, it may share the cache entry's inode.
+    resolve: gives the URL when url is None (file_url found it cached) but it was evicted since.
+    """
+    if download_cache.get(file_id, str(destination), link):
+        print(f"Served {os.path.basename(destination)} from the download cache")
+        return
+    if url is None:
+        if resolve is None:
+            raise FileNotFoundError(f"{file_id} was evicted from the download cache")
+        print(f"{os.path.basename(destination)} left the download cache, downloading it")
+        url = resolve()
+    if not download_cache.limit:
+        fetch_file(url, destination)
+        return
+    os.makedirs(download_cache.directory, exist_ok=True)
+    partial = download_cache.path_for(file_id) + f".{uuid.uuid4().hex[:8]}.part"
+    try:
+        fetch_file(url, partial)
+        download_cache.put(file_id, partial)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    if not download_cache.get(file_id, str(destination), link):
+        # Evicted right away (bigger than the whole cache), fetch it again without caching.
+        fetch_file(url, destination)
+
+async def download(backup_token: str, bot: Bot, destination: Optional[str] = None, stats: dict = None,
+                   at: Optional[datetime.datetime] = None):
     """
     Downloads all files associated with the backup identified by backup_token
     from Telegram into the default system Downloads folder. The backup structure
@@ -282,7 +806,15 @@ async def download(backup_token: str, bot: Bot):
     Parameters:
       - backup_token: The unique token for the backup (from a BackupRootFolder).
       - bot: The aiogram Bot instance.
+      - destination: (Optional) Folder to restore into instead of the Downloads folder.
+      - stats: (Optional) Dict that receives the restore folder, bytes restored and seconds taken,
+        and the files that could not be restored: "failed" (how many) and "failed_files" (their paths).
+      - at: (Optional) Restore a rolling backup (watch.py) as it was at this time instead of as it is now.
     """
+    from consts import backups
+    start_time = time.time()
+    # fetch_cached runs in worker threads, URLs it has to resolve late are resolved here.
+    loop = asyncio.get_running_loop()
     # Reload backups storage
     backups.load()
     
@@ -293,10 +825,24 @@ async def download(backup_token: str, bot: Bot):
         return False
     if not backup.uploaded:
         return False
+    if at is not None:
+        # watch imports this module, so it is imported here.
+        from watch import index_path, snapshot_at
+        if not os.path.exists(index_path(backup_token)):
+            print(f"Backup {backup.name} is not a rolling backup, it has no earlier versions.")
+            return False
+        backup = snapshot_at(backup_token, at)
     # Determine the default system Downloads folder.
-    downloads_dir = Path.home() / "Downloads" / f"Backup_{backup.name}_{backup.creatin_date}"
+    downloads_dir = Path(destination or Path.home() / "Downloads") / f"Backup_{backup.name}_{backup.creatin_date}"
     downloads_dir.mkdir(parents=True, exist_ok=True)
     print(f"Downloading backup '{backup.name}' into: {downloads_dir}")
+    # Paths (relative to downloads_dir) of files that were not restored, or not completely
+    failed_files = []
+
+    def fail(path: Path) -> None:
+        rel_path = str(path.relative_to(downloads_dir))
+        if rel_path not in failed_files:
+            failed_files.append(rel_path)
 
     async def download_item(item, current_path: Path):
         # If the item is a folder, create a subfolder and process children.
@@ -305,33 +851,48 @@ async def download(backup_token: str, bot: Bot):
             subfolder.mkdir(parents=True, exist_ok=True)
             for child in item.children:
                 await download_item(child, subfolder)
+        elif getattr(item, "chunks", None) is not None:
+            # Delta-backed file: fetch the volumes holding its chunks and rebuild it.
+            try:
+                file_urls = {}
+                for volume in volumes_of(item.chunks):
+                    file_urls[volume] = await file_url(bot, chunk_store.file_id(volume))
+                destination = current_path / item.name
+                print(f"Rebuilding '{item.name}' from {len(item.chunks)} chunks in {len(file_urls)} volumes...")
+                await asyncio.to_thread(assemble, item.chunks, destination,
+                                        lambda volume, path: fetch_cached(
+                                            chunk_store.file_id(volume), file_urls[volume], path, True,
+                                            url_resolver(bot, chunk_store.file_id(volume), loop)),
+                                        downloads_dir / ".chunks")
+                print(f"Rebuilt '{item.name}' at {destination}")
+            except Exception as e:
+                print(f"Error rebuilding '{item.name}': {e}")
+                fail(current_path / item.name)
         else:
             # For FileUpload items:
             if not item.upload_id:
                 print(f"No upload IDs for file '{item.name}', skipping download.")
+                fail(current_path / item.name)
                 return
             part_counter = 1
             for file_id in item.upload_id:
                 try:
-                    file_info = await bot.get_file(file_id)
-                    file_url = f"https://api.telegram.org/file/bot{bot.token}/{file_info.file_path}"
+                    url = await file_url(bot, file_id)
                     # For split files, append a part number.
                     if len(item.upload_id) > 1:
                         filename = f"{item.name}.{part_counter:03d}"
                     else:
                         filename = item.name
                     destination = current_path / filename
-                    print(f"Downloading '{filename}' from {file_url}...")
-                    response = requests.get(file_url)
-                    if response.status_code == 200:
-                        with open(destination, "wb") as f:
-                            f.write(response.content)
-                        print(f"Downloaded '{filename}' to {destination}")
-                    else:
-                        print(f"Failed to download '{filename}': HTTP {response.status_code}")
+                    print(f"Downloading '{filename}' from {url or 'the download cache'}...")
+                    # Parts of a split archive are extracted and deleted, a single part is the file itself.
+                    await asyncio.to_thread(fetch_cached, file_id, url, destination, len(item.upload_id) > 1,
+                                            url_resolver(bot, file_id, loop))
+                    print(f"Downloaded '{filename}' to {destination}")
                     part_counter += 1
                 except Exception as e:
                     print(f"Error downloading part of '{item.name}': {e}")
+                    fail(current_path / item.name)
 
     await download_item(backup, downloads_dir)
     print("Backup download complete.")
@@ -365,6 +926,13 @@ async def download(backup_token: str, bot: Bot):
                     print(f"Failed to delete {f}: {e}")
         else:
             print(f"Extraction failed for {part}: {stderr.decode().strip()}")
+            fail(Path(base_archive))
 
     print("Backup extraction complete.")
+    if stats is not None:
+        stats.update(path=str(downloads_dir), seconds=time.time() - start_time,
+                     bytes=sum(f.stat().st_size for f in downloads_dir.rglob("*") if f.is_file()),
+                     failed=len(failed_files), failed_files=failed_files)
+    if failed_files:
+        print(f"{len(failed_files)} files of backup '{backup.name}' were not restored: {', '.join(failed_files)}")
     return True
\ No newline at end of file
@@ -1,17 +1,37 @@
 import os
-import datetime
+import asyncio
 
 from aiogram import Router, F
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery
 
-from consts import M, chats, logger, backups
-from utils import get_size, buttons
-from backup import send_backup_files, create_backup, download
+from consts import M, chats, backups
+from utils import get_size
+from filters import matcher_for
+from backup import download
+from jobs import backup_to_workchat, audit_tokens
 
 MESSAGES = M["backup"]
 router = Router()
 router.message.filter(F.chat.type == "private")
 
+# Registered before start_backup, which would take "/audit" for a path.
+@router.message(Command("audit"))
+async def audit_backups(message: Message, command: CommandObject):
+    await asyncio.to_thread(backups.load)
+    tokens = command.args.split() if command.args else [b.token for b in backups.backups if b.uploaded]
+    await message.answer(text=MESSAGES["audit"])
+    for report in await audit_tokens(message.bot, tokens):
+        if "error" in report:
+            await message.answer(text=f'{report["token"]}: {report["error"]}')
+        elif report["missing"] or report["mismatch"]:
+            lines = "\n".join(report["missing"] + report["mismatch"])
+            await message.answer(text=MESSAGES["audit_bad"].format(
+                name=report["name"], parts=report["parts"],
+                missing=len(report["missing"]), mismatch=len(report["mismatch"])) + f"\n\n{lines}"[:3500])
+        else:
+            await message.answer(text=MESSAGES["audit_ok"].format(name=report["name"], parts=report["parts"]))
+
 @router.message(F.text.regexp(r"^(?:[A-Za-z]:\\|/).+"))
 async def start_backup(message: Message):
     if not os.path.exists(message.text):
@@ -19,44 +39,11 @@ async def start_backup(message: Message):
         return
     path = message.text
     await message.reply(text=MESSAGES["preparation"])
-    size, est_time = get_size(path)
-    backup_token = create_backup(path, chats.mode)
+    size, est_time = get_size(path, matcher_for(path))
     msg = f'{MESSAGES["msg"]} \n\n {size} \n\n will aproximately take: {est_time}' 
     await message.reply(text=msg)
-    for chat in chats.chats:
-        if chat.chat_id == chats.workchat:
-            work = chat
-    logger.info("New backup starting")
-    if work.chat_type == 'supergroup':
-        today = datetime.date.today()
-        thread_name = f"backup - {today.strftime('%d.%m.%Y')}"
-        
-        # Create the forum topic; ensure your bot is an admin with can_manage_topics permission.
-        forum_topic = await message.bot.create_forum_topic(chat_id=work.chat_id, name=thread_name)
-        thread_id = forum_topic.message_thread_id
-        
-        await message.bot.send_message(chat_id=work.chat_id,
-                                       text="Кира, тут твоя структура папок",
-                                       message_thread_id=thread_id,
-                                       reply_markup=buttons({
-                                           f"download_{backup_token}": MESSAGES["download"]
-                                       }))
-        
-        send_backup_files(message.bot, work.chat_id, thread_id=thread_id, backup_token=backup_token)
-        await message.reply(text=MESSAGES["done"])
-        logger.info("Backup done")
-        
-    else:
-        today = datetime.date.today()
-        thread_name = f"backup - {today.strftime('%d.%m.%Y')}"
-        await message.bot.send_message(chat_id=work.chat_id,
-                                text="Кира тут твоя структура папок",
-                                reply_markup=buttons({
-                                           f"download_{backup_token}": MESSAGES["download"]
-                                       }))
-        send_backup_files(message.bot, work.chat_id, backup_token=backup_token)
-        await message.reply(text=MESSAGES["done"])
-        logger.info("Backup done")
+    await backup_to_workchat(message.bot, path, chats.mode)
+    await message.reply(text=MESSAGES["done"])
 
 @router.callback_query(F.data.startswith('download_'))
 async def download_backup(callback: CallbackQuery):
@@ -0,0 +1,94 @@
+"""
+Benchmark for building the backup tree of huge folders.
+
+Creates synthetic folders of empty files (by default up to 1M files in 100k sibling
+folders) and times utils.build_tree against the os.walk + folder_dict construction
+create_backup used before, which scans the parent's children for every subfolder.
+Nothing is copied or compressed, only the tree is built.
+
+    python bench_tree.py
+    python bench_tree.py --files 200000 --dirs 20000 --legacy-max-dirs 20000
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from storage import FileUpload, FolderUpload, BackupRootFolder
+from utils import build_tree
+
+def make_tree(root: str, files: int, dirs: int) -> None:
+    """
+    Creates `dirs` sibling folders under root and spreads `files` empty files over them.
+    """
+    for d in range(dirs):
+        os.makedirs(os.path.join(root, f"d{d}"))
+    for i in range(files):
+        open(os.path.join(root, f"d{i % dirs}", f"f{i}"), "wb").close()
+
+def file_record(file_path: str, name: str, size: int) -> FileUpload:
+    return FileUpload(name=name, upload_id=[], absolute_path=file_path, is_split=False)
+
+def legacy_build(path: str) -> FolderUpload:
+    folder_dict = {}
+    abs_path = os.path.abspath(path)
+    folder_dict[abs_path] = BackupRootFolder(name=os.path.basename(abs_path), children=[])
+    for root, dirs, files in os.walk(path):
+        root_abs = os.path.abspath(root)
+        if root_abs not in folder_dict:
+            folder_dict[root_abs] = FolderUpload(name=os.path.basename(root_abs), children=[])
+        for file in files:
+            file_path = os.path.join(root, file)
+            folder_dict[root_abs].children.append(file_record(file_path, file, os.path.getsize(file_path)))
+        for d in dirs:
+            subdir_abs = os.path.abspath(os.path.join(root, d))
+            if subdir_abs not in folder_dict:
+                folder_dict[subdir_abs] = FolderUpload(name=d, children=[])
+            if not any(isinstance(child, FolderUpload) and child.name == d for child in folder_dict[root_abs].children):
+                folder_dict[root_abs].children.append(folder_dict[subdir_abs])
+    return folder_dict[abs_path]
+
+def count_nodes(node) -> int:
+    total = 1
+    stack = list(getattr(node, "children", None) or [])
+    while stack:
+        item = stack.pop()
+        total += 1
+        stack.extend(getattr(item, "children", None) or [])
+    return total
+
+def timed(func, *args) -> tuple:
+    start_time = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start_time, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=1_000_000, help="Files in the largest tree")
+    parser.add_argument("--dirs", type=int, default=100_000, help="Sibling folders in the largest tree")
+    parser.add_argument("--steps", type=int, default=3, help="Number of sizes, each 10x the previous")
+    parser.add_argument("--legacy-max-dirs", type=int, default=10_000,
+                        help="Skip the old construction above this many sibling folders (it is quadratic)")
+    args = parser.parse_args()
+
+    print(f"{'files':>10} {'dirs':>8} {'nodes':>10} {'build_tree':>12} {'legacy':>12}")
+    for step in reversed(range(args.steps)):
+        files = max(1, args.files // 10 ** step)
+        dirs = max(1, args.dirs // 10 ** step)
+        tmp_dir = tempfile.mkdtemp(prefix="bench_tree_")
+        try:
+            make_tree(tmp_dir, files, dirs)
+            new_time, tree = timed(build_tree, tmp_dir, BackupRootFolder(name="bench", children=[]), file_record)
+            nodes = count_nodes(tree)
+            del tree
+            legacy = "skipped"
+            if dirs <= args.legacy_max_dirs:
+                legacy_time, _ = timed(legacy_build, tmp_dir)
+                legacy = f"{legacy_time:.2f}s"
+            print(f"{files:>10} {dirs:>8} {nodes:>10} {new_time:>11.2f}s {legacy:>12}")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Memory benchmark for uploading parts of growing size.
+
+Sends sparse files of each size to a local HTTP server that throws the body away and
+reports the peak RSS of the uploading process, once for the streamed MultipartBody
+post_multipart uses and once for requests' files= upload, which builds the whole
+body in memory first. Every upload runs in a fresh process so the peaks don't mix.
+Uses the resource module, so Unix only.
+
+    python bench_upload.py
+    python bench_upload.py --sizes 64 512 2048 --no-legacy
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+class DrainHandler(BaseHTTPRequestHandler):
+    """
+    Reads the request body in small blocks and answers like a successful sendDocument.
+    """
+
+    def do_POST(self):
+        left = int(self.headers["Content-Length"])
+        while left > 0:
+            left -= len(self.rfile.read(min(left, 1024 * 1024)))
+        response = json.dumps({"ok": True, "result": {"document": {"file_id": "bench"}}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+def upload(method: str, path: str, url: str) -> None:
+    """
+    Child process: uploads path once and prints its RSS before and after as JSON.
+    """
+    from backup import MultipartBody
+    fields = {"chat_id": 1}
+    baseline = peak_rss_mb()
+    start_time = time.perf_counter()
+    if method == "streamed":
+        body = MultipartBody(fields, {"document": path})
+        try:
+            response = requests.post(url, data=body, headers={"Content-Type": body.content_type})
+        finally:
+            body.close()
+    else:
+        with open(path, "rb") as f:
+            response = requests.post(url, data=fields, files={"document": f})
+    response.raise_for_status()
+    print(json.dumps({"baseline": baseline, "peak": peak_rss_mb(), "seconds": time.perf_counter() - start_time}))
+
+def measure(method: str, path: str, url: str) -> dict:
+    output = subprocess.run([sys.executable, __file__, "--child", method, path, url],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 128, 1024], help="Part sizes in MB")
+    parser.add_argument("--no-legacy", action="store_true", help="Only measure the streamed upload")
+    parser.add_argument("--child", nargs=3, metavar=("METHOD", "PATH", "URL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        upload(*args.child)
+        return
+
+    server = HTTPServer(("127.0.0.1", 0), DrainHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/sendDocument"
+    methods = ["streamed"] if args.no_legacy else ["streamed", "legacy"]
+
+    print(f"{'part MB':>8} {'method':>9} {'baseline MB':>12} {'peak MB':>9} {'growth MB':>10} {'seconds':>8}")
+    tmp_dir = tempfile.mkdtemp(prefix="bench_upload_")
+    try:
+        for size in args.sizes:
+            path = os.path.join(tmp_dir, f"part_{size}")
+            # Sparse: no disk space or write time needed, reads return zeros.
+            with open(path, "wb") as f:
+                f.truncate(size * 1024 * 1024)
+            for method in methods:
+                result = measure(method, path, url)
+                print(f"{size:>8} {method:>9} {result['baseline']:>12.1f} {result['peak']:>9.1f} "
+                      f"{result['peak'] - result['baseline']:>10.1f} {result['seconds']:>8.2f}")
+            os.remove(path)
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
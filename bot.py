@@ -4,10 +4,19 @@ from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 
 from consts import BOT_TOKEN, logger, chats
-from utils import ChatTrackingMiddleware
-import error_router, start_router, settings, backup_router
+from utils import ChatTrackingMiddleware, human_readable_size
+from backup import collect_tmp_garbage
+from watch import start_watch
+from worker import start_worker_server
+from scheduler import run_scheduler, load_schedule
+import error_router, start_router, settings, backup_router, catalog_router
 
 async def main():
+    reclaimed = collect_tmp_garbage()
+    if reclaimed:
+        logger.info(f"Reclaimed {human_readable_size(reclaimed)} of orphaned parts in tmp")
+    # Fails here, before polling starts, on a broken SCHEDULE.
+    schedule = load_schedule()
     bot = Bot(token=BOT_TOKEN)
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
@@ -16,14 +25,20 @@ async def main():
     dp.include_router(start_router.router)
 
     dp.include_router(settings.router)
+    # Before backup_router, which takes every message starting with "/" for a path.
+    dp.include_router(catalog_router.router)
     dp.include_router(backup_router.router)
 
     dp.include_router(error_router.router)
     
+    start_watch(bot)
+    start_worker_server(bot, asyncio.get_running_loop())
+    scheduler = asyncio.create_task(run_scheduler(bot, schedule))
 
     try:
         await dp.start_polling(bot)
     finally:
+        scheduler.cancel()
         await bot.session.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import threading
+from typing import List, Tuple
+
+from config import CATALOG_FILE
+from storage import BackupStorage, BackupRootFolder, FolderUpload, load_tree
+
+PAGE_SIZE = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    token TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    creatin_date TEXT,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    stamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    token TEXT NOT NULL,
+    path TEXT NOT NULL,
+    lower_name TEXT NOT NULL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE INDEX IF NOT EXISTS files_token ON files (token);
+"""
+
+# Trigram index over file names for substring search, kept in step with files by triggers
+NAME_INDEX = """
+CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+    lower_name, content='files', content_rowid='rowid', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+    INSERT INTO files_fts (rowid, lower_name) VALUES (new.rowid, new.lower_name);
+END;
+CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+    INSERT INTO files_fts (files_fts, rowid, lower_name) VALUES ('delete', old.rowid, old.lower_name);
+END;
+"""
+
+class Catalog:
+    """
+    SQLite index of every file of every uploaded backup: its path inside the backup
+    ("<backup name>/folder/file") and size, plus file count and total size per backup.
+
+    Answering "which backup holds file X" from backups.json would mean loading every tree,
+    here it is one query. sync() keeps the index up to date incrementally: only backups whose
+    tree file changed since they were indexed are walked again, deleted backups are dropped.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(file_path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.name_index = self._create_name_index()
+
+    def _create_name_index(self) -> bool:
+        """
+        Sets up the trigram index over file names, filled from files when it is new.
+        Returns False if SQLite has no trigram tokenizer (before 3.34), names are scanned then.
+        """
+        exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'files_fts'").fetchone()
+        try:
+            self.db.executescript(NAME_INDEX)
+        except sqlite3.OperationalError as e:
+            print(f"No trigram index for file names, searching them by scanning: {e}")
+            return False
+        if not exists:
+            self.db.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+            self.db.commit()
+        return True
+
+    def stamp_of(self, backup: BackupRootFolder, storage: BackupStorage) -> float:
+        """
+        Last change of a backup tree: the mtime of its tree file, or of the headers file
+        for old backups that still keep their tree inline.
+        """
+        for path in (storage.get_tree_path(backup.token), storage.file_path):
+            if os.path.exists(path):
+                return os.path.getmtime(path)
+        return 0.0
+
+    def sync(self, storage: BackupStorage) -> int:
+        """
+        Brings the index in line with storage. Returns the number of backups (re)indexed.
+        """
+        with self._lock:
+            indexed = dict(self.db.execute("SELECT token, stamp FROM backups"))
+            current = {backup.token: backup for backup in storage.backups if backup.uploaded}
+            for token in indexed.keys() - current.keys():
+                self._remove(token)
+            changed = 0
+            for token, backup in current.items():
+                stamp = self.stamp_of(backup, storage)
+                if indexed.get(token) == stamp:
+                    continue
+                try:
+                    self._index(backup, stamp)
+                except (OSError, ValueError) as e:
+                    print(f"Can't index backup {backup.name} ({token}): {e}")
+                    continue
+                changed += 1
+            self.db.commit()
+            return changed
+
+    def _remove(self, token: str) -> None:
+        self.db.execute("DELETE FROM files WHERE token = ?", (token,))
+        self.db.execute("DELETE FROM backups WHERE token = ?", (token,))
+
+    def _index(self, backup: BackupRootFolder, stamp: float) -> None:
+        # Read the tree file directly, so indexing does not keep every tree loaded in backups.
+        children = backup.children if backup.is_loaded or not backup.tree_path else load_tree(backup.tree_path)
+        self._remove(backup.token)
+        files = 0
+        total = 0
+        rows = []
+        stack = [(backup.name, children)]
+        while stack:
+            prefix, nodes = stack.pop()
+            for node in nodes:
+                path = f"{prefix}/{node.name}"
+                if isinstance(node, FolderUpload):
+                    stack.append((path, node.children))
+                    continue
+                files += 1
+                total += node.size or 0
+                rows.append((backup.token, path, node.name.lower(), node.size))
+                if len(rows) >= 10000:
+                    self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?)", rows)
+                    rows = []
+        self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?)", rows)
+        self.db.execute("INSERT INTO backups VALUES (?, ?, ?, ?, ?, ?)",
+                        (backup.token, backup.name, backup.creatin_date, files, total, stamp))
+
+    def backups_page(self, page: int) -> Tuple[List[tuple], int]:
+        """
+        One page of (token, name, creatin_date, files, bytes), last changed first, and the number of backups.
+        """
+        with self._lock:
+            count = self.db.execute("SELECT COUNT(*) FROM backups").fetchone()[0]
+            rows = self.db.execute(
+                "SELECT token, name, creatin_date, files, bytes FROM backups ORDER BY rowid DESC LIMIT ? OFFSET ?",
+                (PAGE_SIZE, page * PAGE_SIZE)).fetchall()
+        return rows, count
+
+    def search(self, query: str, page: int) -> Tuple[List[tuple], int]:
+        """
+        One page of (token, backup name, creatin_date, path, size) matching query, and the number of matches.
+        A query with a "/" is a path prefix ("photos/2024/"), anything else is looked up
+        in file names, ignoring case.
+        """
+        if "/" in query:
+            # Every path that starts with query sorts between query and query + the last code point.
+            where, args = "f.path >= ? AND f.path < ?", (query, query + "\U0010ffff")
+        elif self.name_index and len(query) >= 3:
+            # A quoted phrase of trigrams matches the names that hold query anywhere.
+            phrase = '"' + query.lower().replace('"', '""') + '"'
+            where, args = "f.rowid IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)", (phrase,)
+        else:
+            # Shorter than one trigram: the index can't answer it.
+            where, args = "instr(f.lower_name, ?) > 0", (query.lower(),)
+        with self._lock:
+            count = self.db.execute(f"SELECT COUNT(*) FROM files f WHERE {where}", args).fetchone()[0]
+            rows = self.db.execute(
+                f"SELECT f.token, b.name, b.creatin_date, f.path, f.size FROM files f "
+                f"JOIN backups b ON b.token = f.token WHERE {where} "
+                f"ORDER BY b.rowid DESC, f.path LIMIT ? OFFSET ?",
+                args + (PAGE_SIZE, page * PAGE_SIZE)).fetchall()
+        return rows, count
+
+catalog = Catalog(CATALOG_FILE)
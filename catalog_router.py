@@ -0,0 +1,89 @@
+import asyncio
+
+from aiogram import Router, F
+from aiogram.filters import Command, CommandObject
+from aiogram.fsm.context import FSMContext
+from aiogram.types import Message, CallbackQuery
+
+from consts import M, backups
+from utils import buttons, human_readable_size
+from catalog import catalog, PAGE_SIZE
+
+MESSAGES = M["catalog"]
+router = Router()
+router.message.filter(F.chat.type == "private")
+
+def page_count(count: int) -> int:
+    return max(1, (count + PAGE_SIZE - 1) // PAGE_SIZE)
+
+def navigation(prefix: str, page: int, count: int) -> dict:
+    """
+    Previous/next buttons of a paged list, their callback data is prefix + page number.
+    """
+    nav = {}
+    if page > 0:
+        nav[f"{prefix}{page - 1}"] = MESSAGES["prev"]
+    if page + 1 < page_count(count):
+        nav[f"{prefix}{page + 1}"] = MESSAGES["next"]
+    return nav
+
+async def synced_catalog() -> None:
+    """
+    Picks up backups added or deleted since the last look, only changed trees are read.
+    """
+    await asyncio.to_thread(backups.load)
+    await asyncio.to_thread(catalog.sync, backups)
+
+def backups_view(page: int):
+    rows, count = catalog.backups_page(page)
+    if not count:
+        return MESSAGES["empty"], None
+    text = MESSAGES["msg"].format(page=page + 1, pages=page_count(count))
+    lines = [f"{name} ({date}): {files} files, {human_readable_size(size)}" for _, name, date, files, size in rows]
+    keyboard = {f"download_{token}": f"{name} ({date})" for token, name, date, _, _ in rows}
+    keyboard.update(navigation("saved_", page, count))
+    return f"{text}\n\n" + "\n".join(lines) + f"\n\n{MESSAGES['search_hint']}", buttons(keyboard)
+
+def search_view(query: str, page: int):
+    rows, count = catalog.search(query, page)
+    if not count:
+        return MESSAGES["not_found"], None
+    text = MESSAGES["found"].format(count=count, page=page + 1, pages=page_count(count))
+    lines = [f"{path} - {human_readable_size(size) if size is not None else '?'} ({date})"
+             for _, _, date, path, size in rows]
+    keyboard = {f"download_{token}": f"{name} ({date})" for token, name, date, _, _ in rows}
+    keyboard.update(navigation("found_", page, count))
+    return f"{text}\n\n" + "\n".join(lines), buttons(keyboard)
+
+@router.callback_query(F.data == 'what_saved')
+async def what_saved(callback: CallbackQuery):
+    await callback.answer()
+    await synced_catalog()
+    text, keyboard = backups_view(0)
+    await callback.bot.send_message(chat_id=callback.from_user.id, text=text, reply_markup=keyboard)
+
+@router.callback_query(F.data.startswith('saved_'))
+async def what_saved_page(callback: CallbackQuery):
+    await callback.answer()
+    text, keyboard = backups_view(int(callback.data.split("_")[-1]))
+    await callback.message.edit_text(text=text, reply_markup=keyboard)
+
+@router.message(Command("find"))
+async def find(message: Message, command: CommandObject, state: FSMContext):
+    if not command.args:
+        await message.answer(text=MESSAGES["search_hint"])
+        return
+    query = command.args.strip()
+    await state.update_data(catalog_query=query)
+    await synced_catalog()
+    text, keyboard = search_view(query, 0)
+    await message.answer(text=text, reply_markup=keyboard)
+
+@router.callback_query(F.data.startswith('found_'))
+async def find_page(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    query = (await state.get_data()).get("catalog_query")
+    if not query:
+        return
+    text, keyboard = search_view(query, int(callback.data.split("_")[-1]))
+    await callback.message.edit_text(text=text, reply_markup=keyboard)
@@ -0,0 +1,312 @@
+import os
+import json
+import zlib
+import queue
+import hashlib
+import threading
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+from config import THRESHOLD, CHUNKS_FILE
+from storage import FileUpload, write_atomic, file_lock
+from staging import TmpBudget
+
+# Content-defined chunking. A boundary is placed after an ANCHOR byte whose preceding
+# WINDOW bytes hash (crc32) to zero under MASK, so boundaries depend only on nearby content
+# and survive insertions and deletions elsewhere in the file. Anchors are found with
+# bytes.find, which keeps the scan in C: ~1/256 positions are hashed instead of every byte.
+CHUNK_MIN = 1024 * 1024
+CHUNK_MAX = 8 * 1024 * 1024
+WINDOW = 48
+ANCHOR = 0x9E
+MASK = (1 << 13) - 1  # with the anchor byte: one boundary per ~2 MB after CHUNK_MIN
+
+def find_cut(data: bytes) -> int:
+    """
+    Returns the length of the next chunk at the start of data.
+    Unless data is the end of the file it must hold at least CHUNK_MAX bytes.
+    """
+    end = min(len(data), CHUNK_MAX)
+    if end <= CHUNK_MIN:
+        return end
+    i = CHUNK_MIN
+    while True:
+        i = data.find(ANCHOR, i, end)
+        if i < 0:
+            return end
+        if not zlib.crc32(data[i - WINDOW:i]) & MASK:
+            return i + 1
+        i += 1
+
+def iter_chunks(path: str):
+    """
+    Yields the content-defined chunks of a file, reading it in CHUNK_MAX sized blocks.
+    """
+    with open(path, "rb") as f:
+        buffer = b""
+        final = False
+        while True:
+            if not final and len(buffer) < CHUNK_MAX:
+                block = f.read(CHUNK_MAX)
+                final = len(block) < CHUNK_MAX
+                buffer += block
+            if not buffer:
+                return
+            cut = find_cut(buffer)
+            yield buffer[:cut]
+            buffer = buffer[cut:]
+
+class ChunkStore:
+    """
+    Index of uploaded chunks: sha256 -> [volume, offset, size, compressed], volume -> file_id
+    and volume -> [file_unique_id, file_size] as Telegram reported it on upload.
+    Chunks written during a backup stay pending until their volume is uploaded,
+    commit() then keeps the ones that made it and forgets the rest.
+
+    The bot, the CLI and the watcher share the index file: commit() merges what the others
+    added under a file lock before it writes, and lookups read the file again on a miss.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.chunks: Dict[str, list] = {}
+        self.volumes: Dict[str, str] = {}
+        self.fingerprints: Dict[str, list] = {}
+        self.pending: Dict[str, list] = {}
+        self.pending_volumes: Dict[str, FileUpload] = {}
+        # Pending volume -> records of files with chunks in it, they break if it is not uploaded
+        self.users: Dict[str, Dict[int, FileUpload]] = {}
+        # Pending volumes chunk_file gave up on, the next commit() fails them
+        self.abandoned = set()
+        # (mtime, size, inode) of the index file when it was last read or written
+        self._stamp = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self) -> None:
+        """
+        Merges the index file into memory if it changed since it was last read.
+        """
+        with self._lock:
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stamp == self._stamp:
+            return
+        with open(self.file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        # Entries never change once indexed, merging keeps the ones only this process has.
+        self.chunks = {**data["chunks"], **self.chunks}
+        self.volumes = {**data["volumes"], **self.volumes}
+        self.fingerprints = {**data.get("fingerprints", {}), **self.fingerprints}
+        self._stamp = stamp
+
+    def save(self) -> None:
+        with self._lock, file_lock(self.file_path + ".lock"):
+            self._save()
+
+    def _save(self) -> None:
+        # Called with the file lock held: what other processes added since the last read is merged first.
+        self._load()
+        write_atomic(self.file_path, json.dumps({"chunks": self.chunks, "volumes": self.volumes,
+                                                 "fingerprints": self.fingerprints}, separators=(',', ':')))
+        stat = os.stat(self.file_path)
+        self._stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def known(self, digest: str) -> bool:
+        return digest in self.chunks or digest in self.pending
+
+    def use(self, digest: str, record: FileUpload) -> bool:
+        """
+        True if the chunk is uploaded or pending. A pending one ties record to its volume,
+        so commit() can tell record it lost the chunk when the volume fails.
+        """
+        with self._lock:
+            if digest in self.chunks:
+                return True
+            entry = self.pending.get(digest)
+            if entry is None:
+                return False
+            self.users.setdefault(entry[0], {})[id(record)] = record
+            return True
+
+    def add_pending(self, digest: str, entry: list, record: FileUpload) -> None:
+        with self._lock:
+            self.pending[digest] = entry
+            self.users.setdefault(entry[0], {})[id(record)] = record
+
+    def lookup(self, digest: str) -> list:
+        entry = self.chunks.get(digest) or self.pending.get(digest)
+        if entry is None:
+            # Indexed by another process after this one read the file.
+            self.load()
+            entry = self.chunks[digest]
+        return entry
+
+    def file_id(self, volume: str) -> Optional[str]:
+        if volume not in self.volumes and volume not in self.pending_volumes:
+            self.load()
+        if volume in self.volumes:
+            return self.volumes[volume]
+        record = self.pending_volumes.get(volume)
+        return record.upload_id[0] if record and record.upload_id else None
+
+    def abandon(self, volume: str) -> None:
+        """
+        Drops the chunks of a volume that will never be uploaded, so no other file reuses them.
+        The volume stays pending until the next commit(), which breaks the files that used them.
+        """
+        with self._lock:
+            for digest, entry in list(self.pending.items()):
+                if entry[0] == volume:
+                    del self.pending[digest]
+            self.abandoned.add(volume)
+
+    def commit(self, volumes: List[str]) -> None:
+        """
+        Moves the chunks of the given volumes into the index if the volume was uploaded,
+        forgets them otherwise, and saves the index. Abandoned volumes are committed too, as failed.
+        Volumes of other running backups stay pending.
+
+        Returns the file records that had chunks in a volume that was not uploaded. Their chunk
+        list is dropped, they have no data to restore from and the backup lists them as failed.
+        """
+        broken = {}
+        with self._lock, file_lock(self.file_path + ".lock"):
+            volumes = list(volumes) + [volume for volume in self.abandoned if volume not in volumes]
+            self.abandoned.clear()
+            if not volumes:
+                return []
+            for volume in volumes:
+                record = self.pending_volumes.pop(volume, None)
+                users = self.users.pop(volume, {})
+                if record and record.upload_id:
+                    self.volumes[volume] = record.upload_id[0]
+                    if record.fingerprints:
+                        self.fingerprints[volume] = record.fingerprints[0]
+                else:
+                    broken.update(users)
+            finished = set(volumes)
+            for digest, entry in list(self.pending.items()):
+                if entry[0] in finished:
+                    del self.pending[digest]
+                    if entry[0] in self.volumes:
+                        self.chunks[digest] = entry
+            self._save()
+        for record in broken.values():
+            if record.chunks is not None:
+                print(f"Lost chunks of {record.name} with a volume that failed to upload")
+                record.chunks = None
+        return list(broken.values())
+
+chunk_store = ChunkStore(CHUNKS_FILE)
+
+def chunk_file(src: str, name: str, output_file: str,
+               budget: TmpBudget = None, staged: queue.Queue = None, store: ChunkStore = None) -> FileUpload:
+    """
+    Splits a large file into content-defined chunks and packs only the chunks that are
+    not uploaded yet into volumes output_file.001, .002, ... of at most THRESHOLD bytes.
+    Every volume is handed to the uploader once it is full.
+
+    The returned record lists the chunk hashes in file order, download() rebuilds the file from them.
+    """
+    budget = budget or TmpBudget()
+    store = store or chunk_store
+    # Chunks another process uploaded since the index was read are not uploaded again.
+    store.load()
+    digests = []
+    # Created first, every pending chunk it uses registers it with the chunk's volume.
+    record = FileUpload(name=name, upload_id=[], absolute_path=None, is_split=False, chunks=digests)
+    volume = None
+    volume_path = None
+    volume_size = 0
+    # Budget held for the open volume, more than volume_size while a chunk is being written
+    volume_reserved = 0
+    volume_count = 0
+    new_bytes = 0
+
+    def close_volume():
+        if volume is None:
+            return
+        volume.close()
+        if staged is not None:
+            staged.put((store.pending_volumes[os.path.basename(volume_path)], volume_path, volume_size))
+        else:
+            budget.release(volume_size)
+
+    try:
+        for chunk in iter_chunks(src):
+            digest = hashlib.sha256(chunk).hexdigest()
+            digests.append(digest)
+            if store.use(digest, record):
+                continue
+            packed = zlib.compress(chunk, 6)
+            compressed = len(packed) < len(chunk)
+            data = packed if compressed else chunk
+            if volume is None or volume_size + len(data) > THRESHOLD:
+                close_volume()
+                volume_count += 1
+                volume_path = f"{output_file}.{volume_count:03d}"
+                volume_name = os.path.basename(volume_path)
+                volume = open(volume_path, "wb")
+                store.pending_volumes[volume_name] = FileUpload(name=volume_name, upload_id=[],
+                                                                absolute_path=volume_path, is_split=False)
+                volume_size = 0
+                volume_reserved = 0
+            budget.reserve(len(data))
+            volume_reserved += len(data)
+            volume.write(data)
+            store.add_pending(digest, [os.path.basename(volume_path), volume_size, len(data), compressed], record)
+            volume_size += len(data)
+            new_bytes += len(chunk)
+        close_volume()
+    except BaseException:
+        # The volume being written never reaches the uploader (ENOSPC, a read error, ...):
+        # its chunks must not be reused, and files that already did are failed by commit().
+        if volume is not None and not volume.closed:
+            volume.close()
+            if os.path.exists(volume_path):
+                os.remove(volume_path)
+            budget.release(volume_reserved)
+            store.abandon(os.path.basename(volume_path))
+        raise
+    print(f"Chunked {name} into {len(digests)} chunks, {new_bytes / (1024 * 1024):.1f} MB new in {volume_count} volumes")
+    return record
+
+def volumes_of(digests: List[str], store: ChunkStore = None) -> List[str]:
+    """
+    Volumes that hold the given chunks, in the order they are first needed.
+    """
+    store = store or chunk_store
+    return list(dict.fromkeys(store.lookup(digest)[0] for digest in digests))
+
+def assemble(digests: List[str], destination: str, fetch_volume: Callable[[str, str], None],
+             work_dir: str, store: ChunkStore = None) -> None:
+    """
+    Rebuilds a file from its chunk list. fetch_volume(volume, path) downloads a volume,
+    each volume is fetched once and deleted as soon as no later chunk of this file needs it.
+    """
+    store = store or chunk_store
+    entries = [store.lookup(digest) for digest in digests]
+    remaining = Counter(entry[0] for entry in entries)
+    os.makedirs(work_dir, exist_ok=True)
+    with open(destination, "wb") as out:
+        for digest, (volume, offset, size, compressed) in zip(digests, entries):
+            volume_path = os.path.join(work_dir, volume)
+            if not os.path.exists(volume_path):
+                fetch_volume(volume, volume_path)
+            with open(volume_path, "rb") as f:
+                f.seek(offset)
+                data = f.read(size)
+            chunk = zlib.decompress(data) if compressed else data
+            if hashlib.sha256(chunk).hexdigest() != digest:
+                raise ValueError(f"Chunk {digest} from {volume} is corrupted")
+            out.write(chunk)
+            remaining[volume] -= 1
+            if not remaining[volume]:
+                os.remove(volume_path)
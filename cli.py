@@ -0,0 +1,99 @@
+"""
+Headless runner for backups and restores, without bot polling.
+
+    python cli.py backup /data/a /data/b --parallel 2 --mode individual
+    python cli.py download <token> <token> --dest /restore --parallel 4
+    python cli.py download <token> --at 2026-10-01T12:00   (a rolling backup as it was then)
+    python cli.py audit            (every uploaded backup, or pass tokens)
+
+Every job prints one JSON line with its throughput to stdout, followed by a summary line.
+Everything else the jobs print goes to stderr.
+"""
+import sys
+import json
+import time
+import asyncio
+import datetime
+import argparse
+import contextlib
+
+from aiogram import Bot
+
+from consts import BOT_TOKEN, chats, backups, logger
+from utils import log_to_stderr
+from jobs import backup_paths, download_tokens, audit_tokens
+
+def local_time(value: str) -> datetime.datetime:
+    # The rolling index is dated in local time without a zone.
+    at = datetime.datetime.fromisoformat(value)
+    return at.astimezone().replace(tzinfo=None) if at.tzinfo else at
+
+def with_speed(result: dict) -> dict:
+    if result.get("seconds"):
+        result["mb_per_s"] = round(result.get("bytes", 0) / (1024 * 1024) / result["seconds"], 3)
+    return result
+
+async def run(args) -> list:
+    bot = Bot(token=BOT_TOKEN)
+    try:
+        if args.command == "backup":
+            return await backup_paths(bot, args.paths, args.mode or chats.mode, args.parallel)
+        if args.command == "audit":
+            tokens = args.tokens or [backup.token for backup in backups.backups if backup.uploaded]
+            return await audit_tokens(bot, tokens, args.parallel)
+        return await download_tokens(bot, args.tokens, args.dest, args.parallel, args.at)
+    finally:
+        await bot.session.close()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Run backups and restores without the bot.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backup_parser = commands.add_parser("backup", help="Back up paths into the work chat")
+    backup_parser.add_argument("paths", nargs="+")
+    backup_parser.add_argument("--mode", choices=["archive", "individual"], help="Defaults to the mode set in the bot")
+    backup_parser.add_argument("--chat", type=int, help="Chat id to upload to instead of the work chat")
+    backup_parser.add_argument("--mirror", type=int, action="append",
+                               help="Chat id to copy the backup to, repeatable, replaces the mirrors set in the bot")
+    backup_parser.add_argument("--parallel", type=int, default=1, help="Backups running at once")
+    download_parser = commands.add_parser("download", help="Restore backups by token")
+    download_parser.add_argument("tokens", nargs="+")
+    download_parser.add_argument("--dest", help="Folder to restore into, defaults to Downloads")
+    download_parser.add_argument("--parallel", type=int, default=1, help="Restores running at once")
+    download_parser.add_argument("--at", type=local_time,
+                                 help="Restore rolling backups (watch.py) as they were at this ISO date and time")
+    audit_parser = commands.add_parser("audit", help="Check that the uploaded parts are still in Telegram")
+    audit_parser.add_argument("tokens", nargs="*", help="Defaults to every uploaded backup")
+    audit_parser.add_argument("--parallel", type=int, default=1, help="Backups audited at once")
+    args = parser.parse_args()
+
+    if args.command == "backup":
+        if args.chat:
+            chats.workchat = args.chat
+        if args.mirror is not None:
+            chats.mirrors = args.mirror
+        if not any(chat.chat_id == chats.workchat for chat in chats.chats):
+            parser.error("No work chat set, choose one in the bot or pass --chat with a chat the bot knows")
+
+    out = sys.stdout
+    # Only the JSON lines go to stdout, log lines too go to stderr.
+    log_to_stderr(logger)
+    start_time = time.time()
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(run(args))
+    for result in results:
+        print(json.dumps(with_speed(result), ensure_ascii=False), file=out)
+    # "failed" counts parts that did not upload in a backup and files not restored in a download.
+    failed = sum(1 for result in results if "error" in result or result.get("failed")
+                 or result.get("missing") or result.get("mismatch"))
+    summary = with_speed({
+        "op": "summary",
+        "jobs": len(results),
+        "failed": failed,
+        "bytes": sum(result.get("bytes", 0) for result in results),
+        "seconds": time.time() - start_time,
+    })
+    print(json.dumps(summary), file=out)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""
+Settings from SETTINGS.yaml that need no bot token, so remote agents (worker.py) can load them.
+The bot token, the messages and the chat and backup stores are in consts.py.
+"""
+import os
+
+import yaml
+
+from utils import setup_logger
+
+
+THRESHOLD = 18 * 1024 * 1024  # 48 MB threshold
+with open("SETTINGS.yaml", "r", -1, "utf-8") as file:
+    config = yaml.safe_load(file)
+
+TMP_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tmp")
+# Every process stages into a dir of its own, locked while it runs (see staging.hold_dir)
+TMP_DIR = os.path.join(TMP_ROOT, str(os.getpid()))
+# Max bytes staged in tmp/ and not uploaded yet, 0 means no limit
+TMP_BUDGET = int(config.get("TMP_BUDGET_MB") or 0) * 1024 * 1024
+# Files at least this big are backed up as content-defined chunks, only changed chunks
+# are uploaded again (0 = always use 7z). Known chunks are indexed in CHUNKS_FILE.
+DELTA_MIN_SIZE = int(config.get("DELTA_MIN_SIZE_MB", 1024) or 0) * 1024 * 1024
+CHUNKS_FILE = "chunks.json"
+# Searchable index of every file in every backup, behind the "what_saved" menu
+CATALOG_FILE = "catalog.db"
+# Files per sendMediaGroup upload (1 = one sendDocument per file, max 10) and max bytes per group
+UPLOAD_BATCH = max(1, min(10, int(config.get("UPLOAD_BATCH") or 1)))
+UPLOAD_BATCH_BYTES = int(config.get("UPLOAD_BATCH_MB") or 50) * 1024 * 1024
+# Local cache of downloaded parts, reused by repeated and overlapping restores (0 = off)
+DOWNLOAD_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+DOWNLOAD_CACHE_SIZE = int(config.get("DOWNLOAD_CACHE_MB") or 0) * 1024 * 1024
+# Cores shared by concurrent 7z jobs in individual mode (0 = all cores)
+COMPRESSION_CORES = int(config.get("COMPRESSION_CORES") or 0)
+# 7z level 0-9, or "auto" to pick it from the measured upload speed (see tuner.py)
+COMPRESSION_LEVEL = config.get("COMPRESSION_LEVEL", "auto")
+# Folders kept in rolling backups by watch.py, seconds of quiet before a batch is uploaded
+# and max seconds a batch may wait under a steady stream of changes
+WATCH_ROOTS = config.get("WATCH_ROOTS") or []
+WATCH_DEBOUNCE = float(config.get("WATCH_DEBOUNCE") or 2)
+WATCH_MAX_DELAY = float(config.get("WATCH_MAX_DELAY") or 30)
+# Upload/download limit in Mb/s (0 = unlimited) and time-of-day windows overriding it:
+# [{"name": "offpeak", "from": "19:00", "to": "09:00", "limit_mbps": 0}, ...]
+BANDWIDTH_LIMIT_MBPS = float(config.get("BANDWIDTH_LIMIT_MBPS") or 0)
+BANDWIDTH_WINDOWS = config.get("BANDWIDTH_WINDOWS") or []
+# gitignore-style rules for what not to back up, for every backup and per source folder, e.g.
+# EXCLUDE: ["node_modules/", "**/.git/objects/", "__pycache__/", ".venv/", "*.tmp", "!keep.tmp"]
+# EXCLUDE_BY_ROOT: {"/home/me/projects": ["build/", "dist/"]}
+# A .backupignore file in the root of a backed up folder adds its own rules.
+EXCLUDE = config.get("EXCLUDE") or []
+EXCLUDE_BY_ROOT = config.get("EXCLUDE_BY_ROOT") or {}
+# Address the bot takes remote agents (worker.py) on, "host:port" or "unix:/path/to.sock",
+# and the secret they must present. Empty WORKER_LISTEN disables it.
+WORKER_LISTEN = config.get("WORKER_LISTEN") or ""
+WORKER_SECRET = str(config.get("WORKER_SECRET") or "")
+# Scheduled backups: [{"cron": "0 2 * * *", "path": "/data", "mode": "archive", "window": "offpeak"}, ...]
+SCHEDULE = config.get("SCHEDULE") or []
+
+logger = setup_logger(name='tg_backuper', filepath='logs/log.log')
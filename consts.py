@@ -1,21 +1,14 @@
 import json
 import platform
 
-import yaml
-
-from utils import setup_logger
+from config import config, logger
 from storage import BackupStorage, ChatsStorage
 
 
-THRESHOLD = 18 * 1024 * 1024  # 48 MB threshold
-with open("SETTINGS.yaml", "r", -1, "utf-8") as file:
-    config = yaml.safe_load(file)
 BOT_TOKEN = config.get("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN not set in SETTINGS.yaml")
 
-logger = setup_logger(name='tg_backuper', filepath='logs/log.log')
-
 with open("messages.json", "r", encoding='utf-8') as file:
     M = json.load(file)
 
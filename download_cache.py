@@ -0,0 +1,120 @@
+import os
+import time
+import asyncio
+import shutil
+import hashlib
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from aiogram import Bot
+
+from config import DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_SIZE
+
+# Telegram keeps a file_path valid for at least an hour, stay a bit below that.
+FILE_PATH_TTL = 55 * 60
+
+class DownloadCache:
+    """
+    On-disk cache of downloaded Telegram files keyed by file_id, limited to `limit` bytes.
+    The mtime of an entry is its last use, the least recently used entries are evicted first.
+    A limit of 0 disables the cache.
+    """
+
+    def __init__(self, directory: str, limit: int):
+        self.directory = directory
+        self.limit = limit
+        self._lock = threading.Lock()
+
+    def path_for(self, file_id: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(file_id.encode()).hexdigest())
+
+    def contains(self, file_id: str) -> bool:
+        return bool(self.limit) and os.path.exists(self.path_for(file_id))
+
+    def get(self, file_id: str, destination: str, link: bool = False) -> bool:
+        """
+        Puts the cached copy of file_id at destination. Returns False on a miss.
+        With link the copy is a hard link, only for files that are deleted after use.
+        """
+        if not self.limit:
+            return False
+        path = self.path_for(file_id)
+        with self._lock:
+            if not os.path.exists(path):
+                return False
+            os.utime(path)
+            place(path, destination, link)
+        return True
+
+    def put(self, file_id: str, source: str) -> None:
+        """
+        Moves a freshly downloaded file into the cache and evicts old entries.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            os.replace(source, self.path_for(file_id))
+            self.evict()
+
+    def evict(self) -> None:
+        entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.limit:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+
+def place(source: str, destination: str, link: bool = False) -> None:
+    """
+    Copies source to destination. With link it is hard-linked where possible: a linked
+    file is the cache entry itself, editing it in place would corrupt the cache, so only
+    parts that are read once and deleted (split volumes, chunk volumes) are linked.
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    if link:
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+
+class FilePathCache:
+    """
+    Remembers what getFile returned for a file_id until the path expires.
+    """
+
+    def __init__(self, ttl: float = FILE_PATH_TTL):
+        self.ttl = ttl
+        self.paths: Dict[str, Tuple[str, float]] = {}
+
+    async def resolve(self, bot: Bot, file_id: str) -> str:
+        cached = self.paths.get(file_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        file_info = await bot.get_file(file_id)
+        self.paths[file_id] = (file_info.file_path, time.monotonic() + self.ttl)
+        return file_info.file_path
+
+download_cache = DownloadCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_SIZE)
+file_paths = FilePathCache()
+
+async def telegram_url(bot: Bot, file_id: str) -> str:
+    return f"https://api.telegram.org/file/bot{bot.token}/{await file_paths.resolve(bot, file_id)}"
+
+async def file_url(bot: Bot, file_id: str) -> Optional[str]:
+    """
+    Download URL for file_id, or None if it is cached and no request is needed.
+    """
+    if download_cache.contains(file_id):
+        return None
+    return await telegram_url(bot, file_id)
+
+def url_resolver(bot: Bot, file_id: str, loop: asyncio.AbstractEventLoop) -> Callable[[], str]:
+    """
+    Resolves the URL of file_id later, from a worker thread, on the bot's event loop.
+    For when file_url said the file is cached but it is evicted before it is read.
+    """
+    return lambda: asyncio.run_coroutine_threadsafe(telegram_url(bot, file_id), loop).result()
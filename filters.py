@@ -0,0 +1,137 @@
+import os
+import re
+from typing import Dict, List, Optional
+
+from config import EXCLUDE, EXCLUDE_BY_ROOT
+
+# Rules kept next to the data, in the root of a backed up folder
+IGNORE_FILE = ".backupignore"
+
+def translate(pattern: str) -> str:
+    """
+    Turns one gitignore pattern (without "!" and trailing "/") into a regex
+    matched against paths relative to the root, with "/" as the separator.
+    """
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex += "/.*"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            body = pattern[i + 1:end]
+            regex += "[" + ("^" + body[1:] if body.startswith("!") else body) + "]"
+            i = end + 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    # Without a slash a pattern matches a name at any depth.
+    return regex if anchored else "(?:.*/)?" + regex
+
+class Matcher:
+    """
+    Compiled gitignore-style rules. As in .gitignore the last matching rule wins,
+    "!pattern" includes again what an earlier rule excluded and "dir/" only matches folders.
+
+    Consecutive rules of the same kind are joined into one regex, so a path costs one regex
+    search per run of exclude or include rules instead of one per rule, checked from the last run back.
+    """
+
+    def __init__(self, rules: List[str]):
+        self.rules = []
+        for rule in rules:
+            rule = rule.rstrip()
+            if not rule or rule.startswith("#"):
+                continue
+            negated = rule.startswith("!")
+            if negated:
+                rule = rule[1:]
+            elif rule.startswith("\\!") or rule.startswith("\\#"):
+                rule = rule[1:]
+            dir_only = rule.endswith("/")
+            self.rules.append((negated, dir_only, translate(rule.rstrip("/"))))
+        self.for_dirs = self.compile(self.rules)
+        self.for_files = self.compile([rule for rule in self.rules if not rule[1]])
+
+    @staticmethod
+    def compile(rules: list) -> list:
+        runs = []
+        for negated, _, regex in rules:
+            if runs and runs[-1][0] == negated:
+                runs[-1][1].append(regex)
+            else:
+                runs.append((negated, [regex]))
+        return [(negated, re.compile("(?:" + "|".join(regexes) + ")\\Z", re.S)) for negated, regexes in reversed(runs)]
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+    def excluded(self, rel_path: str, is_dir: bool) -> bool:
+        """
+        True if the file or folder at rel_path (relative to the root, "/"-separated) is excluded.
+        """
+        for negated, regex in self.for_dirs if is_dir else self.for_files:
+            if regex.match(rel_path):
+                return not negated
+        return False
+
+    def excluded_path(self, rel_path: str, is_dir: bool) -> bool:
+        """
+        Like excluded(), but also True below an excluded folder. For paths that
+        did not come from a pruned walk, e.g. the ones file system events report.
+        """
+        parts = rel_path.split("/")
+        for i in range(1, len(parts)):
+            if self.excluded("/".join(parts[:i]), True):
+                return True
+        return self.excluded(rel_path, is_dir)
+
+class SkipStats:
+    """
+    What exclusion rules kept out of a walk. Excluded folders are never entered,
+    so their content is not counted, only the folders themselves.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.dirs = 0
+
+    def to_dict(self) -> dict:
+        return {"skipped_files": self.files, "skipped_bytes": self.bytes, "skipped_dirs": self.dirs}
+
+def matcher_for(root: str, by_root: Dict[str, List[str]] = None) -> Optional[Matcher]:
+    """
+    Rules for a backup of root: the global EXCLUDE, then the EXCLUDE_BY_ROOT entry of root,
+    then the root's own .backupignore. Returns None when there are no rules at all.
+    """
+    root = os.path.abspath(root)
+    by_root = EXCLUDE_BY_ROOT if by_root is None else by_root
+    rules = list(EXCLUDE)
+    for path, root_rules in by_root.items():
+        if os.path.abspath(os.path.expanduser(path)) == root:
+            rules.extend(root_rules)
+    ignore_file = os.path.join(root, IGNORE_FILE)
+    if os.path.isfile(ignore_file):
+        with open(ignore_file, "r", encoding="utf-8") as f:
+            rules.extend(f.read().splitlines())
+    matcher = Matcher(rules)
+    return matcher or None
@@ -0,0 +1,142 @@
+import asyncio
+import datetime
+from typing import List, Callable
+
+from aiogram import Bot
+
+from consts import M, chats, backups, logger
+from utils import buttons
+from backup import run_backup, download
+from storage import generate_token
+from catalog import catalog
+from audit import audit, RateLimiter
+
+MESSAGES = M["backup"]
+
+async def backup_to_workchat(bot: Bot, path: str, mode: str, backup_token: str = None,
+                             stats: dict = None, runner: Callable = run_backup) -> str:
+    """
+    Posts the download button for a new backup in the work chat (in a fresh forum topic
+    for supergroups) and runs the backup into it. Returns the backup token.
+    The parts are copied to the mirror chats too, which get the download button as well
+    (in a topic of their own for supergroups).
+    stats is filled by run_backup (parts, bytes, failed, seconds).
+    runner does the backup, it takes the arguments of run_backup (worker.py passes one
+    that receives the parts from a remote agent instead of staging them here).
+    """
+    backup_token = backup_token or generate_token()
+    for chat in chats.chats:
+        if chat.chat_id == chats.workchat:
+            work = chat
+    logger.info("New backup starting")
+    # Mirror chat id -> topic the copies go to, supergroups get one like the work chat.
+    mirrors = {}
+    for mirror in chats.mirrors:
+        if mirror == work.chat_id:
+            continue
+        mirror_chat = next((chat for chat in chats.chats if chat.chat_id == mirror), None)
+        mirrors[mirror] = None
+        if mirror_chat and mirror_chat.chat_type == 'supergroup':
+            try:
+                topic = await bot.create_forum_topic(
+                    chat_id=mirror, name=f"backup - {datetime.date.today().strftime('%d.%m.%Y')}")
+                mirrors[mirror] = topic.message_thread_id
+            except Exception as e:
+                # Not a forum or no can_manage_topics right, the copies go to the general chat.
+                logger.warning(f"No backup topic in mirror {mirror}: {e}")
+        await bot.send_message(chat_id=mirror,
+                               text="Кира тут твоя структура папок",
+                               message_thread_id=mirrors[mirror],
+                               reply_markup=buttons({
+                                   f"download_{backup_token}": MESSAGES["download"]
+                               }))
+    if work.chat_type == 'supergroup':
+        today = datetime.date.today()
+        thread_name = f"backup - {today.strftime('%d.%m.%Y')}"
+        
+        # Create the forum topic; ensure your bot is an admin with can_manage_topics permission.
+        forum_topic = await bot.create_forum_topic(chat_id=work.chat_id, name=thread_name)
+        thread_id = forum_topic.message_thread_id
+        
+        await bot.send_message(chat_id=work.chat_id,
+                               text="Кира, тут твоя структура папок",
+                               message_thread_id=thread_id,
+                               reply_markup=buttons({
+                                   f"download_{backup_token}": MESSAGES["download"]
+                               }))
+        
+        await asyncio.to_thread(runner, bot, path, mode, work.chat_id,
+                                token=backup_token, thread_id=thread_id, stats=stats, mirrors=mirrors)
+        logger.info("Backup done")
+        
+    else:
+        await bot.send_message(chat_id=work.chat_id,
+                               text="Кира тут твоя структура папок",
+                               reply_markup=buttons({
+                                   f"download_{backup_token}": MESSAGES["download"]
+                               }))
+        await asyncio.to_thread(runner, bot, path, mode, work.chat_id,
+                                token=backup_token, stats=stats, mirrors=mirrors)
+        logger.info("Backup done")
+    await asyncio.to_thread(catalog.sync, backups)
+    return backup_token
+
+async def run_jobs(jobs: List, parallel: int) -> list:
+    """
+    Awaits the given coroutines with at most `parallel` of them running at once,
+    returns their results (or exceptions) in order.
+    """
+    semaphore = asyncio.Semaphore(max(1, parallel))
+
+    async def limited(job):
+        async with semaphore:
+            return await job
+
+    return await asyncio.gather(*(limited(job) for job in jobs), return_exceptions=True)
+
+async def backup_paths(bot: Bot, paths: List[str], mode: str, parallel: int = 1) -> List[dict]:
+    """
+    Backs up every path into the work chat, `parallel` at a time.
+    Returns one result dict per path with its token and transfer stats.
+    """
+    async def job(path):
+        stats = {}
+        token = await backup_to_workchat(bot, path, mode, stats=stats)
+        return {"op": "backup", "path": path, "token": token, **stats}
+
+    results = await run_jobs([job(path) for path in paths], parallel)
+    return [result if isinstance(result, dict) else {"op": "backup", "path": path, "error": str(result)}
+            for path, result in zip(paths, results)]
+
+async def download_tokens(bot: Bot, tokens: List[str], destination: str = None, parallel: int = 1,
+                          at: datetime.datetime = None) -> List[dict]:
+    """
+    Restores every backup token, `parallel` at a time, rolling backups as they were at `at` if given.
+    Returns one result dict per token, "failed" in it is the number of files that were not restored.
+    """
+    async def job(token):
+        stats = {}
+        if not await download(token, bot, destination, stats, at):
+            raise ValueError("backup not found or not uploaded" if at is None
+                             else "backup not found, not uploaded or not a rolling backup")
+        if stats.get("failed"):
+            logger.warning(f"Restore of {token} is incomplete, {stats['failed']} files failed")
+        return {"op": "download", "token": token, **stats}
+
+    results = await run_jobs([job(token) for token in tokens], parallel)
+    return [result if isinstance(result, dict) else {"op": "download", "token": token, "error": str(result)}
+            for token, result in zip(tokens, results)]
+
+async def audit_tokens(bot: Bot, tokens: List[str], parallel: int = 1) -> List[dict]:
+    """
+    Audits every backup token (see audit.audit), `parallel` backups at a time.
+    They share one rate limiter, a 429 pauses all of them.
+    """
+    limiter = RateLimiter()
+
+    async def job(token):
+        return {"op": "audit", **await audit(bot, token, limiter=limiter)}
+
+    results = await run_jobs([job(token) for token in tokens], parallel)
+    return [result if isinstance(result, dict) else {"op": "audit", "token": token, "error": str(result)}
+            for token, result in zip(tokens, results)]
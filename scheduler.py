@@ -0,0 +1,121 @@
+import asyncio
+import datetime
+from typing import List, Set
+
+from aiogram import Bot
+
+from consts import logger, chats
+from config import SCHEDULE
+from throttle import bandwidth
+from jobs import backup_to_workchat
+
+FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+def parse_field(field: str, low: int, high: int) -> Set[int]:
+    """
+    Parses one cron field: "*", "5", "1-5", "*/15", "0-30/10" and comma separated lists of those.
+    """
+    values = set()
+    for item in field.split(","):
+        step = 1
+        if "/" in item:
+            item, step = item.split("/")
+            step = int(step)
+        if item == "*":
+            start, end = low, high
+        elif "-" in item:
+            start, end = map(int, item.split("-"))
+        else:
+            start = end = int(item)
+        if start < low or end > high or start > end:
+            raise ValueError(f"Cron field '{field}' out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+class CronExpression:
+    """
+    Standard 5-field cron expression: minute hour day-of-month month day-of-week (0 = Sunday).
+    As in cron, when both day fields are restricted a day matching either of them is enough.
+    """
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression '{expression}' must have 5 fields")
+        self.expression = expression
+        # A day field starting with "*" (also "*/2") does not restrict on its own.
+        self.any_day = fields[2].startswith("*")
+        self.any_weekday = fields[4].startswith("*")
+        self.fields = [parse_field(field, low, high) for field, (low, high) in zip(fields, FIELD_RANGES)]
+        # Sunday may be written as 7 too.
+        if 7 in self.fields[4]:
+            self.fields[4] = (self.fields[4] - {7}) | {0}
+
+    def matches(self, moment: datetime.datetime) -> bool:
+        minutes, hours, days, months, weekdays = self.fields
+        day_matches = moment.day in days
+        weekday_matches = (moment.weekday() + 1) % 7 in weekdays
+        if self.any_day or self.any_weekday:
+            day_ok = day_matches and weekday_matches
+        else:
+            day_ok = day_matches or weekday_matches
+        return moment.minute in minutes and moment.hour in hours and moment.month in months and day_ok
+
+class ScheduledBackup:
+    """
+    A backup from SCHEDULE in SETTINGS.yaml. If a window is named, a run that falls
+    outside of it waits until the window opens.
+    """
+
+    def __init__(self, data: dict):
+        self.cron = CronExpression(data["cron"])
+        self.path = data["path"]
+        self.mode = data.get("mode") or chats.mode
+        self.window = data.get("window")
+        # A typo in the name would otherwise leave the window always open.
+        if self.window and not any(w.name == self.window for w in bandwidth.windows):
+            raise ValueError(f"Scheduled backup of {self.path} names unknown window '{self.window}', "
+                             f"BANDWIDTH_WINDOWS has {[w.name for w in bandwidth.windows]}")
+        self.running = False
+
+    def in_window(self, moment: datetime.datetime) -> bool:
+        if not self.window:
+            return True
+        window = next(w for w in bandwidth.windows if w.name == self.window)
+        return window.contains(moment.time())
+
+def load_schedule(schedule: List[dict] = SCHEDULE) -> List[ScheduledBackup]:
+    """
+    The scheduled backups of SETTINGS.yaml. Raises ValueError on a bad cron
+    expression or window name, so a broken config stops the bot at startup.
+    """
+    return [ScheduledBackup(data) for data in schedule]
+
+async def run_job(bot: Bot, job: ScheduledBackup) -> None:
+    job.running = True
+    try:
+        while not job.in_window(datetime.datetime.now()):
+            await asyncio.sleep(60)
+        token = await backup_to_workchat(bot, job.path, job.mode)
+        logger.info(f"Scheduled backup of {job.path} done (token: {token})")
+    except Exception as e:
+        logger.error(f"Scheduled backup of {job.path} failed: {e}")
+    finally:
+        job.running = False
+
+async def run_scheduler(bot: Bot, jobs: List[ScheduledBackup] = None) -> None:
+    """
+    Checks the scheduled backups once a minute and starts the ones that are due.
+    A job that is still running (or waiting for its window) is not started twice.
+    """
+    jobs = jobs if jobs is not None else load_schedule()
+    if not jobs:
+        return
+    logger.info(f"Scheduler started with {len(jobs)} backups")
+    while True:
+        now = datetime.datetime.now().replace(second=0, microsecond=0)
+        for job in jobs:
+            if job.cron.matches(now) and not job.running:
+                asyncio.create_task(run_job(bot, job))
+        next_minute = now + datetime.timedelta(minutes=1)
+        await asyncio.sleep(max(0.0, (next_minute - datetime.datetime.now()).total_seconds()))
@@ -40,6 +40,29 @@ async def dir_set(callback: CallbackQuery):
     await callback.bot.send_message(chat_id=workdir_id,
                                     text=MESSAGES["choose_workdir"]["set_alert"])
     
+def mirrors_keyboard():
+    return buttons({f"mirror_{x.chat_id}": ("✅ " if x.chat_id in chats.mirrors else "") +
+                    (x.username if x.chat_type == 'private' else x.title)
+                    for x in chats.chats if x.chat_id != chats.workchat})
+
+@router.callback_query(F.data == 'choose_mirrors')
+async def choosing_mirrors(callback: CallbackQuery):
+    await callback.answer()
+    await callback.bot.send_message(chat_id=callback.from_user.id, text=MESSAGES["mirrors"]["msg"],
+                                    reply_markup=mirrors_keyboard())
+
+@router.callback_query(F.data.startswith('mirror_'))
+async def mirror_toggle(callback: CallbackQuery):
+    await callback.answer()
+    mirror_id = int(callback.data.split('_')[-1])
+    if mirror_id in chats.mirrors:
+        chats.mirrors.remove(mirror_id)
+    else:
+        chats.mirrors.append(mirror_id)
+        await callback.bot.send_message(chat_id=mirror_id, text=MESSAGES["mirrors"]["set_alert"])
+    chats.save()
+    await callback.message.edit_reply_markup(reply_markup=mirrors_keyboard())
+
 @router.callback_query(F.data == 'choose_mode')
 async def mode_choise(callback: CallbackQuery):
     await callback.answer()
@@ -0,0 +1,117 @@
+import os
+import threading
+import contextlib
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# Lock file in the tmp dir of a process, held for as long as the process runs
+DIR_LOCK = ".lock"
+# Tmp dirs this process holds -> their open lock file
+_held = {}
+_held_lock = threading.Lock()
+
+def _lock(f, blocking: bool) -> None:
+    if os.name == "nt":
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def _unlock(f) -> None:
+    if os.name == "nt":
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def hold_dir(path: str) -> str:
+    """
+    Creates the tmp dir of this process if needed and locks it until the process exits,
+    so collect_tmp_garbage in another process leaves what is staged in it alone. Returns path.
+    """
+    with _held_lock:
+        if path in _held:
+            return path
+        while True:
+            os.makedirs(path, exist_ok=True)
+            f = open(os.path.join(path, DIR_LOCK), "a+b")
+            _lock(f, True)
+            # A collector may have removed the dir of a dead process with the same pid meanwhile.
+            try:
+                if os.path.samestat(os.fstat(f.fileno()), os.stat(f.name)):
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        _held[path] = f
+    return path
+
+@contextlib.contextmanager
+def claim_dir(path: str):
+    """
+    Locks the tmp dir of another process if that process is gone. Yields True if it is,
+    the dir is then the caller's to clean up, and False while its process still runs.
+    """
+    if path in _held:
+        yield False
+        return
+    with open(os.path.join(path, DIR_LOCK), "a+b") as f:
+        try:
+            _lock(f, False)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            _unlock(f)
+
+
+class TmpBudget:
+    """
+    Keeps track of the bytes that are staged in tmp/ but not uploaded yet.
+
+    Producers (copying and 7z) call reserve()/add() before or after putting bytes
+    into tmp/, the uploader calls release() once a part has been sent and deleted.
+    A limit of 0 disables the budget, so nothing ever blocks.
+    """
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def is_full(self, incoming: int = 0) -> bool:
+        """
+        Returns True if staging `incoming` more bytes would go over the budget.
+        An empty tmp/ is never full, so a single item bigger than the budget still goes through.
+        """
+        with self._cond:
+            return bool(self.limit) and self.used > 0 and self.used + incoming > self.limit
+
+    def reserve(self, size: int) -> None:
+        """
+        Blocks until `size` bytes fit into the budget and accounts them as staged.
+        """
+        with self._cond:
+            while self.limit and self.used > 0 and self.used + size > self.limit:
+                self._cond.wait()
+            self.used += size
+
+    def add(self, size: int) -> None:
+        """
+        Accounts bytes that are already on disk (e.g. a finished 7z volume) without blocking.
+        """
+        with self._cond:
+            self.used += size
+
+    def release(self, size: int) -> None:
+        """
+        Frees `size` bytes after they were uploaded and wakes up blocked producers.
+        """
+        with self._cond:
+            self.used = max(0, self.used - size)
+            self._cond.notify_all()
@@ -1,9 +1,23 @@
 import os
+import sys
+import json
 import uuid
+import hashlib
+import tempfile
+import threading
 import datetime
-from typing import Optional, List, Union
+import contextlib
+from typing import Dict, Optional, List, Tuple, Union
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# Journal entries after which save() folds the journal back into the headers file
+JOURNAL_COMPACT_AT = 200
 
 class Topic(BaseModel):
     topic_id: int = Field(..., description="Unique identifier for the forum topic (thread)")
@@ -20,7 +34,9 @@ class ChatsStorage(BaseModel):
     chats: List[Chat] = Field(default_factory=list, description="List of chats where the bot is present")
     file_path: str
     workchat: Optional[int] = Field(default=None)
+    mirrors: List[int] = Field(default_factory=list, description="Chats that get a copy of every backup besides workchat")
     mode: Optional[str] = Field(default="individual")
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
 
     def add_chat(self, chat: Chat) -> None:
         """
@@ -49,8 +65,8 @@ class ChatsStorage(BaseModel):
         """
         Save the storage to a JSON file.
         """
-        with open(self.file_path, 'w', encoding='utf-8') as f:
-            f.write(self.model_dump_json(indent=2))
+        with self._lock:
+            write_atomic(self.file_path, self.model_dump_json(indent=2))
 
     def load(self) -> None:
         """
@@ -62,6 +78,7 @@ class ChatsStorage(BaseModel):
                 loaded_storage = self.__class__.model_validate_json(data)
                 self.chats = loaded_storage.chats
                 self.workchat = loaded_storage.workchat
+                self.mirrors = loaded_storage.mirrors
                 self.mode = loaded_storage.mode
         except FileNotFoundError:
             self.chats=[]
@@ -71,34 +88,313 @@ def generate_token() -> str:
 def generate_date() -> str:
     return  datetime.datetime.now().strftime('%d.%m.%Y-%H-%M-%S')
 
-class FileUpload(BaseModel):
-    name: str = Field(..., description="Name of the file")
-    upload_id: list[str] = Field([], description="Upload identifier for the file (default empty)")
-    absolute_path: Optional[str] = Field(None, description="Absolute path to the file in the tmp folder, or the base path for a split archive")
-    is_split: bool = Field(False, description="Indicates if this file is split into multiple parts")
+def write_atomic(path: str, text: str) -> None:
+    """
+    Replaces the file at path with text. The text goes to a temporary file next to it first,
+    so a crash leaves either the old file or the new one, never a half-written one.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """
+    Holds an exclusive lock on the file at path (created if missing) until the with block ends.
+    Serialises read-modify-write cycles of a file shared by several processes (bot, CLI, watcher).
+    """
+    with open(path, 'a+b') as f:
+        if os.name == "nt":
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class FileUpload:
+    """
+    A file of a backup tree. Backups can hold millions of these, so tree nodes are plain
+    __slots__ classes with interned names instead of validated pydantic models.
+    """
+    __slots__ = ("name", "upload_id", "absolute_path", "is_split", "chunks", "size", "fingerprints")
+
+    def __init__(self, name: str, upload_id: Optional[List[str]] = None,
+                 absolute_path: Optional[str] = None, is_split: bool = False,
+                 chunks: Optional[List[str]] = None, size: Optional[int] = None,
+                 fingerprints: Optional[List[list]] = None):
+        self.name = sys.intern(name)
+        self.upload_id = upload_id if upload_id is not None else []
+        self.absolute_path = absolute_path
+        self.is_split = is_split
+        # sha256 of the content-defined chunks of a delta-backed file (see chunks.py)
+        self.chunks = chunks
+        # Size of the original file in bytes, unknown for records made before it was tracked
+        self.size = size
+        # [file_unique_id, file_size] Telegram reported for each upload_id, checked by audit.py
+        self.fingerprints = fingerprints if fingerprints is not None else []
+
+    def add_part(self, document: dict) -> None:
+        """
+        Records an uploaded part from the Document object Telegram returned for it.
+        """
+        self.upload_id.append(document["file_id"])
+        self.fingerprints.append([document.get("file_unique_id"), document.get("file_size")])
+
+    def to_dict(self) -> dict:
+        data = {"name": self.name, "upload_id": self.upload_id,
+                "absolute_path": self.absolute_path, "is_split": self.is_split}
+        if self.chunks is not None:
+            data["chunks"] = self.chunks
+        if self.size is not None:
+            data["size"] = self.size
+        if self.fingerprints:
+            data["fingerprints"] = self.fingerprints
+        return data
+
+class FolderUpload:
+    """
+    A folder of a backup tree, children are FileUpload and FolderUpload nodes.
+    """
+    __slots__ = ("name", "children")
+
+    def __init__(self, name: str, children: Optional[List[Union["FileUpload", "FolderUpload"]]] = None):
+        self.name = sys.intern(name)
+        self.children = children if children is not None else []
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "children": [child.to_dict() for child in self.children]}
+
+def node_from_dict(data: dict) -> Union[FileUpload, FolderUpload]:
+    """
+    Builds a tree node from its JSON form, folders are the ones with "children".
+    """
+    if "children" in data:
+        return FolderUpload(data["name"], [node_from_dict(child) for child in data["children"] or []])
+    return FileUpload(data["name"], data.get("upload_id") or [],
+                      data.get("absolute_path"), data.get("is_split", False), data.get("chunks"),
+                      data.get("size"), data.get("fingerprints"))
+
+def dump_tree(children: List[Union[FileUpload, FolderUpload]]) -> str:
+    """
+    The content of a tree file.
+    """
+    return json.dumps({"children": [child.to_dict() for child in children]},
+                      ensure_ascii=False, separators=(',', ':'))
+
+def load_tree(tree_path: str) -> List[Union[FileUpload, FolderUpload]]:
+    """
+    Reads the children of a backup root from its tree file.
+    """
+    with open(tree_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return [node_from_dict(child) for child in data["children"]]
 
-class FolderUpload(BaseModel):
-    name: str = Field(..., description="Name of the folder")
-    children: Optional[List[Union["FileUpload", "FolderUpload"]]] = Field(default_factory=list, description="List of files or subfolders contained in the folder")
+def apply_changes(children: List[Union[FileUpload, FolderUpload]], changes: List[dict]) -> bool:
+    """
+    Replays journaled tree changes over a tree read from its file, in journal order:
+      - parts {"path", "index", "file_id", "fingerprint"}: a part the file already holds is skipped,
+        the tree was written after it was journaled;
+      - nodes {"folder", "remove", "node"}: in the folder at that path (created if missing),
+        the children named in remove are dropped and node, if any, is added. Replaying one twice
+        leaves the same tree.
+    Returns True if the tree changed.
+    """
+    # id of a children list -> (the list, name -> its nodes with that name)
+    names = {}
+
+    def by_name(nodes):
+        cached = names.get(id(nodes))
+        if cached is None or cached[0] is not nodes:
+            index = {}
+            for child in nodes:
+                index.setdefault(child.name, []).append(child)
+            cached = names[id(nodes)] = (nodes, index)
+        return cached[1]
+
+    def folder_at(path, create):
+        nodes = children
+        for name in path:
+            folder = next((c for c in by_name(nodes).get(name, ()) if isinstance(c, FolderUpload)), None)
+            if folder is None:
+                if not create:
+                    return None
+                folder = FolderUpload(name, [])
+                nodes.append(folder)
+                by_name(nodes).setdefault(name, []).append(folder)
+            nodes = folder.children
+        return nodes
+
+    changed = False
+    for change in changes:
+        if "file_id" in change:
+            nodes = folder_at(change["path"][:-1], False)
+            node = next((c for c in by_name(nodes).get(change["path"][-1], ()) if isinstance(c, FileUpload)),
+                        None) if nodes is not None else None
+            if node is None or len(node.upload_id) != change["index"]:
+                continue
+            node.upload_id.append(change["file_id"])
+            if len(node.fingerprints) == change["index"]:
+                node.fingerprints.append(change["fingerprint"])
+            changed = True
+            continue
+        nodes = folder_at(change["folder"], change["node"] is not None)
+        if nodes is None:
+            continue
+        index = by_name(nodes)
+        for name in change["remove"]:
+            for node in index.pop(name, []):
+                nodes.remove(node)
+                changed = True
+        if change["node"] is not None:
+            node = node_from_dict(change["node"])
+            nodes.append(node)
+            index.setdefault(node.name, []).append(node)
+            changed = True
+    return changed
 
 class BackupRootFolder(FolderUpload):
-    token: str = Field(default_factory=generate_token, description="Unique token for the backup root folder")
-    uploaded: bool = Field(False, description="Indicates if this backup is uploaded")
-    creatin_date: str = Field(default_factory=generate_date, description="Date of creation of backup")
+    """
+    Root of a backup. The header (name, token, date, uploaded) is always in memory,
+    the children are read from tree_path the first time they are accessed, with the
+    changes journaled after the tree file was written replayed over them.
+    """
+    __slots__ = ("token", "uploaded", "creatin_date", "_children", "tree_path", "destinations", "changes")
 
-class BackupStorage(BaseModel):
-    backups: List[BackupRootFolder] = Field(default_factory=list, description="List of root backup folders")
-    file_path: str
+    def __init__(self, name: str, children: Optional[list] = None, token: Optional[str] = None,
+                 uploaded: bool = False, creatin_date: Optional[str] = None,
+                 tree_path: Optional[str] = None, destinations: Optional[List[int]] = None,
+                 changes: Optional[List[dict]] = None):
+        self.name = sys.intern(name)
+        self.token = token or generate_token()
+        self.uploaded = uploaded
+        self.creatin_date = creatin_date or generate_date()
+        self.tree_path = tree_path
+        # Chats that hold every part of the backup, the first one is where it was uploaded
+        self.destinations = destinations if destinations is not None else []
+        self._children = children if children is not None or tree_path else []
+        self.changes = changes
+
+    @property
+    def children(self) -> List[Union[FileUpload, FolderUpload]]:
+        if self._children is None:
+            children = load_tree(self.tree_path)
+            if self.changes:
+                apply_changes(children, self.changes)
+            self.changes = None
+            self._children = children
+        return self._children
+
+    @children.setter
+    def children(self, value: List[Union[FileUpload, FolderUpload]]) -> None:
+        self._children = value
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._children is not None
+
+    def header(self) -> dict:
+        return {"name": self.name, "token": self.token, "uploaded": self.uploaded,
+                "creatin_date": self.creatin_date, "destinations": self.destinations}
+
+class BackupStorage:
+    """
+    List of backups. The JSON file only holds the backup headers, every backup tree is kept
+    in its own file in trees_dir and loaded lazily, so looking up one token does not
+    build the trees of every backup ever made.
+
+    save() does not rewrite the headers file: it appends the headers that changed (and the
+    deleted tokens) to a journal next to it, one JSON line each. add_parts() journals the parts
+    uploaded for a running backup the same way (token, path of the file in the tree, file_id),
+    and add_nodes() the files a job puts into or removes from a saved tree, so neither rewrites
+    the tree. load() replays the journal over the headers file and the trees, and once it holds
+    JOURNAL_COMPACT_AT entries save() folds it back into them.
+    Tree files are only written when their content changed. Every rewrite goes through
+    write_atomic, so a crash in the middle of a save never leaves a truncated file behind.
+
+    Jobs pin the backups they fill in (pinned()). load() keeps the roots of pinned backups
+    and of backups not saved yet as they are in memory, every other root is read from disk
+    again, so a backup deleted by another process is gone after the next load.
+    """
+
+    def __init__(self, file_path: str, backups: Optional[List[BackupRootFolder]] = None):
+        self.file_path = file_path
+        self.trees_dir = os.path.splitext(file_path)[0] + "_trees"
+        self.journal_path = file_path + ".journal"
+        self.backups = backups if backups is not None else []
+        self._deleted = set()
+        # Header JSON per token and sha1 per tree as they are on disk, save() writes what differs.
+        self._saved_headers = {}
+        self._saved_trees = {}
+        self._journal_entries = 0
+        # Tokens of the backups that were on disk at the last load or saved since
+        self._known = set()
+        # Token -> number of running jobs that pinned the backup
+        self._pins: Dict[str, int] = {}
+        # Token of a pinned backup -> id of every file record in its saved tree -> (record, folder path)
+        self._paths: Dict[str, Dict[int, Tuple[FileUpload, tuple]]] = {}
+        # Token -> the root _paths was built from
+        self._indexed: Dict[str, BackupRootFolder] = {}
+        # Tokens whose tree in memory is its file with the journal replayed, save() does not write them
+        self._journaled = set()
+        # Backups may run in several threads at once, each loading and saving.
+        self._lock = threading.RLock()
+
+    def get_tree_path(self, token: str) -> str:
+        return os.path.join(self.trees_dir, f"{token}.json")
+
+    def pin(self, token: str) -> None:
+        """
+        Marks the backup as used by a running job: load() leaves its root alone and
+        add_parts() journals its parts. Every pin() needs an unpin().
+        """
+        with self._lock:
+            self._pins[token] = self._pins.get(token, 0) + 1
+
+    def unpin(self, token: str) -> None:
+        with self._lock:
+            self._pins[token] -= 1
+            if not self._pins[token]:
+                del self._pins[token]
+                self._paths.pop(token, None)
+                self._indexed.pop(token, None)
+
+    @contextlib.contextmanager
+    def pinned(self, token: str):
+        """
+        pin() for the duration of a with block.
+        """
+        self.pin(token)
+        try:
+            yield
+        finally:
+            self.unpin(token)
 
     def add_backup(self, backup: BackupRootFolder) -> None:
         """
         Add a new backup or update an existing one by folder name.
         """
-        for idx, existing_backup in enumerate(self.backups):
-            if existing_backup.token == backup.token:
-                self.backups[idx] = backup
-                return
-        self.backups.append(backup)
+        with self._lock:
+            for idx, existing_backup in enumerate(self.backups):
+                if existing_backup.token == backup.token:
+                    self.backups[idx] = backup
+                    return
+            self.backups.append(backup)
 
     def delete_backup(self, backup_name: str) -> bool:
         """
@@ -107,27 +403,251 @@ class BackupStorage(BaseModel):
         Returns:
             bool: True if the backup was found and deleted, False otherwise.
         """
-        for idx, existing_backup in enumerate(self.backups):
-            if existing_backup.name == backup_name:
-                del self.backups[idx]
-                return True
-        return False
+        with self._lock:
+            for idx, existing_backup in enumerate(self.backups):
+                if existing_backup.name == backup_name:
+                    self._deleted.add(existing_backup.token)
+                    del self.backups[idx]
+                    return True
+            return False
+
+    def add_parts(self, parts: List[Tuple[FileUpload, dict]]) -> None:
+        """
+        Journals parts just recorded with FileUpload.add_part, as (record, Telegram document) pairs.
+        Only files of pinned backups whose tree is saved are journaled, the parts of the others
+        reach the disk with their tree on the next save().
+        """
+        with self._lock:
+            entries = []
+            for record, document in parts:
+                for token, paths in self._paths.items():
+                    known = paths.get(id(record))
+                    if known is not None and known[0] is record:
+                        break
+                else:
+                    continue
+                entries.append(json.dumps({"part": {
+                    "token": token, "path": [*known[1], record.name],
+                    "index": record.upload_id.index(document["file_id"]), "file_id": document["file_id"],
+                    "fingerprint": [document.get("file_unique_id"), document.get("file_size")]}},
+                    ensure_ascii=False))
+            self._append(entries)
+
+    def add_nodes(self, token: str, changes: List[Tuple[List[str], List[str], Optional[FileUpload]]]) -> None:
+        """
+        Journals changes a job made to the tree of a saved backup, as (folder path, names removed
+        from the folder, file record added or None). From then on save() takes the file with the
+        journal replayed for the tree's content and stops writing it, so every change to the tree
+        in memory has to go through here.
+        """
+        with self._lock:
+            self._append([json.dumps({"node": {"token": token, "folder": folder, "remove": removed,
+                                               "node": record.to_dict() if record is not None else None}},
+                                     ensure_ascii=False) for folder, removed, record in changes])
+            self._journaled.add(token)
 
     def save(self) -> None:
         """
-        Save the backup storage to a JSON file.
+        Journal the backup headers that changed since the last load or save. Only trees that
+        were loaded (and so could have changed) and differ from their file are written back.
         """
-        with open(self.file_path, 'w', encoding='utf-8') as f:
-            f.write(self.model_dump_json(indent=2))
+        with self._lock:
+            self._save()
 
-    def load(self) -> None:
+    def _save(self) -> None:
+        os.makedirs(self.trees_dir, exist_ok=True)
+        # Trees first: a journaled header must never point to a tree that is not on disk yet.
+        for backup in self.backups:
+            if not backup.is_loaded or backup.token in self._journaled:
+                continue
+            written = self._save_tree(backup)
+            # Parts are journaled by their path in the saved tree, so the paths follow every write.
+            if backup.token in self._pins and (written or self._indexed.get(backup.token) is not backup):
+                self._index_paths(backup)
+        entries = []
+        for backup in self.backups:
+            header = json.dumps(backup.header(), ensure_ascii=False)
+            if self._saved_headers.get(backup.token) != header:
+                entries.append(f'{{"put":{header}}}')
+                self._saved_headers[backup.token] = header
+                self._known.add(backup.token)
+        for token in self._deleted:
+            entries.append(json.dumps({"delete": token}))
+            self._saved_headers.pop(token, None)
+            self._saved_trees.pop(token, None)
+            self._known.discard(token)
+            self._journaled.discard(token)
+        self._append(entries)
+        for token in self._deleted:
+            if os.path.exists(self.get_tree_path(token)):
+                os.remove(self.get_tree_path(token))
+        self._deleted.clear()
+        if self._journal_entries >= JOURNAL_COMPACT_AT or not os.path.exists(self.file_path):
+            self._compact()
+
+    def _save_tree(self, backup: BackupRootFolder) -> bool:
+        """
+        Writes the tree of a loaded backup unless its file already holds it. Returns True if written.
+        """
+        backup.tree_path = self.get_tree_path(backup.token)
+        text = dump_tree(backup.children)
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        if digest == self._saved_trees.get(backup.token):
+            return False
+        if backup.token not in self._saved_trees and os.path.exists(backup.tree_path):
+            with open(backup.tree_path, 'r', encoding='utf-8') as f:
+                on_disk = hashlib.sha1(f.read().encode()).hexdigest()
+            if digest == on_disk:
+                self._saved_trees[backup.token] = digest
+                return False
+        write_atomic(backup.tree_path, text)
+        self._saved_trees[backup.token] = digest
+        return True
+
+    def _index_paths(self, backup: BackupRootFolder) -> None:
+        paths = {}
+        stack = [(backup.children, ())]
+        while stack:
+            children, path = stack.pop()
+            for child in children:
+                if isinstance(child, FolderUpload):
+                    stack.append((child.children, path + (child.name,)))
+                else:
+                    paths[id(child)] = (child, path)
+        self._paths[backup.token] = paths
+        self._indexed[backup.token] = backup
+
+    def _append(self, entries: List[str]) -> None:
+        """
+        Appends JSON lines to the journal and syncs it.
+        """
+        if not entries:
+            return
+        with open(self.journal_path, 'a+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size:
+                f.seek(size - 1)
+                # A torn append left the last line open, the new entries start on a line of their own.
+                if f.read(1) != b"\n":
+                    entries = [""] + entries
+            f.write(("\n".join(entries) + "\n").encode())
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_entries += len(entries)
+
+    def _read_entries(self) -> Tuple[List[dict], Dict[str, List[dict]]]:
         """
-        Load the backup storage from a JSON file. If the file does not exist, resets backups to empty.
+        Backup entries on disk: the headers file with the journal replayed over it,
+        and the journaled tree changes of every backup left.
+        A compaction cut short leaves its journal in journal_path + ".old", replayed first.
         """
+        entries = {}
+        changes = {}
         if os.path.exists(self.file_path):
             with open(self.file_path, 'r', encoding='utf-8') as f:
-                data = f.read()
-                loaded_storage = self.__class__.model_validate_json(data)
-                self.backups = loaded_storage.backups
-        else:
-            self.backups = []
\ No newline at end of file
+                entries = {entry["token"]: entry for entry in json.load(f)["backups"]}
+        self._journal_entries = 0
+        for path in (self.journal_path + ".old", self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        # The tail of an append the process did not live to finish.
+                        continue
+                    if "put" in change:
+                        entries[change["put"]["token"]] = change["put"]
+                    elif "part" in change or "node" in change:
+                        tree_change = change.get("part") or change["node"]
+                        changes.setdefault(tree_change["token"], []).append(tree_change)
+                    else:
+                        entries.pop(change["delete"], None)
+                        changes.pop(change["delete"], None)
+                    self._journal_entries += 1
+        return list(entries.values()), {token: changes[token] for token in changes if token in entries}
+
+    def _compact(self) -> None:
+        """
+        Folds the journal into the headers file and the tree changes into their tree files. The journal
+        is moved aside before it is read, so lines another process appends meanwhile start a new
+        journal instead of getting lost.
+        """
+        # After a compaction cut short the old journal is still there and must be read first.
+        if os.path.exists(self.journal_path) and not os.path.exists(self.journal_path + ".old"):
+            os.replace(self.journal_path, self.journal_path + ".old")
+        entries, changes = self._read_entries()
+        # A compaction cut short is replayed again, apply_changes leaves the trees it got to as they are.
+        for entry in entries:
+            if entry["token"] not in changes:
+                continue
+            if "children" in entry:
+                children = [node_from_dict(child) for child in entry["children"] or []]
+                if apply_changes(children, changes[entry["token"]]):
+                    entry["children"] = [child.to_dict() for child in children]
+                continue
+            tree_path = self.get_tree_path(entry["token"])
+            if not os.path.exists(tree_path):
+                continue
+            children = load_tree(tree_path)
+            if apply_changes(children, changes[entry["token"]]):
+                write_atomic(tree_path, dump_tree(children))
+                self._saved_trees.pop(entry["token"], None)
+        write_atomic(self.file_path, json.dumps({"backups": entries, "file_path": self.file_path},
+                                                ensure_ascii=False, indent=2))
+        if os.path.exists(self.journal_path + ".old"):
+            os.remove(self.journal_path + ".old")
+        self._journal_entries = 0
+
+    def load(self) -> None:
+        """
+        Load the backup headers from the JSON file and its journal. If neither exists, resets backups to empty.
+        Backups saved before trees were split out still carry their children inline,
+        those are built right away and moved to tree files on the next save.
+
+        Roots of pinned backups are kept as they are: a running backup may still be filling in
+        upload ids (or not have saved yet), and reloading must not swap its tree for the saved copy
+        or drop it. So are backups that were never saved. Every other root is replaced by the one
+        on disk, or dropped if the backup is not there anymore.
+        """
+        with self._lock:
+            self._load()
+
+    def _load(self) -> None:
+        kept = {backup.token: backup for backup in self.backups
+                if backup.token in self._pins or backup.token not in self._known}
+        # Trees read again may differ from what this process wrote, they are compared with the file.
+        self._saved_trees = {token: digest for token, digest in self._saved_trees.items() if token in kept}
+        self._journaled &= set(kept)
+        self._saved_headers = {}
+        self._known &= set(kept)
+        self.backups = []
+        if any(os.path.exists(path) for path in (self.file_path, self.journal_path, self.journal_path + ".old")):
+            entries, changes = self._read_entries()
+            for entry in entries:
+                token = entry["token"]
+                self._known.add(token)
+                if "children" not in entry:
+                    self._saved_headers[token] = json.dumps(entry, ensure_ascii=False)
+                if token in kept:
+                    backup = kept.pop(token)
+                    if not backup.is_loaded:
+                        backup.changes = changes.get(token)
+                    self.backups.append(backup)
+                    continue
+                children = None
+                if "children" in entry:
+                    children = [node_from_dict(child) for child in entry["children"] or []]
+                    apply_changes(children, changes.get(token, []))
+                self.backups.append(BackupRootFolder(
+                    name=entry["name"],
+                    children=children,
+                    token=token,
+                    uploaded=entry.get("uploaded", False),
+                    creatin_date=entry.get("creatin_date"),
+                    destinations=entry.get("destinations"),
+                    tree_path=None if children is not None else self.get_tree_path(token),
+                    changes=None if children is not None else changes.get(token)
+                ))
+        self.backups.extend(kept.values())
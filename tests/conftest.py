@@ -0,0 +1,21 @@
+"""
+The modules read SETTINGS.yaml, messages.json and their JSON stores from the working
+directory on import, so the tests run in a scratch directory with a minimal setup.
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix="tg_backup_tests_")
+
+sys.path.insert(0, ROOT)
+with open(os.path.join(WORK_DIR, "SETTINGS.yaml"), "w", encoding="utf-8") as f:
+    f.write('BOT_TOKEN: "123:abc"\nDELTA_MIN_SIZE_MB: 0\n')
+shutil.copy(os.path.join(ROOT, "messages.json"), WORK_DIR)
+os.chdir(WORK_DIR)
+
+def pytest_sessionfinish(session, exitstatus):
+    os.chdir(ROOT)
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
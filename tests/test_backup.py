@@ -0,0 +1,26 @@
+import fcntl
+
+import backup
+import consts
+from staging import DIR_LOCK
+from storage import BackupStorage
+
+def test_tmp_garbage_skips_dirs_of_running_processes(tmp_path, monkeypatch):
+    # Another process (the CLI, an agent) stages into tmp/<pid> before its backup is saved,
+    # the bot collecting garbage at startup must not delete those files.
+    root = tmp_path / "tmp"
+    running, dead = root / "101", root / "102"
+    running.mkdir(parents=True)
+    dead.mkdir()
+    (running / "part.7z.001").write_bytes(b"x" * 10)
+    (dead / "part.7z.001").write_bytes(b"y" * 20)
+    (dead / DIR_LOCK).touch()
+    monkeypatch.setattr(backup, "TMP_ROOT", str(root))
+    monkeypatch.setattr(consts, "backups", BackupStorage(str(tmp_path / "backups.json")))
+
+    with open(running / DIR_LOCK, "a+b") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        assert backup.collect_tmp_garbage() == 20
+
+    assert (running / "part.7z.001").exists()
+    assert not dead.exists()
@@ -0,0 +1,25 @@
+from catalog import Catalog
+from storage import BackupRootFolder, FileUpload, FolderUpload
+
+NAMES = ["Report 2024.PDF", "report.txt", "photo.jpg", 'say "hi".txt', "Отчёт.docx", "ab"]
+
+def test_name_search_matches_substrings_ignoring_case(tmp_path):
+    catalog = Catalog(str(tmp_path / "catalog.db"))
+    assert catalog.name_index
+    root = BackupRootFolder("data", children=[FolderUpload("docs", [FileUpload(name, size=1) for name in NAMES])],
+                            uploaded=True)
+    catalog._index(root, 0.0)
+    catalog._index(BackupRootFolder("old", children=[FileUpload("report.old", size=1)], uploaded=True), 0.0)
+    catalog._remove(catalog.db.execute("SELECT token FROM backups WHERE name = 'old'").fetchone()[0])
+
+    def found(query):
+        rows, count = catalog.search(query, 0)
+        assert count == len(rows)
+        return sorted(row[3] for row in rows)
+
+    assert found("REPORT") == ["data/docs/Report 2024.PDF", "data/docs/report.txt"]
+    assert found('"hi"') == ['data/docs/say "hi".txt']
+    assert found("отчёт") == ["data/docs/Отчёт.docx"]
+    # Shorter than a trigram, answered by a scan.
+    assert found("b") == ["data/docs/ab"]
+    assert found("data/docs/p") == ["data/docs/photo.jpg"]
@@ -0,0 +1,136 @@
+import os
+import errno
+import queue
+
+import pytest
+
+from chunks import ChunkStore, CHUNK_MAX, chunk_file, volumes_of, assemble
+from storage import FileUpload
+
+def stage_volume(store, volume, digest, file_id=None):
+    record = FileUpload(volume, upload_id=[file_id] if file_id else [])
+    store.pending_volumes[volume] = record
+    store.add_pending(digest, [volume, 0, 1, False], FileUpload("file", chunks=[digest]))
+
+def test_commits_of_two_stores_on_one_file_keep_each_other(tmp_path):
+    path = str(tmp_path / "chunks.json")
+    first = ChunkStore(path)
+    second = ChunkStore(path)
+    stage_volume(first, "va", "d_a", "id_a")
+    stage_volume(second, "vb", "d_b", "id_b")
+    first.commit(["va"])
+    second.commit(["vb"])
+    stage_volume(first, "vc", "d_c", "id_c")
+    first.commit(["vc"])
+
+    on_disk = ChunkStore(path)
+    assert set(on_disk.chunks) == {"d_a", "d_b", "d_c"}
+    assert on_disk.volumes == {"va": "id_a", "vb": "id_b", "vc": "id_c"}
+    # A chunk indexed by the other store is found on a miss.
+    stage_volume(second, "vd", "d_d", "id_d")
+    second.commit(["vd"])
+    assert first.lookup("d_d") == ["vd", 0, 1, False]
+    assert first.file_id("vd") == "id_d"
+
+def test_failed_chunking_leaves_no_chunks_to_reuse(tmp_path, monkeypatch):
+    store = ChunkStore(str(tmp_path / "chunks.json"))
+    source = tmp_path / "big.bin"
+    source.write_bytes(os.urandom(3 * CHUNK_MAX))
+    output = str(tmp_path / "big.chunks")
+    real_open = open
+
+    def full_disk(path, mode="r", *args, **kwargs):
+        f = real_open(path, mode, *args, **kwargs)
+        if str(path).startswith(output):
+            def write(data):
+                raise OSError(errno.ENOSPC, "No space left on device")
+            f.write = write
+        return f
+
+    monkeypatch.setattr("builtins.open", full_disk)
+    with pytest.raises(OSError):
+        chunk_file(str(source), "big.bin", output, store=store)
+    monkeypatch.undo()
+
+    staged = queue.Queue()
+    record = chunk_file(str(source), "big.bin", output + "2", staged=staged, store=store)
+    volumes = []
+    while not staged.empty():
+        volume, part, _ = staged.get()
+        volume.upload_id.append("id_" + volume.name)
+        volumes.append(volume.name)
+        os.remove(part)
+    assert store.commit(volumes) == []
+    assert record.chunks is not None
+    assert set(volumes_of(record.chunks, store)) <= set(store.volumes)
+    assert not store.pending and not store.pending_volumes
+
+def upload_staged(staged, uploaded):
+    volumes = []
+    while not staged.empty():
+        volume, part, _ = staged.get()
+        file_id = f"id{len(uploaded)}"
+        with open(part, "rb") as f:
+            uploaded[file_id] = f.read()
+        os.remove(part)
+        volume.upload_id.append(file_id)
+        volumes.append(volume.name)
+    return volumes
+
+def test_changed_file_reuses_its_chunks_and_assembles(tmp_path):
+    store = ChunkStore(str(tmp_path / "chunks.json"))
+    uploaded = {}
+    original = bytearray(os.urandom(5 * CHUNK_MAX) + bytes(CHUNK_MAX))
+    source = tmp_path / "disk.img"
+    source.write_bytes(original)
+    staged = queue.Queue()
+    first = chunk_file(str(source), "disk.img", str(tmp_path / "v1.chunks"), staged=staged, store=store)
+    assert store.commit(upload_staged(staged, uploaded)) == []
+    first_bytes = sum(len(data) for data in uploaded.values())
+
+    changed = bytearray(original)
+    changed[3 * CHUNK_MAX:3 * CHUNK_MAX + 100] = os.urandom(100)
+    source.write_bytes(changed)
+    second = chunk_file(str(source), "disk.img", str(tmp_path / "v2.chunks"), staged=staged, store=store)
+    assert store.commit(upload_staged(staged, uploaded)) == []
+
+    # Only the chunks around the change are new, what comes before it is reused as it is.
+    new = [digest for digest in second.chunks if digest not in first.chunks]
+    assert 0 < len(new) < len(second.chunks)
+    assert second.chunks[0] == first.chunks[0]
+    assert sum(len(data) for data in uploaded.values()) - first_bytes < first_bytes / 2
+
+    fetched = []
+
+    def fetch(volume, path):
+        fetched.append(volume)
+        with open(path, "wb") as f:
+            f.write(uploaded[store.file_id(volume)])
+
+    work_dir = str(tmp_path / "work")
+    for record, content in ((first, original), (second, changed)):
+        fetched.clear()
+        destination = tmp_path / "restored.img"
+        assemble(record.chunks, str(destination), fetch, work_dir, store)
+        assert destination.read_bytes() == content
+        # Every volume once, and none left behind.
+        assert sorted(fetched) == sorted(set(volumes_of(record.chunks, store)))
+        assert os.listdir(work_dir) == []
+
+def test_assemble_rejects_a_corrupted_chunk(tmp_path):
+    store = ChunkStore(str(tmp_path / "chunks.json"))
+    source = tmp_path / "file.bin"
+    source.write_bytes(os.urandom(2 * CHUNK_MAX))
+    staged = queue.Queue()
+    uploaded = {}
+    record = chunk_file(str(source), "file.bin", str(tmp_path / "file.chunks"), staged=staged, store=store)
+    store.commit(upload_staged(staged, uploaded))
+
+    def fetch(volume, path):
+        data = bytearray(uploaded[store.file_id(volume)])
+        data[10] ^= 0xFF
+        with open(path, "wb") as f:
+            f.write(data)
+
+    with pytest.raises(ValueError):
+        assemble(record.chunks, str(tmp_path / "out.bin"), fetch, str(tmp_path / "work"), store)
@@ -0,0 +1,57 @@
+import re
+
+from filters import Matcher, matcher_for, translate
+
+def matches(pattern: str, path: str) -> bool:
+    return re.match(translate(pattern) + r"\Z", path) is not None
+
+def test_translate_follows_gitignore_patterns():
+    # Without a slash a pattern matches a name at any depth, with one it is anchored at the root.
+    assert matches("*.log", "a.log") and matches("*.log", "x/y/a.log")
+    assert matches("build", "build") and matches("build", "src/build")
+    assert matches("/build", "build") and not matches("/build", "src/build")
+    assert matches("docs/*.md", "docs/a.md") and not matches("docs/*.md", "x/docs/a.md")
+    # "*" and "?" stay inside one path component, "**" crosses them.
+    assert not matches("docs/*.md", "docs/sub/a.md")
+    assert matches("a?c", "abc") and not matches("a?c", "a/c")
+    assert matches("**/objects", "objects") and matches("**/objects", ".git/objects")
+    assert matches("logs/**", "logs/a/b.txt") and not matches("logs/**", "logs")
+    assert matches("a/**/b", "a/b") and matches("a/**/b", "a/x/y/b")
+    # Classes, negated classes and escapes.
+    assert matches("file[0-9]", "file7") and not matches("file[0-9]", "filex")
+    assert matches("file[!0-9]", "filex") and not matches("file[!0-9]", "file7")
+    assert matches(r"\*.txt", "*.txt") and not matches(r"\*.txt", "a.txt")
+    assert matches("a+b(1).txt", "a+b(1).txt")
+
+def test_matcher_last_rule_wins():
+    matcher = Matcher(["# comment", "", "*.tmp", "!keep.tmp", "node_modules/", r"\!bang", "cache/**", "!cache/keep"])
+    assert matcher.excluded("a.tmp", False)
+    assert not matcher.excluded("keep.tmp", False)
+    assert not matcher.excluded("# comment", False)
+    assert matcher.excluded("!bang", False)
+    # "dir/" only matches folders.
+    assert matcher.excluded("node_modules", True)
+    assert not matcher.excluded("node_modules", False)
+    assert matcher.excluded("cache/a", False)
+    assert not matcher.excluded("cache/keep", False)
+    assert not Matcher(["# only a comment", ""])
+
+def test_excluded_path_covers_what_is_below_an_excluded_folder():
+    matcher = Matcher(["node_modules/", "*.log"])
+    assert matcher.excluded_path("src/node_modules/pkg/index.js", False)
+    assert matcher.excluded_path("a/b.log", False)
+    assert not matcher.excluded_path("src/index.js", False)
+    # excluded() alone only looks at the path itself.
+    assert not matcher.excluded("src/node_modules/pkg/index.js", False)
+
+def test_matcher_for_joins_global_root_and_ignore_file_rules(tmp_path, monkeypatch):
+    monkeypatch.setattr("filters.EXCLUDE", ["*.tmp"])
+    (tmp_path / ".backupignore").write_text("!keep.tmp\nsecret/\n", encoding="utf-8")
+    matcher = matcher_for(str(tmp_path), {str(tmp_path): ["dist/"], "/elsewhere": ["*"]})
+    assert matcher.excluded("a.tmp", False)
+    assert not matcher.excluded("keep.tmp", False)
+    assert matcher.excluded("dist", True) and matcher.excluded("secret", True)
+    assert not matcher.excluded("src/main.py", False)
+
+    monkeypatch.setattr("filters.EXCLUDE", [])
+    assert matcher_for(str(tmp_path / "nothing"), {}) is None
@@ -0,0 +1,49 @@
+import datetime
+
+import pytest
+
+import scheduler
+from scheduler import CronExpression, ScheduledBackup, parse_field
+from throttle import Window
+
+def at(day: str, time: str = "02:00") -> datetime.datetime:
+    return datetime.datetime.fromisoformat(f"{day}T{time}")
+
+def test_parse_field():
+    assert parse_field("*", 0, 5) == {0, 1, 2, 3, 4, 5}
+    assert parse_field("*/15", 0, 59) == {0, 15, 30, 45}
+    assert parse_field("1-5,7", 0, 7) == {1, 2, 3, 4, 5, 7}
+    assert parse_field("0-30/10", 0, 59) == {0, 10, 20, 30}
+    for field in ("60", "5-1", "0", "x"):
+        with pytest.raises(ValueError):
+            parse_field(field, 1, 59)
+
+def test_restricted_day_fields_match_either_day():
+    # Regression: both day fields restricted used to need both, "the 13th and a Friday".
+    cron = CronExpression("0 2 13 * 5")
+    assert cron.matches(at("2026-02-13"))       # Friday the 13th
+    assert cron.matches(at("2026-02-20"))       # a Friday
+    assert cron.matches(at("2026-01-13"))       # a 13th, a Tuesday
+    assert not cron.matches(at("2026-02-14"))
+    assert not cron.matches(at("2026-02-13", "03:00"))
+
+def test_day_field_starting_with_star_does_not_restrict_on_its_own():
+    # Odd days of the month, only on Sundays.
+    cron = CronExpression("0 2 */2 * 0")
+    assert cron.matches(at("2026-02-15"))
+    assert not cron.matches(at("2026-02-22"))   # a Sunday, even day
+    assert not cron.matches(at("2026-02-21"))   # odd day, a Saturday
+
+def test_sunday_may_be_written_as_seven():
+    assert CronExpression("0 2 * * 7").matches(at("2026-02-15"))
+    assert not CronExpression("0 2 * * 7").matches(at("2026-02-02"))
+
+def test_broken_schedule_entries_are_rejected(monkeypatch):
+    for expression in ("0 2 * *", "0 24 * * *", "0 2 * 13 *"):
+        with pytest.raises(ValueError):
+            CronExpression(expression)
+    monkeypatch.setattr(scheduler.bandwidth, "windows",
+                        [Window(datetime.time(19), datetime.time(9), name="offpeak")])
+    assert ScheduledBackup({"cron": "0 2 * * *", "path": "/data", "mode": "archive", "window": "offpeak"}).window
+    with pytest.raises(ValueError):
+        ScheduledBackup({"cron": "0 2 * * *", "path": "/data", "mode": "archive", "window": "ofpeak"})
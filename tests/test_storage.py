@@ -0,0 +1,83 @@
+import storage
+from storage import BackupStorage, BackupRootFolder, FolderUpload, FileUpload
+
+def document(file_id):
+    return {"file_id": file_id, "file_unique_id": "u" + file_id, "file_size": 1}
+
+def make_backup(token):
+    record = FileUpload("a.txt", is_split=True)
+    root = BackupRootFolder("src", children=[FolderUpload("docs", [record])], token=token)
+    return root, record
+
+def test_parts_are_journaled_and_folded_into_the_tree(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "JOURNAL_COMPACT_AT", 1000)
+    path = str(tmp_path / "backups.json")
+    writer = BackupStorage(path)
+    root, record = make_backup("t1")
+    with writer.pinned("t1"):
+        writer.add_backup(root)
+        writer.save()
+        tree_mtime = (tmp_path / "backups_trees" / "t1.json").stat().st_mtime_ns
+        for file_id in ("p1", "p2"):
+            record.add_part(document(file_id))
+            writer.add_parts([(record, document(file_id))])
+        # A part the tree already holds when the journal is replayed is not added twice.
+        writer.save()
+        record.add_part(document("p3"))
+        writer.add_parts([(record, document("p3"))])
+
+    reader = BackupStorage(path)
+    reader.load()
+    (loaded,) = reader.backups
+    assert loaded.children[0].children[0].upload_id == ["p1", "p2", "p3"]
+    assert loaded.children[0].children[0].fingerprints[2] == ["up3", 1]
+
+    writer._compact()
+    assert not (tmp_path / "backups.json.journal").exists()
+    assert (tmp_path / "backups_trees" / "t1.json").stat().st_mtime_ns != tree_mtime
+    reader = BackupStorage(path)
+    reader.load()
+    assert reader.backups[0].children[0].children[0].upload_id == ["p1", "p2", "p3"]
+
+def test_load_keeps_only_pinned_and_unsaved_roots(tmp_path):
+    path = str(tmp_path / "backups.json")
+    first = BackupStorage(path)
+    for token in ("kept", "gone"):
+        first.add_backup(make_backup(token)[0])
+    first.save()
+    other = BackupStorage(path)
+    other.load()
+    # Both backups are named "src"
+    while other.delete_backup("src"):
+        pass
+    other.save()
+
+    first.pin("kept")
+    pinned = next(b for b in first.backups if b.token == "kept")
+    new, _ = make_backup("new")
+    first.add_backup(new)
+    first.load()
+    assert [b.token for b in first.backups] == ["kept", "new"]
+    assert first.backups[0] is pinned and first.backups[1] is new
+    first.unpin("kept")
+    first.load()
+    assert [b.token for b in first.backups] == ["new"]
+
+def test_journaled_nodes_replace_the_tree_writes(tmp_path):
+    path = str(tmp_path / "backups.json")
+    writer = BackupStorage(path)
+    root, _ = make_backup("t1")
+    writer.add_backup(root)
+    writer.save()
+    tree_file = tmp_path / "backups_trees" / "t1.json"
+    before = tree_file.read_text()
+    added = FileUpload("b.txt", ["p1"])
+    root.children[0].children = [added]
+    writer.add_nodes("t1", [(["docs"], ["a.txt"], added), (["new", "deep"], [], FileUpload("c.txt"))])
+    root.children.append(FolderUpload("new", [FolderUpload("deep", [FileUpload("c.txt")])]))
+    writer.save()
+    assert tree_file.read_text() == before
+
+    reader = BackupStorage(path)
+    reader.load()
+    assert storage.dump_tree(reader.backups[0].children) == storage.dump_tree(root.children)
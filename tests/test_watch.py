@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import datetime
+
+import watch
+from filters import Matcher
+from storage import BackupRootFolder, BackupStorage, FileUpload, FolderUpload
+from watch import RollingTree, PollingWatcher, InotifyWatcher
+
+def names(folder):
+    return sorted(child.name for child in folder.children)
+
+def test_place_replaces_every_version_of_a_file():
+    docs = FolderUpload("docs", [FileUpload("a.txt"), FileUpload("2024-01-01_a.txt.7z"),
+                                 FileUpload("2024-01-02_a.txt (1).7z"), FileUpload("b.txt")])
+    root = BackupRootFolder("root", children=[docs])
+    tree = RollingTree(root)
+
+    change = tree.place(os.path.join("docs", "a.txt"), FileUpload("2024-02-01_a.txt.7z"))
+    assert change == (["docs"], ["a.txt", "2024-01-01_a.txt.7z", "2024-01-02_a.txt (1).7z"])
+    assert names(docs) == ["2024-02-01_a.txt.7z", "b.txt"]
+
+    assert tree.place(os.path.join("new", "c.txt"), FileUpload("c.txt")) == (["new"], [])
+    assert tree.place(os.path.join("docs", "a.txt"), None) == (["docs"], ["2024-02-01_a.txt.7z"])
+    assert tree.place(os.path.join("gone", "d.txt"), None) is None
+    assert tree.place("new", None) == ([], ["new"])
+    assert names(root) == ["docs"]
+
+def test_watchers_do_not_enter_excluded_folders(tmp_path):
+    root = str(tmp_path)
+    for rel in ("src/a.py", "node_modules/pkg/index.js", "src/build/out.o", "notes.log"):
+        os.makedirs(os.path.dirname(os.path.join(root, rel)), exist_ok=True)
+        with open(os.path.join(root, rel), "w") as f:
+            f.write("x")
+    matchers = {root: Matcher(["node_modules/", "build/", "*.log"])}
+
+    polling = PollingWatcher([root], matchers)
+    assert sorted(os.path.relpath(path, root) for path in polling.snapshot) == [os.path.join("src", "a.py")]
+
+    if sys.platform.startswith("linux"):
+        inotify = InotifyWatcher([root], matchers)
+        try:
+            assert sorted(inotify.paths.values()) == [root, os.path.join(root, "src")]
+            # A folder that appears later below an excluded one is not watched either.
+            os.makedirs(os.path.join(root, "node_modules", "new"))
+            assert inotify.add_tree(os.path.join(root, "node_modules", "new")) == []
+        finally:
+            inotify.close()
+
+def test_snapshot_at_rebuilds_the_tree_of_that_time(tmp_path, monkeypatch):
+    storage = BackupStorage(str(tmp_path / "backups.json"))
+    monkeypatch.setattr(watch, "backups", storage)
+    os.makedirs(storage.trees_dir, exist_ok=True)
+    with open(watch.index_path("tok"), "w", encoding="utf-8") as f:
+        for date, path, deleted in [("2026-01-01T10:00:00", "a.txt", False),
+                                    ("2026-01-01T10:00:00", os.path.join("d", "b.txt"), False),
+                                    ("2026-01-02T10:00:00", "a.txt", True),
+                                    ("2026-01-03T10:00:00", "d", True)]:
+            line = {"date": date, "path": path, "deleted": deleted}
+            if not deleted:
+                line.update(FileUpload(os.path.basename(path), upload_id=["id"]).to_dict())
+            f.write(json.dumps(line) + "\n")
+
+    root = watch.snapshot_at("tok", datetime.datetime(2026, 1, 1, 12))
+    assert (root.token, root.creatin_date) == ("tok", "01.01.2026-12-00-00")
+    assert names(root) == ["a.txt", "d"]
+    assert names(watch.snapshot_at("tok", datetime.datetime(2026, 1, 2, 12))) == ["d"]
+    assert names(watch.snapshot_at("tok", datetime.datetime(2026, 1, 4))) == []
@@ -0,0 +1,66 @@
+import os
+import sys
+import socket
+import subprocess
+import threading
+from types import SimpleNamespace
+
+import backup
+import consts
+import worker
+from storage import BackupStorage
+
+def test_files_with_one_name_keep_their_own_parts(tmp_path, monkeypatch):
+    # The agent stages every README.md as tmp/README.md once the previous one is sent,
+    # the bot must still tell their parts apart.
+    source = tmp_path / "src"
+    for i in range(30):
+        (source / f"d{i}").mkdir(parents=True)
+        (source / f"d{i}" / "README.md").write_text(f"readme {i}")
+    monkeypatch.setattr(backup, "TMP_DIR", str(tmp_path / "tmp"))
+    monkeypatch.setattr(worker, "TMP_DIR", str(tmp_path / "tmp"))
+    monkeypatch.setattr(worker, "AGENT_BACKUPS", str(tmp_path / "agent_backups.json"))
+    monkeypatch.setattr(consts, "backups", BackupStorage(str(tmp_path / "backups.json")))
+    uploaded = {}
+
+    def upload_documents(token, chat_id, paths, thread_id=None):
+        documents = []
+        for path in paths:
+            file_id = f"id{len(uploaded)}"
+            with open(path, encoding="utf-8") as f:
+                uploaded[file_id] = f.read()
+            documents.append({"file_id": file_id, "file_unique_id": file_id, "file_size": 1})
+        return documents
+
+    monkeypatch.setattr(backup, "upload_documents", upload_documents)
+
+    agent_sock, bot_sock = socket.socketpair()
+    result = {}
+    agent = threading.Thread(target=lambda: result.update(
+        worker.agent_backup(agent_sock, str(source), "individual", "secret")))
+    agent.start()
+    stream = bot_sock.makefile("rwb")
+    assert worker.read_message(stream)["type"] == "hello"
+    worker.send_message(stream, {"type": "ready"})
+    job = worker.read_message(stream)
+    token = worker.receive_backup(stream, "agent", SimpleNamespace(token="123:abc"), job["path"],
+                                  job["mode"], -1, token=job["token"])
+    worker.send_message(stream, {"type": "result", "token": token})
+    agent.join(timeout=30)
+    agent_sock.close()
+    bot_sock.close()
+
+    assert result["token"] == token
+    (root,) = consts.backups.backups
+    assert len(root.children) == 30
+    for folder in root.children:
+        (readme,) = folder.children
+        assert [uploaded[file_id] for file_id in readme.upload_id] == [f"readme {folder.name[1:]}"]
+
+def test_agent_runs_without_bot_token(tmp_path):
+    # Agents get a SETTINGS.yaml without the bot token, importing worker must not need it
+    # nor load the bot's stores.
+    (tmp_path / "SETTINGS.yaml").write_text('WORKER_SECRET: "secret"\n')
+    code = "import sys, worker; assert 'consts' not in sys.modules and 'jobs' not in sys.modules"
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(worker.__file__)))
+    subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env, check=True)
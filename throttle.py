@@ -0,0 +1,107 @@
+import time
+import datetime
+import threading
+from typing import Optional, List
+
+from config import BANDWIDTH_LIMIT_MBPS, BANDWIDTH_WINDOWS
+
+def mbps_to_bytes(limit_mbps: Optional[float]) -> int:
+    """
+    Converts a limit in megabits per second (like estimated_backup_time uses) to bytes per second.
+    0 or None means unlimited.
+    """
+    return int((limit_mbps or 0) * 1_000_000 / 8)
+
+def parse_time(value: str) -> datetime.time:
+    hours, minutes = str(value).split(":")
+    return datetime.time(int(hours), int(minutes))
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` bytes per second with bursts of up to `capacity` bytes.
+    A rate of 0 lets everything through. Thread safe, consume() blocks until tokens are available.
+    """
+
+    def __init__(self, rate: int = 0, capacity: Optional[int] = None):
+        self._lock = threading.Lock()
+        self.rate = 0
+        self.capacity = 0
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.set_rate(rate, capacity)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def set_rate(self, rate: int, capacity: Optional[int] = None) -> None:
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            # One second worth of bytes, but at least one 64 KB chunk.
+            self.capacity = capacity or max(rate, 64 * 1024)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def consume(self, amount: int) -> None:
+        while amount > 0:
+            with self._lock:
+                if not self.rate:
+                    return
+                self._refill()
+                take = min(amount, self.capacity)
+                if self.tokens >= take:
+                    self.tokens -= take
+                    amount -= take
+                    continue
+                wait = (take - self.tokens) / self.rate
+            time.sleep(wait)
+
+class Window:
+    """
+    A time-of-day window with its own limit. Windows where `to` is not after `from`
+    wrap around midnight, e.g. 19:00 - 09:00.
+    """
+
+    def __init__(self, start: datetime.time, end: datetime.time, limit_mbps: float = 0, name: str = None):
+        self.start = start
+        self.end = end
+        self.rate = mbps_to_bytes(limit_mbps)
+        self.name = name
+
+    @classmethod
+    def from_config(cls, data: dict) -> "Window":
+        return cls(parse_time(data["from"]), parse_time(data["to"]), data.get("limit_mbps", 0), data.get("name"))
+
+    def contains(self, moment: datetime.time) -> bool:
+        if self.start < self.end:
+            return self.start <= moment < self.end
+        return moment >= self.start or moment < self.end
+
+class BandwidthSchedule:
+    """
+    Limits all uploads and downloads of this process together. The rate follows the
+    first window that contains the current time, outside of all windows the default limit applies.
+    """
+
+    def __init__(self, windows: List[Window], default_rate: int = 0):
+        self.windows = windows
+        self.default_rate = default_rate
+        self.bucket = TokenBucket(self.current_rate())
+
+    def window_at(self, moment: datetime.datetime = None) -> Optional[Window]:
+        moment = (moment or datetime.datetime.now()).time()
+        return next((w for w in self.windows if w.contains(moment)), None)
+
+    def current_rate(self) -> int:
+        window = self.window_at()
+        return window.rate if window else self.default_rate
+
+    def consume(self, amount: int) -> None:
+        rate = self.current_rate()
+        if rate != self.bucket.rate:
+            self.bucket.set_rate(rate)
+        self.bucket.consume(amount)
+
+bandwidth = BandwidthSchedule([Window.from_config(w) for w in BANDWIDTH_WINDOWS],
+                              mbps_to_bytes(BANDWIDTH_LIMIT_MBPS))
@@ -0,0 +1,147 @@
+import os
+import lzma
+import math
+import time
+import threading
+from typing import Dict, Optional, Tuple
+
+from config import COMPRESSION_LEVEL
+from throttle import bandwidth
+
+# 7z levels the tuner picks from and the level used until the uplink has been measured
+LEVELS = (1, 3, 5, 7, 9)
+DEFAULT_LEVEL = 5
+# The sample is SAMPLE_SLICES slices of SLICE_SIZE bytes spread over the input
+SAMPLE_SLICES = 4
+SLICE_SIZE = 256 * 1024
+# Seconds a compression profile is trusted before the next input is sampled again
+RETUNE_EVERY = 300
+
+class UplinkMeter:
+    """
+    Moving average of the measured upload throughput in bytes per second.
+    run_pipeline feeds it with every uploaded batch.
+    """
+
+    def __init__(self, weight: float = 0.3):
+        self.weight = weight
+        self.measured: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def record(self, size: int, seconds: float) -> None:
+        # Tiny uploads are mostly request overhead and say little about the link.
+        if seconds <= 0 or size < 256 * 1024:
+            return
+        with self._lock:
+            sample = size / seconds
+            self.measured = sample if self.measured is None else self.measured + self.weight * (sample - self.measured)
+
+    def rate(self) -> Optional[float]:
+        """
+        Expected upload speed: the measured one, capped by the current bandwidth limit.
+        With nothing measured yet that is the limit, or None without one.
+        """
+        limit = bandwidth.current_rate()
+        if self.measured is None:
+            return limit or None
+        return min(self.measured, limit) if limit else self.measured
+
+def read_sample(path: str) -> bytes:
+    """
+    Reads slices spread evenly over a file, or the starts of the first files of a folder.
+    """
+    files = [path]
+    if os.path.isdir(path):
+        files = []
+        for dirpath, _, filenames in os.walk(path):
+            files.extend(os.path.join(dirpath, name) for name in filenames)
+            if len(files) >= SAMPLE_SLICES:
+                break
+    slices = []
+    for file_path in files[:SAMPLE_SLICES]:
+        try:
+            size = os.path.getsize(file_path)
+            # Overlapping slices would repeat data and make it look more compressible.
+            count = SAMPLE_SLICES if len(files) == 1 and size > SAMPLE_SLICES * SLICE_SIZE else 1
+            with open(file_path, "rb") as f:
+                for i in range(count):
+                    f.seek(max(0, size - SLICE_SIZE) * i // max(1, count - 1))
+                    slices.append(f.read(SLICE_SIZE))
+        except OSError:
+            continue
+    return b"".join(slices)
+
+def profile(sample: bytes) -> Dict[int, Tuple[float, float]]:
+    """
+    Single-thread speed (input bytes per second) and output/input ratio of every level on sample.
+    Python's lzma presets stand in for the 7z levels, both are LZMA with matching level settings.
+    """
+    result = {}
+    for level in LEVELS:
+        start_time = time.perf_counter()
+        packed = lzma.compress(sample, preset=level)
+        seconds = max(time.perf_counter() - start_time, 1e-6)
+        result[level] = (len(sample) / seconds, min(1.0, len(packed) / len(sample)))
+    return result
+
+def choose(levels: Dict[int, Tuple[float, float]], uplink: float, max_threads: int) -> Tuple[int, int]:
+    """
+    Picks the level and thread count that finish soonest. Compression and upload overlap,
+    so a byte of input takes as long as the slower of the two: compressing it on `threads`
+    cores or uploading what is left of it. Each level gets just the threads it needs to keep
+    up with the uplink, and of levels within 5% of the best time the smallest output wins.
+    """
+    options = []
+    for level, (speed, ratio) in levels.items():
+        # Output of `threads` cores is speed * threads * ratio, it has to reach the uplink.
+        threads = max(1, min(max_threads, math.ceil(uplink / (speed * ratio))))
+        cost = max(1 / (speed * threads), ratio / uplink)
+        options.append((cost, ratio, level, threads))
+    best = min(cost for cost, _, _, _ in options)
+    _, level, threads = min((ratio, level, threads) for cost, ratio, level, threads in options if cost <= best * 1.05)
+    return level, threads
+
+class CompressionTuner:
+    """
+    Chooses the 7z level and thread count for every compression job.
+
+    COMPRESSION_LEVEL from SETTINGS.yaml fixes the level. With "auto" the level follows the
+    uplink: on a fast link compression is the bottleneck and a light level wins, on a slow one
+    -mx9 costs nothing. The compression profile is sampled from the input being compressed
+    and renewed every RETUNE_EVERY seconds, the uplink speed is re-read for every job,
+    so long backups keep adjusting as the link or the data changes.
+    """
+
+    def __init__(self, level_setting=COMPRESSION_LEVEL, retune_every: float = RETUNE_EVERY):
+        self.fixed = None if str(level_setting).lower() == "auto" else int(level_setting)
+        self.retune_every = retune_every
+        self.levels: Optional[Dict[int, Tuple[float, float]]] = None
+        self.sampled_at = 0.0
+        self.last: Optional[Tuple[int, int]] = None
+        self._lock = threading.Lock()
+
+    def settings(self, path: str, max_threads: int) -> Tuple[int, int]:
+        """
+        (level, threads) for compressing path with at most max_threads threads.
+        """
+        if self.fixed is not None:
+            return self.fixed, max_threads
+        uplink = uplink_meter.rate()
+        if uplink is None:
+            return DEFAULT_LEVEL, max_threads
+        with self._lock:
+            if self.levels is None or time.monotonic() - self.sampled_at > self.retune_every:
+                sample = read_sample(path)
+                if not sample:
+                    return DEFAULT_LEVEL, max_threads
+                self.levels = profile(sample)
+                self.sampled_at = time.monotonic()
+            chosen = choose(self.levels, uplink, max_threads)
+            if chosen != self.last:
+                print(f"Compression tuned to -mx{chosen[0]} with {chosen[1]} threads "
+                      f"for an uplink of {uplink * 8 / 1_000_000:.1f} Mb/s")
+                self.last = chosen
+        return chosen
+
+uplink_meter = UplinkMeter()
+tuner = CompressionTuner()
@@ -9,7 +9,7 @@ from typing import Any, Callable, Awaitable
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram import BaseMiddleware, types
 
-from storage import ChatsStorage, Chat, Topic
+from storage import ChatsStorage, Chat, Topic, FileUpload, FolderUpload
 class TextFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
         base_message = super().format(record)
@@ -65,6 +65,15 @@ def setup_logger(name: str = 'default',
     main_logger.listener = listener
     return main_logger
 
+def log_to_stderr(main_logger: logging.Logger) -> None:
+    """
+    Moves the stdout handler of a logger made by setup_logger to stderr,
+    for runs whose stdout is machine-readable output (cli.py, worker.py).
+    """
+    for handler in main_logger.listener.handlers:
+        if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+            handler.setStream(sys.stderr)
+
 def buttons(buttons_dict: dict, cols: int = 1) -> InlineKeyboardMarkup:
     """
     Convert a dictionary into an InlineKeyboardMarkup.
@@ -169,17 +178,103 @@ class ChatTrackingMiddleware(BaseMiddleware):
         # Continue processing the update.
         return await handler(event, data)
 
-def get_size(path: str) -> int:
+def build_tree(path: str, root: FolderUpload,
+               on_file: Callable[[str, str, int], FileUpload],
+               matcher: "Matcher" = None, skipped: "SkipStats" = None) -> FolderUpload:
+    """
+    Walks the folder at path depth-first and appends nodes to root as it goes.
+
+    Every directory node is created once, when it is seen as an entry of its parent,
+    and only the directories still waiting to be walked are kept on the stack,
+    so the walk stays linear in the number of entries however wide the folders are.
+
+    Args:
+        path (str): Folder to walk.
+        root (FolderUpload): Node that receives the entries of path.
+        on_file (Callable): Called as on_file(file_path, name, size) for every file,
+                            returns the FileUpload to put into the tree.
+        matcher (Matcher): Optional exclusion rules (see filters.py), excluded files are left out
+                           and excluded folders are not entered at all.
+        skipped (SkipStats): Optional, counts what the matcher left out.
+
+    Returns:
+        FolderUpload: The root node.
+    """
+    stack = [(path, root, "")]
+    while stack:
+        dir_path, node, rel_dir = stack.pop()
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    is_dir = entry.is_dir()
+                    if matcher and matcher.excluded(rel_dir + entry.name, is_dir):
+                        if skipped is not None:
+                            if is_dir:
+                                skipped.dirs += 1
+                            else:
+                                skipped.files += 1
+                                skipped.bytes += entry.stat().st_size
+                        continue
+                    if is_dir:
+                        subdirs.append(entry)
+                    else:
+                        files.append(entry)
+        except OSError as e:
+            # Like os.walk, an unreadable folder is left out instead of failing the backup.
+            logging.getLogger("tg_backuper").warning(f"Skipped unreadable folder {dir_path}: {e}")
+            continue
+        for entry in files:
+            node.children.append(on_file(entry.path, entry.name, entry.stat().st_size))
+        pending = []
+        for entry in subdirs:
+            child = FolderUpload(name=entry.name, children=[])
+            node.children.append(child)
+            # Like os.walk, symlinked folders are recorded but not followed.
+            if not entry.is_symlink():
+                pending.append((entry.path, child, f"{rel_dir}{entry.name}/"))
+        stack.extend(reversed(pending))
+    return root
+
+def iter_files(path: str, matcher: "Matcher" = None, skipped: "SkipStats" = None):
+    """
+    Yields (file_path, rel_path, size) for the files under path that the matcher
+    does not exclude, pruning excluded folders. Symbolic links are skipped.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        rel_dir = os.path.relpath(dirpath, path).replace(os.sep, "/")
+        rel_dir = "" if rel_dir == "." else rel_dir + "/"
+        if matcher:
+            kept = [d for d in dirnames if not matcher.excluded(rel_dir + d, True)]
+            if skipped is not None:
+                skipped.dirs += len(dirnames) - len(kept)
+            # os.walk only descends into what is left in dirnames.
+            dirnames[:] = kept
+        for f in filenames:
+            fp = os.path.join(dirpath, f)
+            # Skip if it is a symbolic link (optional)
+            if os.path.islink(fp):
+                continue
+            size = os.path.getsize(fp)
+            if matcher and matcher.excluded(rel_dir + f, False):
+                if skipped is not None:
+                    skipped.files += 1
+                    skipped.bytes += size
+                continue
+            yield fp, rel_dir + f, size
+
+def folder_size(path: str, matcher: "Matcher" = None, skipped: "SkipStats" = None) -> int:
+    """
+    Total size in bytes of the files under path that would be backed up, symbolic links are skipped.
+    """
+    return sum(size for _, _, size in iter_files(path, matcher, skipped))
+
+def get_size(path: str, matcher: "Matcher" = None) -> int:
     if os.path.isfile(path):
         return os.path.getsize(path)
     elif os.path.isdir(path):
-        total_size = 0
-        for dirpath, dirnames, filenames in os.walk(path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                # Skip if it is a symbolic link (optional)
-                if not os.path.islink(fp):
-                    total_size += os.path.getsize(fp)
+        total_size = folder_size(path, matcher)
         return human_readable_size(total_size), estimated_backup_time(total_size)
     else:
         raise ValueError("The provided path is neither a file nor a directory.")
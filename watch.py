@@ -0,0 +1,509 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import ctypes
+import select
+import struct
+import subprocess
+import datetime
+import threading
+from typing import Optional, List, Dict, Tuple
+
+from aiogram import Bot
+
+from consts import backups, chats, logger, BOT_TOKEN
+from config import TMP_ROOT, WATCH_ROOTS, WATCH_DEBOUNCE, WATCH_MAX_DELAY
+from storage import FileUpload, FolderUpload, BackupRootFolder, node_from_dict
+from backup import stage_file, run_pipeline
+from filters import matcher_for, Matcher
+from utils import iter_files
+
+# inotify(7) constants
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ATTRIB | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+# Seconds before a file that failed to stage or upload is tried again, doubled on every failure in a row
+RETRY_MIN = 5
+RETRY_MAX = 600
+
+def root_of(roots: List[str], path: str) -> Optional[str]:
+    return next((root for root in roots if path == root or path.startswith(root + os.sep)), None)
+
+def walk_excluded(matchers: Dict[str, Optional[Matcher]], root: str, path: str, is_dir: bool) -> bool:
+    """
+    True if the exclusion rules of root exclude path, met in a walk that never enters
+    excluded folders, like iter_files and build_tree.
+    """
+    matcher = matchers.get(root)
+    return bool(matcher) and matcher.excluded(os.path.relpath(path, root).replace(os.sep, "/"), is_dir)
+
+class InotifyWatcher:
+    """
+    Reports changed files under the roots with inotify (Linux only).
+    Every folder gets its own watch, folders created later are added as they appear.
+    Excluded folders are not watched, so node_modules and the like cost no watches.
+    """
+
+    def __init__(self, roots: List[str], matchers: Dict[str, Optional[Matcher]] = None):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.roots = roots
+        self.matchers = matchers or {}
+        self.paths: Dict[int, str] = {}
+        for root in roots:
+            self.add_tree(root)
+
+    def add_tree(self, path: str) -> List[str]:
+        """
+        Watches path and every folder below it that is not excluded. Returns the files found
+        on the way, they could have been written before the watch was in place.
+        """
+        root = root_of(self.roots, path)
+        matcher = self.matchers.get(root)
+        # A folder created later is not reached by a pruned walk, its parents are checked too.
+        if matcher and path != root and matcher.excluded_path(os.path.relpath(path, root).replace(os.sep, "/"), True):
+            return []
+        found = []
+        stack = [path]
+        while stack:
+            dir_path = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+            if wd < 0:
+                logger.warning(f"Can't watch {dir_path}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.paths[wd] = dir_path
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if walk_excluded(self.matchers, root, entry.path, is_dir):
+                            continue
+                        if is_dir:
+                            stack.append(entry.path)
+                        else:
+                            found.append(entry.path)
+            except OSError:
+                pass
+        return found
+
+    def read(self, timeout: float) -> List[Tuple[str, bool]]:
+        """
+        Waits up to timeout seconds and returns (path, deleted) for every reported change.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return []
+        changes = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, everything under the roots has to be looked at again.
+                logger.warning("inotify queue overflowed, rescanning watched roots")
+                for root in self.roots:
+                    changes.extend((path, False) for path in self.add_tree(root))
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            dir_path = self.paths.get(wd)
+            if dir_path is None or not name:
+                continue
+            path = os.path.join(dir_path, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changes.extend((file_path, False) for file_path in self.add_tree(path))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    changes.append((path, True))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                changes.append((path, True))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB):
+                changes.append((path, False))
+        return changes
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Fallback for systems without inotify: compares (mtime, size) of every file
+    on each poll, so it does walk the roots, but only what changed is reported.
+    Excluded folders and files are pruned from the walk.
+    """
+
+    def __init__(self, roots: List[str], matchers: Dict[str, Optional[Matcher]] = None):
+        self.roots = roots
+        self.matchers = matchers or {}
+        self.snapshot = self.scan()
+
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for root in self.roots:
+            stack = [root]
+            while stack:
+                try:
+                    with os.scandir(stack.pop()) as entries:
+                        for entry in entries:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                            if walk_excluded(self.matchers, root, entry.path, is_dir):
+                                continue
+                            if is_dir:
+                                stack.append(entry.path)
+                            else:
+                                stat = entry.stat(follow_symlinks=False)
+                                snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    continue
+        return snapshot
+
+    def read(self, timeout: float) -> List[Tuple[str, bool]]:
+        time.sleep(timeout)
+        current = self.scan()
+        changes = [(path, False) for path, stat in current.items() if self.snapshot.get(path) != stat]
+        changes.extend((path, True) for path in self.snapshot if path not in current)
+        self.snapshot = current
+        return changes
+
+    def close(self) -> None:
+        pass
+
+def make_watcher(roots: List[str], matchers: Dict[str, Optional[Matcher]] = None):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(roots, matchers)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify unavailable ({e}), falling back to polling")
+    return PollingWatcher(roots, matchers)
+
+def rolling_token(root: str) -> str:
+    """
+    The rolling backup of a root always has the same token, derived from its path.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, os.path.abspath(root)))
+
+def index_path(token: str) -> str:
+    return os.path.join(backups.trees_dir, f"{token}.index.jsonl")
+
+# "<date>_<name>.7z" or "<date>_<name> (N).7z", the archives compress_file makes of <name>
+ARCHIVE_NAME = re.compile(r"\d{4}-\d{2}-\d{2}_(.+?)( \(\d+\))?\.7z")
+
+def version_keys(node_name: str) -> Tuple[str, ...]:
+    """
+    Names of the files a tree node may hold a version of: its own name, and for an
+    archive made by compress_file the name of the file inside.
+    """
+    match = ARCHIVE_NAME.fullmatch(node_name)
+    if match is None:
+        return (node_name,)
+    # "2024-01-01_a (1).7z" is an archive of "a" or of "a (1)"
+    if match.group(2):
+        return (node_name, match.group(1), match.group(1) + match.group(2))
+    return (node_name, match.group(1))
+
+class RollingTree:
+    """
+    Changes of the files under a rolling backup root, applied to its tree. Every folder gets a
+    dict from file name to the nodes holding a version of it the first time it is visited,
+    so a change costs the same in a folder of ten files and in one of a hundred thousand.
+    """
+
+    def __init__(self, root: BackupRootFolder):
+        self.root = root
+        # id of a folder -> (the folder, file name -> nodes holding a version of it)
+        self.folders: Dict[int, Tuple[FolderUpload, Dict[str, list]]] = {}
+
+    def versions(self, folder: FolderUpload) -> Dict[str, list]:
+        cached = self.folders.get(id(folder))
+        if cached is None or cached[0] is not folder:
+            index = {}
+            for child in folder.children:
+                for key in version_keys(child.name):
+                    index.setdefault(key, []).append(child)
+            cached = self.folders[id(folder)] = (folder, index)
+        return cached[1]
+
+    def place(self, rel_path: str, record: Optional[FileUpload]) -> Optional[Tuple[List[str], List[str]]]:
+        """
+        Puts record into the folder of rel_path, replacing older versions of the file,
+        creating missing folders on the way. A record of None removes the file or folder.
+        Returns the change for BackupStorage.add_nodes (folder path, names removed), None if nothing changed.
+        """
+        parts = rel_path.split(os.sep)
+        folder = self.root
+        for part in parts[:-1]:
+            child = next((c for c in self.versions(folder).get(part, ()) if isinstance(c, FolderUpload)), None)
+            if child is None:
+                if record is None:
+                    return None
+                child = FolderUpload(name=part, children=[])
+                self.add(folder, child)
+            folder = child
+        index = self.versions(folder)
+        removed = index.get(parts[-1], [])[:]
+        for node in removed:
+            folder.children.remove(node)
+            for key in version_keys(node.name):
+                index[key].remove(node)
+                if not index[key]:
+                    del index[key]
+        if record is not None:
+            self.add(folder, record)
+        elif not removed:
+            return None
+        return parts[:-1], [node.name for node in removed]
+
+    def add(self, folder: FolderUpload, node) -> None:
+        folder.children.append(node)
+        for key in version_keys(node.name):
+            self.versions(folder).setdefault(key, []).append(node)
+
+# Token -> RollingTree of the root last flushed, kept while that root object stays in backups
+_rolling_trees: Dict[str, RollingTree] = {}
+
+def rolling_tree(backup: BackupRootFolder) -> RollingTree:
+    tree = _rolling_trees.get(backup.token)
+    if tree is None or tree.root is not backup:
+        tree = _rolling_trees[backup.token] = RollingTree(backup)
+    return tree
+
+def index_state(token: str, at: datetime.datetime = None) -> Dict[str, dict]:
+    """
+    Replays the point-in-time index of a rolling backup up to at (to the end without it):
+    the latest entry of every file that exists at that moment, by relative path.
+    """
+    state = {}
+    if not os.path.exists(index_path(token)):
+        return state
+    with open(index_path(token), 'r', encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            if at is not None and datetime.datetime.fromisoformat(entry["date"]) > at:
+                break
+            if entry["deleted"]:
+                # A deleted folder takes everything below it along.
+                prefix = entry["path"] + os.sep
+                for rel_path in [p for p in state if p == entry["path"] or p.startswith(prefix)]:
+                    del state[rel_path]
+            else:
+                state[entry["path"]] = entry
+    return state
+
+def snapshot_at(token: str, at: datetime.datetime) -> BackupRootFolder:
+    """
+    Rebuilds the tree of a rolling backup as it was at the given point in time
+    by replaying its index. The result is not added to backups, download restores it.
+    """
+    backup = next((b for b in backups.backups if b.token == token), None)
+    root = BackupRootFolder(name=backup.name if backup else token, children=[], token=token, uploaded=True,
+                            creatin_date=at.strftime('%d.%m.%Y-%H-%M-%S'))
+    tree = RollingTree(root)
+    for rel_path, entry in index_state(token, at).items():
+        tree.place(rel_path, node_from_dict(entry))
+    return root
+
+def catch_up(root: str, matcher: Optional[Matcher] = None) -> Dict[str, bool]:
+    """
+    What changed under root while nobody watched it: every file the rolling backup does not
+    hold with the same size and mtime, and the files it holds that are gone. On the first
+    start that is every file of root, so files that never change get into the backup too.
+    """
+    known = {rel_path: (entry.get("size"), entry.get("mtime"))
+             for rel_path, entry in index_state(rolling_token(root)).items()}
+    changes = {}
+    for file_path, _, size in iter_files(root, matcher):
+        if file_path.startswith(TMP_ROOT + os.sep):
+            continue
+        try:
+            mtime = os.path.getmtime(file_path)
+        except OSError:
+            continue
+        if known.pop(os.path.relpath(file_path, root), None) != (size, mtime):
+            changes[file_path] = False
+    for rel_path in known:
+        changes[os.path.join(root, rel_path)] = True
+    return changes
+
+def flush(bot: Bot, root: str, changes: Dict[str, bool], chat_id: int, thread_id: int = None) -> Dict[str, bool]:
+    """
+    Stages and uploads one batch of changed files of root into its rolling backup
+    and appends them to the point-in-time index. Files that failed to upload are left out
+    of both and returned as changes to try again, so are files that failed to stage.
+
+    The tree itself is not written: the batch is journaled onto it (BackupStorage.add_nodes).
+    """
+    token = rolling_token(root)
+    # Pinned until saved: the batch goes into this root, a load() elsewhere must not replace it.
+    with backups.pinned(token):
+        backups.load()
+        backup = next((b for b in backups.backups if b.token == token), None)
+        if backup is None:
+            backup = BackupRootFolder(name=os.path.basename(os.path.abspath(root)), children=[], token=token)
+            backups.add_backup(backup)
+            # The tree file is written once, every batch after that is journaled onto it.
+            backups.save()
+        tree = rolling_tree(backup)
+        date = datetime.datetime.now().isoformat(timespec="seconds")
+        unstaged = {}
+
+        def produce(budget, staged):
+            entries = []
+            for path, deleted in changes.items():
+                rel_path = os.path.relpath(path, root)
+                if rel_path == os.curdir:
+                    continue
+                if deleted or not os.path.isfile(path):
+                    entries.append((path, rel_path, None, None))
+                    continue
+                try:
+                    # Taken before the copy, a write during staging shows up as a change next time.
+                    mtime = os.path.getmtime(path)
+                    record = stage_file(path, os.path.basename(path), os.path.getsize(path), budget, staged)
+                except FileNotFoundError:
+                    # The file went away, its deletion is the next event.
+                    continue
+                except (OSError, subprocess.CalledProcessError, ValueError) as e:
+                    # Unreadable, 7z failed, tmp is full: this file is tried again, the batch goes on.
+                    print(f"Failed to stage {path}: {e}")
+                    unstaged[path] = False
+                    continue
+                entries.append((path, rel_path, record, mtime))
+            return entries
+
+        stats = {}
+        failed = []
+        entries = run_pipeline(bot, chat_id, produce, thread_id, stats, chats.mirrors, failed)
+        failed_ids = {id(record) for record in failed}
+        retry = dict(unstaged)
+        placed = []
+        lines = []
+        for path, rel_path, record, mtime in entries:
+            if record is not None and id(record) in failed_ids:
+                retry[path] = False
+                continue
+            change = tree.place(rel_path, record)
+            if change is not None:
+                placed.append((*change, record))
+            line = {"date": date, "path": rel_path, "deleted": record is None}
+            if record is not None:
+                line.update(record.to_dict(), mtime=mtime)
+            lines.append(json.dumps(line, ensure_ascii=False) + "\n")
+        # The tree first: a file in the index counts as backed up when watching starts again.
+        backups.add_nodes(token, placed)
+        os.makedirs(backups.trees_dir, exist_ok=True)
+        with open(index_path(token), 'a', encoding='utf-8') as f:
+            f.writelines(lines)
+        # A mirror missing any batch of a rolling backup does not hold it anymore.
+        complete = [chat_id] + [mirror for mirror, ok in stats["mirrors"].items() if ok]
+        backup.destinations = [c for c in backup.destinations or complete if c in complete]
+        backup.uploaded = True
+        backups.save()
+    logger.info(f"Watch: uploaded {len(entries) - len(retry)} changes of {root}, {len(retry)} to retry")
+    return retry
+
+def watch(bot: Bot, roots: List[str], chat_id: int, thread_id: int = None,
+          debounce: float = 2.0, max_delay: float = 30.0, stop: threading.Event = None) -> None:
+    """
+    Keeps the rolling backups of roots up to date until stop is set.
+
+    Changes are collected until debounce seconds pass without new events (or max_delay
+    seconds since the first one), repeated events for one file collapse into one upload.
+    """
+    roots = [os.path.abspath(root) for root in roots]
+    stop = stop or threading.Event()
+    matchers = {root: matcher_for(root) for root in roots}
+    watcher = make_watcher(roots, matchers)
+    logger.info(f"Watching {', '.join(roots)} with {watcher.__class__.__name__}")
+    pending: Dict[str, bool] = {}
+    for root in roots:
+        pending.update(catch_up(root, matchers[root]))
+    # What changed while the bot was down goes up right away.
+    first_event = last_event = time.monotonic() - max_delay
+    # Path -> (seconds it waits, when it is tried again) for files that failed, each on its own
+    backoff: Dict[str, Tuple[float, float]] = {}
+    try:
+        while not stop.is_set():
+            changes = watcher.read(debounce)
+            now = time.monotonic()
+            for path, deleted in changes:
+                # Parts staged for upload live in tmp/, which may be inside a watched root.
+                if path.startswith(TMP_ROOT + os.sep):
+                    continue
+                root = root_of(roots, path)
+                if root and path != root and matchers[root] and matchers[root].excluded_path(
+                        os.path.relpath(path, root).replace(os.sep, "/"), not deleted and os.path.isdir(path)):
+                    continue
+                if not pending:
+                    first_event = now
+                pending[path] = deleted
+                # A new version may well stage fine, it does not wait out the old one's backoff.
+                backoff.pop(path, None)
+                last_event = now
+            ready = [path for path in pending if path not in backoff or backoff[path][1] <= now]
+            if ready and (now - last_event >= debounce or now - first_event >= max_delay):
+                batch = {path: pending.pop(path) for path in ready}
+                retry = {}
+                for root in roots:
+                    root_changes = {p: d for p, d in batch.items() if p == root or p.startswith(root + os.sep)}
+                    if root_changes:
+                        try:
+                            retry.update(flush(bot, root, root_changes, chat_id, thread_id))
+                        except Exception as e:
+                            logger.error(f"Watch: failed to back up changes of {root}: {e}")
+                            retry.update(root_changes)
+                for path in batch:
+                    if path not in retry:
+                        backoff.pop(path, None)
+                for path, deleted in retry.items():
+                    # Events that came in since are newer than the failed change.
+                    pending.setdefault(path, deleted)
+                    delay = min(RETRY_MAX, backoff[path][0] * 2 if path in backoff else RETRY_MIN)
+                    backoff[path] = (delay, now + delay)
+                if retry:
+                    logger.warning(f"Watch: {len(retry)} changes failed, retrying each in "
+                                   f"{min(backoff[path][0] for path in retry):g}s or more")
+                first_event = last_event = now
+    finally:
+        watcher.close()
+
+def start_watch(bot: Bot) -> Optional[threading.Event]:
+    """
+    Starts watching the WATCH_ROOTS from SETTINGS.yaml in a background thread,
+    changes go to the work chat. Returns the event that stops it.
+    """
+    if not WATCH_ROOTS or not chats.workchat:
+        return None
+    stop = threading.Event()
+    threading.Thread(
+        target=watch,
+        args=(bot, WATCH_ROOTS, chats.workchat),
+        kwargs={"debounce": WATCH_DEBOUNCE, "max_delay": WATCH_MAX_DELAY, "stop": stop},
+        daemon=True
+    ).start()
+    return stop
+
+if __name__ == "__main__":
+    watch(Bot(token=BOT_TOKEN), sys.argv[1:] or WATCH_ROOTS, chats.workchat,
+          debounce=WATCH_DEBOUNCE, max_delay=WATCH_MAX_DELAY)
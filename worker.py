@@ -0,0 +1,322 @@
+"""
+Distributed worker mode: agents on other hosts scan and compress, the bot uploads.
+
+An agent runs create_backup on its own disk and CPU and streams every finished part to the
+bot over TCP or a unix socket. The bot feeds the parts into the same upload pipeline local
+backups use (run_pipeline), so one process keeps track of Telegram's rate limits, and the
+backup lands in the shared backups storage like any other.
+
+Backpressure is end to end: the bot reserves its tmp budget before it reads a part from the
+socket, while it waits the agent's send blocks, its own tmp budget fills and 7z gets paused.
+
+    python worker.py bot-host:7070 /srv/data /etc --mode individual --parallel 2
+
+The bot listens when WORKER_LISTEN is set. Agents authenticate with WORKER_SECRET and use
+the same SETTINGS.yaml layout minus the bot token, agents only load config.py. Nothing is
+encrypted, put the port behind a VPN or SSH tunnel or use a unix socket.
+"""
+import os
+import sys
+import hmac
+import json
+import queue
+import socket
+import asyncio
+import argparse
+import functools
+import threading
+import contextlib
+import socketserver
+from typing import Dict, Optional, Union
+
+from aiogram import Bot
+
+from config import logger, TMP_DIR, TMP_BUDGET, WORKER_LISTEN, WORKER_SECRET
+from storage import FolderUpload, FileUpload, BackupRootFolder, BackupStorage, node_from_dict, generate_token
+from staging import TmpBudget, hold_dir
+from filters import SkipStats
+from utils import log_to_stderr
+import backup
+from backup import create_backup, run_pipeline, get_unique_copy
+
+# Bytes copied from the socket to disk per read
+BLOCK = 1024 * 1024
+# Where an agent keeps the records of the backups it staged
+AGENT_BACKUPS = "agent_backups.json"
+
+_names_lock = threading.Lock()
+
+def send_message(stream, message: dict) -> None:
+    stream.write((json.dumps(message, ensure_ascii=False) + "\n").encode())
+    stream.flush()
+
+def read_message(stream) -> dict:
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    return json.loads(line)
+
+def parse_address(address: str) -> tuple:
+    """
+    "unix:/path/to.sock" or "host:port" -> (socket family, address).
+    """
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, port = address.rsplit(":", 1)
+    return socket.AF_INET, (host, int(port))
+
+def receive_backup(stream, host: str, bot: Bot, path: str, mode: str, chat_id: int, token: str = None,
+                   thread_id: int = None, stats: dict = None, mirrors: dict = None) -> str:
+    """
+    run_backup for a backup staged by an agent: the parts come from the socket instead of
+    create_backup. Records the tree the agent sends at the end, with the upload ids of its parts.
+    """
+    from consts import backups
+    stats = stats if stats is not None else {}
+    records = {}
+
+    def produce(budget, staged):
+        send_message(stream, {"type": "start", "token": token})
+        while True:
+            message = read_message(stream)
+            if message["type"] == "error":
+                raise RuntimeError(f"Agent {host} failed: {message['message']}")
+            if message["type"] == "done":
+                stats.update(message.get("skipped") or {})
+                return message["tree"]
+            size = message["size"]
+            # The name comes from the other host, only its last component is used, inside TMP_DIR.
+            name = os.path.basename(str(message["name"]).replace("\\", "/"))
+            if name in ("", ".", ".."):
+                raise ValueError(f"Agent {host} sent a part without a usable name: {message['name']!r}")
+            # Waiting here leaves the agent's data in the socket, which stops its sender.
+            budget.reserve(size)
+            hold_dir(TMP_DIR)
+            with _names_lock:
+                part = get_unique_copy(os.path.join(TMP_DIR, name))
+                open(part, "xb").close()
+            with open(part, "wb") as f:
+                left = size
+                while left:
+                    data = stream.read(min(left, BLOCK))
+                    if not data:
+                        raise ConnectionError(f"Agent {host} disconnected in the middle of {name}")
+                    f.write(data)
+                    left -= len(data)
+            # The key ties parts to their file in the tree, all parts of a split archive share it.
+            record = records.setdefault(message["key"], FileUpload(name=message["record"], upload_id=[],
+                                                                   is_split=message["split"]))
+            staged.put((record, part, size))
+
+    tree = run_pipeline(bot, chat_id, produce, thread_id, stats, mirrors)
+    stack = [tree]
+    while stack:
+        for child in stack.pop()["children"]:
+            if "children" in child:
+                stack.append(child)
+            else:
+                record = records.get(child.pop("key", None))
+                if record is not None:
+                    child["upload_id"] = record.upload_id
+                    child["fingerprints"] = record.fingerprints
+    root = BackupRootFolder(name=f"{tree['name']}@{host}", token=token,
+                            children=[node_from_dict(child) for child in tree["children"]])
+    root.destinations = [chat_id] + [mirror for mirror, complete in stats["mirrors"].items() if complete]
+    root.uploaded = True
+    backups.load()
+    backups.add_backup(root)
+    backups.save()
+    print(f"Recorded backup '{root.name}' staged by {host} (token: {token}).")
+    return token
+
+class AgentHandler(socketserver.BaseRequestHandler):
+    """
+    One connection, one backup: hello, job, parts, done, result.
+    """
+
+    def handle(self):
+        # Bot side only: these need the bot token and the bot's stores.
+        from consts import chats
+        from jobs import backup_to_workchat
+        stream = self.request.makefile("rwb")
+        try:
+            hello = read_message(stream)
+            if not hmac.compare_digest(str(hello.get("secret", "")).encode(), WORKER_SECRET.encode()):
+                send_message(stream, {"type": "error", "message": "Wrong secret"})
+                return
+            if not any(chat.chat_id == chats.workchat for chat in chats.chats):
+                send_message(stream, {"type": "error", "message": "No work chat set in the bot"})
+                return
+            send_message(stream, {"type": "ready"})
+            job = read_message(stream)
+            host = hello.get("host") or self.client_address[0]
+            logger.info(f"Agent {host} starts a backup of {job['path']}")
+            stats = {}
+            runner = functools.partial(receive_backup, stream, host)
+            future = asyncio.run_coroutine_threadsafe(
+                backup_to_workchat(self.server.bot, f"{host}:{job['path']}", job["mode"], job["token"], stats, runner),
+                self.server.loop)
+            try:
+                token = future.result()
+            except Exception as e:
+                logger.error(f"Backup from agent {host} failed: {e}")
+                send_message(stream, {"type": "error", "message": str(e)})
+                return
+            send_message(stream, {"type": "result", "token": token, **stats})
+        except (ConnectionError, ValueError, KeyError) as e:
+            logger.error(f"Agent connection from {self.client_address} dropped: {e}")
+        finally:
+            with contextlib.suppress(OSError):
+                stream.close()
+
+class TCPAgentServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixAgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def start_worker_server(bot: Bot, loop: asyncio.AbstractEventLoop) -> Optional[socketserver.BaseServer]:
+    """
+    Takes agent connections on WORKER_LISTEN in a background thread. Jobs run on loop,
+    the bot's event loop, like backups started from the chat. Returns the server.
+    """
+    if not WORKER_LISTEN:
+        return None
+    if not WORKER_SECRET:
+        logger.warning("WORKER_LISTEN is set without WORKER_SECRET, not taking agents")
+        return None
+    family, address = parse_address(WORKER_LISTEN)
+    if family == socket.AF_UNIX:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(address)
+        server = UnixAgentServer(address, AgentHandler)
+    else:
+        server = TCPAgentServer(address, AgentHandler)
+    server.bot = bot
+    server.loop = loop
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Taking agents on {WORKER_LISTEN}")
+    return server
+
+def keyed_dict(node: Union[FileUpload, FolderUpload], keys: Dict[int, str]) -> dict:
+    """
+    to_dict() of a tree node, with the key its parts were sent under on every file that has one.
+    """
+    if isinstance(node, FolderUpload):
+        return {"name": node.name, "children": [keyed_dict(child, keys) for child in node.children]}
+    data = node.to_dict()
+    if id(node) in keys:
+        data["key"] = keys[id(node)]
+    return data
+
+def run_agent_job(address: str, path: str, mode: str, secret: str = WORKER_SECRET) -> dict:
+    """
+    Agent side of one backup: stages path here and streams every part to the bot at address.
+    Returns the bot's result (token, parts, bytes, ...).
+    """
+    family, target = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(target)
+        return agent_backup(sock, path, mode, secret)
+    finally:
+        sock.close()
+
+def agent_backup(sock: socket.socket, path: str, mode: str, secret: str) -> dict:
+    """
+    run_agent_job over a connected socket.
+    """
+    stream = sock.makefile("rwb")
+    try:
+        send_message(stream, {"type": "hello", "secret": secret, "host": socket.gethostname()})
+        reply = read_message(stream)
+        if reply["type"] != "ready":
+            raise RuntimeError(reply.get("message"))
+        token = generate_token()
+        send_message(stream, {"type": "backup", "path": os.path.abspath(path), "mode": mode, "token": token})
+        reply = read_message(stream)
+        if reply["type"] != "start":
+            raise RuntimeError(reply.get("message"))
+
+        budget = TmpBudget(TMP_BUDGET)
+        staged = queue.Queue()
+        skipped = SkipStats()
+        storage = BackupStorage(AGENT_BACKUPS)
+        result = {}
+
+        def worker():
+            try:
+                create_backup(path, mode, token=token, budget=budget, staged=staged,
+                              skipped=skipped, storage=storage)
+            except Exception as e:
+                result["error"] = e
+            finally:
+                staged.put(None)
+
+        threading.Thread(target=worker, daemon=True).start()
+        # Record -> key sent with its parts. Not absolute_path: tmp names are handed out
+        # again once a part is sent and deleted, so two files could share one.
+        keys = {}
+        for file_record, part, size in iter(staged.get, None):
+            key = keys.setdefault(id(file_record), str(len(keys)))
+            send_message(stream, {"type": "part", "key": key, "record": file_record.name,
+                                  "split": file_record.is_split, "name": os.path.basename(part), "size": size})
+            with open(part, "rb") as f:
+                # Blocks while the bot is not reading, which is the backpressure.
+                sock.sendfile(f)
+            os.remove(part)
+            budget.release(size)
+        if "error" in result:
+            send_message(stream, {"type": "error", "message": str(result["error"])})
+            raise result["error"]
+        root = next(b for b in storage.backups if b.token == token)
+        send_message(stream, {"type": "done", "skipped": skipped.to_dict(),
+                              "tree": {"name": root.name, "children": [keyed_dict(child, keys) for child in root.children]}})
+        reply = read_message(stream)
+        if reply["type"] != "result":
+            raise RuntimeError(reply.get("message"))
+        root.uploaded = True
+        storage.save()
+        return reply
+    finally:
+        stream.close()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Stage backups on this host and send them to the bot.")
+    parser.add_argument("address", help='Where the bot takes agents: "host:port" or "unix:/path/to.sock"')
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--mode", choices=["archive", "individual"], default="individual")
+    parser.add_argument("--parallel", type=int, default=1, help="Backups running at once")
+    args = parser.parse_args()
+    # The chunk index lives with the bot, so agents back up big files as 7z volumes.
+    backup.DELTA_MIN_SIZE = 0
+
+    out = sys.stdout
+    # Only the JSON lines go to stdout, log lines too go to stderr.
+    log_to_stderr(logger)
+    failed = 0
+    with contextlib.redirect_stdout(sys.stderr):
+        semaphore = threading.Semaphore(max(1, args.parallel))
+        results = [None] * len(args.paths)
+
+        def job(i, path):
+            with semaphore:
+                try:
+                    results[i] = {"op": "agent_backup", "path": path, **run_agent_job(args.address, path, args.mode)}
+                except Exception as e:
+                    results[i] = {"op": "agent_backup", "path": path, "error": str(e)}
+
+        threads = [threading.Thread(target=job, args=(i, path)) for i, path in enumerate(args.paths)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    for result in results:
+        result.pop("type", None)
+        failed += "error" in result
+        print(json.dumps(result, ensure_ascii=False), file=out)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())